@@ -1,14 +1,21 @@
 from .lib.general import *
 from .lib.disk import *
+from .lib.gpt import *
+from .lib.superblock import *
 from .lib.user_interaction import *
 from .lib.exceptions import *
 from .lib.installer import *
 from .lib.profiles import *
 from .lib.luks import *
+from .lib.volumes import *
+from .lib.swap import *
 from .lib.mirrors import *
 from .lib.networking import *
 from .lib.locale_helpers import *
 from .lib.services import *
 from .lib.packages import *
 from .lib.output import *
-from .lib.tss import *
\ No newline at end of file
+from .lib.steps import *
+from .lib.instrumentation import *
+from .lib.cassette import *
+from .lib.tts import *
\ No newline at end of file
@@ -0,0 +1,135 @@
+import json, base64, hmac, hashlib, secrets, threading
+from collections import deque
+from .exceptions import *
+
+class Cassette():
+	"""
+	Records every :py:class:`~archinstall.sys_command` (argv, output, exit code and timing) into a file,
+	or replays them from that file without spawning a single process.
+	This makes it possible to run `guided.py` or `minimal.py` against a recorded session for development and benchmarking::
+
+		with archinstall.Cassette('session.json', mode='record'):
+			...
+
+		with archinstall.Cassette('session.json', mode='replay'):
+			...
+
+	When replaying, commands are matched on the command line they were called with.
+	Commands run with `sensitive=True` are matched on a salted hash of their command line instead,
+	and neither their arguments nor their output are stored, so passwords never end up in the cassette.
+	If the same command was recorded several times, the recordings are served in order
+	and the last one is repeated once they run out.
+
+	:param path: The cassette file.
+	:type path: str
+
+	:param mode: `record` or `replay`
+	:type mode: str
+
+	:param strict: Raise a :py:class:`~archinstall.SysCallError` when replaying a command that was never recorded, instead of pretending it succeeded without output.
+	:type strict: bool, optional
+	"""
+	active = None
+
+	def __init__(self, path, mode='replay', strict=True):
+		if mode not in ('record', 'replay'):
+			raise ValueError(f'Unknown cassette mode "{mode}", must be "record" or "replay".')
+
+		self.path = path
+		self.mode = mode
+		self.strict = strict
+		self.commands = []
+		self.lock = threading.Lock()
+		self.salt = secrets.token_hex(16)
+		self._queues = {}
+
+		if mode == 'replay':
+			self.load()
+
+	def __repr__(self, *args, **kwargs):
+		return f'Cassette({self.path}, mode={self.mode}, commands={len(self.commands)})'
+
+	def __enter__(self, *args, **kwargs):
+		return self.start()
+
+	def __exit__(self, *args, **kwargs):
+		# TODO: https://stackoverflow.com/questions/28157929/how-to-safely-handle-an-exception-inside-a-context-manager
+		self.stop()
+		if len(args) >= 2 and args[1]:
+			raise args[1]
+
+	def start(self):
+		Cassette.active = self
+		return self
+
+	def stop(self):
+		if Cassette.active is self:
+			Cassette.active = None
+		if self.mode == 'record':
+			self.save()
+
+	def load(self):
+		with open(self.path, 'r') as fh:
+			cassette = json.load(fh)
+		self.commands = cassette['commands']
+		self.salt = cassette.get('salt', self.salt)
+
+		self._queues = {}
+		for command in self.commands:
+			self._queues.setdefault(command.get('digest') or command['cmd'], deque()).append(command)
+
+	def save(self):
+		with open(self.path, 'w') as fh:
+			json.dump({'version' : 2, 'salt' : self.salt, 'commands' : self.commands}, fh, indent=4)
+
+	def emulates_devices(self):
+		"""
+		Whether device nodes are taken to be there rather than waited for, see :py:func:`~archinstall.wait_for_devices`.
+		Nothing is spawned while replaying, so nothing would ever create them.
+		"""
+		return self.mode == 'replay'
+
+	def digest(self, command):
+		"""
+		The key a `sensitive=True` command is recorded under, which can't be turned back into its arguments.
+		"""
+		return hmac.new(self.salt.encode('UTF-8'), command.raw_cmd.encode('UTF-8'), hashlib.sha256).hexdigest()
+
+	def record(self, command):
+		"""
+		Stores a finished `sys_command`.
+		"""
+		with self.lock:
+			recording = {
+				'cmd' : command.redacted_cmd,
+				'argv' : command.cmd,
+				'exit_code' : command.exit_code,
+				'output' : base64.b64encode(bytes(command.trace_log)).decode('UTF-8'),
+				'started' : command.started,
+				'ended' : command.ended
+			}
+			if command.kwargs['sensitive']:
+				# The output can echo the secret back (chpasswd errors do), so it's replayed as empty.
+				recording.update({'digest' : self.digest(command), 'argv' : command.cmd[:1], 'output' : None})
+			self.commands.append(recording)
+
+	def replay(self, command):
+		"""
+		Looks up the recording of a `sys_command`.
+
+		:return: `(output, exit_code)`
+		:rtype: tuple
+		"""
+		key = self.digest(command) if command.kwargs['sensitive'] else command.redacted_cmd
+		with self.lock:
+			if not (queue := self._queues.get(key)):
+				if command.kwargs['sensitive'] and command.redacted_cmd in self._queues:
+					# Recorded without a digest, there's no telling which of the redacted calls this is.
+					raise SysCallError(f"'{command.redacted_cmd}' can't be matched unambiguously against the redacted recordings in {self}")
+				if self.strict:
+					raise SysCallError(f"'{command.redacted_cmd}' was never recorded in {self}")
+				return b'', 0
+
+			recording = queue.popleft() if len(queue) > 1 else queue[0]
+
+		return base64.b64decode(recording['output'] or ''), recording['exit_code']
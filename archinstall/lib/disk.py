@@ -1,21 +1,308 @@
-import glob, re, os, json
+import glob, re, os, math, time, json, shlex, fcntl, struct, select, socket, threading
+import ctypes
 from collections import OrderedDict
 from .exceptions import *
 from .general import *
+from .gpt import GPTWriter
+from .cassette import Cassette
 
-ROOT_DIR_PATTERN = re.compile('^.*?/devices')
 GPT = 0b00000001
+GPT_DIRECT = 0b00000010 # GPT written by archinstall itself, see GPTWriter
 
 #import ctypes
 #import ctypes.util
 #libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
 #libc.mount.argtypes = (ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p)
 
+# <linux/fs.h>, all of them take a uint64_t[2] of {offset, length} in bytes
+BLKDISCARD = 0x1277
+BLKSECDISCARD = 0x127D
+BLKZEROOUT = 0x127F
+
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUPS = 0b11 # Kernel (1) and udev (2) events
+
+# <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+# Seconds to wait for device nodes and /dev/disk symlinks to show up, see wait_for_devices()
+DEVICE_TIMEOUT = 10
+# Where udev keeps the by-uuid, by-partuuid and by-label links, see device_identifiers()
+DEVICE_LINKS = '/dev/disk'
+
+class DeviceTopology():
+	"""
+	A snapshot of all block devices on the machine: disks, partitions, crypt mappings
+	and loop devices with their back-files, indexed by path and name with parent/child relations.
+
+	It's built with a single `lsblk` and `losetup` call, and then kept until either
+	a block device uevent arrives (kernel or udev) or archinstall changes a disk itself
+	and calls :py:func:`~archinstall.DeviceTopology.invalidate`.
+	The uevent socket is opened by the first snapshot, not when archinstall is imported.
+	If it can't be opened, only the explicit invalidation applies.
+	"""
+	def __init__(self):
+		self.devices = {}
+		self.names = {}
+		self.parents = {}
+		self.children = {}
+		self.loop_back_files = {}
+		self.stale = True
+		self.generation = 0
+		self.lock = threading.RLock()
+		self._monitor = None
+		self._monitor_opened = False
+
+	def __repr__(self, *args, **kwargs):
+		return f'DeviceTopology(devices={len(self.devices)}, generation={self.generation}, stale={self.stale})'
+
+	def invalidate(self):
+		self.stale = True
+
+	def _open_monitor(self):
+		self._monitor_opened = True
+		try:
+			self._monitor = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC, NETLINK_KOBJECT_UEVENT)
+			self._monitor.bind((0, UEVENT_GROUPS))
+		except (OSError, AttributeError):
+			self._monitor = None
+
+	def _drain_events(self):
+		if not self._monitor_opened:
+			# Anything before this is covered by the first snapshot being stale.
+			self._open_monitor()
+		if not self._monitor: return
+
+		while True:
+			try:
+				event = self._monitor.recv(65536)
+			except (BlockingIOError, InterruptedError):
+				break
+			except OSError:
+				# Most likely ENOBUFS, too many events queued up, so we missed some.
+				self.stale = True
+				continue
+
+			if b'SUBSYSTEM=block\0' in event:
+				self.stale = True
+
+	def snapshot(self):
+		"""
+		Returns `self`, refreshed first if anything changed since the last snapshot.
+		"""
+		with self.lock:
+			self._drain_events()
+			if self.stale:
+				self.refresh()
+		return self
+
+	def refresh(self):
+		with self.lock:
+			# Marked as fresh before running lsblk, so that anything
+			# happening while we read the devices triggers another refresh.
+			self.stale = False
+
+			devices, names, parents, children = {}, {}, {}, {}
+			for device in json.loads(b''.join(sys_command('/usr/bin/lsblk --json -l -o name,path,pkname,type,size,mountpoint,label', hide_from_log=True)).decode('UTF-8'))['blockdevices']:
+				# Devices with several parents (RAID members for instance) are listed once per parent.
+				devices.setdefault(device['path'], device)
+				names[device['name']] = device['path']
+				if device['pkname']:
+					parents.setdefault(device['name'], []).append(device['pkname'])
+					children.setdefault(device['pkname'], []).append(device['name'])
+
+			loop_back_files = {}
+			if any(device['type'] == 'loop' for device in devices.values()):
+				for drive in json.loads(b''.join(sys_command('/usr/bin/losetup --json', hide_from_log=True)).decode('UTF-8') or '{"loopdevices": []}')['loopdevices']:
+					loop_back_files[drive['name']] = drive['back-file']
+
+			self.devices, self.names, self.parents, self.children = devices, names, parents, children
+			self.loop_back_files = loop_back_files
+			self.generation += 1
+
+	def parent_of(self, path):
+		"""
+		Returns the `/dev/<name>` of the (first) parent of `path`, for instance the partition of a crypt mapping.
+		"""
+		topology = self.snapshot()
+		if (parents := topology.parents.get(os.path.basename(path))):
+			return f'/dev/{parents[0]}'
+
+	def children_of(self, path):
+		topology = self.snapshot()
+		return [topology.names[name] for name in topology.children.get(os.path.basename(path), []) if name in topology.names]
+
+	def back_file(self, path):
+		return self.snapshot().loop_back_files.get(path)
+
+	def __getitem__(self, path):
+		return self.snapshot().devices[path]
+
+	def __contains__(self, path):
+		return path in self.snapshot().devices
+
+# Shared by all block devices, see DeviceTopology.invalidate()
+topology = DeviceTopology()
+
+class DeviceWatcher():
+	"""
+	Wakes up whenever something is created under the watched directories of `/dev`.
+	Uses inotify on the closest existing parent directory of each path (and of the path a symlink points to),
+	or a uevent netlink socket if inotify isn't available.
+	"""
+	def __init__(self):
+		self.fd = None
+		self.watched = set()
+		self._monitor = None
+
+		try:
+			# The symbols of the running process, which include libc (find_library() would spawn ldconfig).
+			self._libc = ctypes.CDLL(None, use_errno=True)
+			if (fd := self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)) >= 0:
+				self.fd = fd
+		except (OSError, AttributeError):
+			pass
+
+		if self.fd is None:
+			try:
+				self._monitor = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC, NETLINK_KOBJECT_UEVENT)
+				self._monitor.bind((0, UEVENT_GROUPS))
+			except (OSError, AttributeError):
+				self._monitor = None
+
+	def __enter__(self, *args, **kwargs):
+		return self
+
+	def __exit__(self, *args, **kwargs):
+		self.close()
+
+	def watch(self, paths):
+		if self.fd is None: return
+
+		for path in paths:
+			for candidate in (os.path.abspath(path), os.path.realpath(path)):
+				directory = os.path.dirname(candidate)
+				while not os.path.isdir(directory) and directory != '/':
+					directory = os.path.dirname(directory)
+				if directory not in self.watched:
+					if self._libc.inotify_add_watch(self.fd, directory.encode('UTF-8'), IN_CREATE | IN_MOVED_TO | IN_ATTRIB) >= 0:
+						self.watched.add(directory)
+
+	def wait(self, timeout):
+		"""
+		Blocks until something happened or `timeout` seconds passed, whichever is first.
+		"""
+		if self.fd is not None:
+			source = self.fd
+		elif self._monitor:
+			source = self._monitor.fileno()
+		else:
+			# Neither inotify nor netlink (very restricted sandboxes), the last resort is checking now and then.
+			time.sleep(min(timeout, 0.1))
+			return False
+
+		if not select.select([source], [], [], timeout)[0]:
+			return False
+
+		# Only used as a wake up call, the caller checks the paths itself.
+		try:
+			while os.read(source, 65536): pass
+		except (BlockingIOError, InterruptedError):
+			pass
+		except OSError:
+			pass # ENOBUFS on the netlink socket, still a wake up call
+		return True
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+		if self._monitor:
+			self._monitor.close()
+			self._monitor = None
+
+_device_watchers = threading.local()
+
+def wait_for_devices(paths, timeout=None):
+	"""
+	Waits for device nodes or `/dev/disk` symlinks (and what they point to) to exist,
+	returning as soon as the last one shows up instead of sleeping for a fixed amount of time.
+
+	:param timeout: Seconds to wait at most, defaults to `DEVICE_TIMEOUT`.
+	:type timeout: float, optional
+
+	While a :py:class:`~archinstall.Cassette` is replaying, the devices are taken to be there right away.
+
+	:return: `True` if every path exists, `False` if some didn't show up in time (they're logged).
+	:rtype: bool
+	"""
+	if Cassette.active and Cassette.active.emulates_devices():
+		return True
+	if timeout is None: timeout = DEVICE_TIMEOUT
+	paths = list(paths)
+	deadline = time.monotonic() + timeout
+
+	if all(os.path.exists(path) for path in paths):
+		return True
+
+	# One watcher per thread, kept open: closing an inotify descriptor waits on the kernel for several milliseconds,
+	# and threads sharing one could drain each others wake ups.
+	if not (watcher := getattr(_device_watchers, 'watcher', None)):
+		watcher = _device_watchers.watcher = DeviceWatcher()
+
+	while True:
+		# Watch before checking, so that nothing created in between goes unnoticed.
+		watcher.watch(paths)
+		if not (missing := [path for path in paths if not os.path.exists(path)]):
+			return True
+
+		if (remaining := deadline - time.monotonic()) <= 0:
+			log(f'Timed out after {timeout}s waiting for: {", ".join(missing)}', level=3)
+			return False
+		watcher.wait(remaining)
+
+def _unescape_udev(name):
+	# udev escapes anything unsafe in /dev/disk/by-label as \xNN
+	return re.sub(r'\\x([0-9a-fA-F]{2})', lambda match: chr(int(match.group(1), 16)), name)
+
+def device_identifiers(root=None):
+	"""
+	Maps every device node to its `uuid`, `partuuid` and `label`, from a single pass over
+	`/dev/disk/by-uuid`, `by-partuuid` and `by-label` reading the links (no `realpath` per link).
+	`root` defaults to `DEVICE_LINKS`.
+
+	:return: `{'/dev/sda2' : {'uuid' : ..., 'partuuid' : ..., 'label' : ...}}`
+	:rtype: dict
+	"""
+	root = root or DEVICE_LINKS
+	index = {}
+	for key, directory in (('uuid', 'by-uuid'), ('partuuid', 'by-partuuid'), ('label', 'by-label')):
+		try:
+			entries = list(os.scandir(f'{root}/{directory}'))
+		except OSError:
+			continue
+
+		for entry in entries:
+			try:
+				target = os.path.normpath(os.path.join(f'{root}/{directory}', os.readlink(entry.path)))
+			except OSError:
+				continue
+			index.setdefault(target, {'uuid' : None, 'partuuid' : None, 'label' : None})[key] = _unescape_udev(entry.name) if key == 'label' else entry.name
+	return index
+
 class BlockDevice():
 	def __init__(self, path, info):
 		self.path = path
 		self.info = info
 		self.part_cache = OrderedDict()
+		# Bumped by everything that changes the partition table,
+		# the partitions are only re-read when it differs from part_cache_generation.
+		self.generation = 0
+		self.part_cache_generation = None
+		self.trimmed = False # The whole device was discarded, see BlockDevice.discard()
+		self.zeroed = False # And reads back as zeroes since
 
 	def __repr__(self, *args, **kwargs):
 		return f"BlockDevice({self.device})"
@@ -29,7 +316,8 @@ class BlockDevice():
 		return {
 			'path' : self.path,
 			'info' : self.info,
-			'partition_cache' : self.part_cache
+			'partition_cache' : self.part_cache,
+			'generation' : self.generation
 		}
 
 	@property
@@ -43,10 +331,7 @@ class BlockDevice():
 		if not 'type' in self.info: raise DiskError(f'Could not locate backplane info for "{self.path}"')
 
 		if self.info['type'] == 'loop':
-			for drive in json.loads(b''.join(sys_command(f'losetup --json', hide_from_log=True)).decode('UTF_8'))['loopdevices']:
-				if not drive['name'] == self.path: continue
-
-				return drive['back-file']
+			return topology.back_file(self.path)
 		elif self.info['type'] == 'disk':
 			return self.path
 		elif self.info['type'] == 'crypt':
@@ -56,8 +341,109 @@ class BlockDevice():
 	#	if not stat.S_ISBLK(os.stat(full_path).st_mode):
 	#		raise DiskError(f'Selected disk "{full_path}" is not a block device.')
 
+	@property
+	def size(self):
+		"""
+		The size of the device (or back-file) in bytes, `None` if it can't be opened.
+		"""
+		try:
+			fd = os.open(self.device, os.O_RDONLY)
+		except OSError:
+			return None
+		try:
+			return os.lseek(fd, 0, os.SEEK_END)
+		finally:
+			os.close(fd)
+
+	def discard(self, secure_fallback=True, zeroout_fallback=True):
+		"""
+		Discards (TRIM/UNMAP) the whole device, so that the drive starts out with nothing mapped.
+		Falls back to a secure discard, and then to a zeroout if the device can offload it
+		(`write_zeroes_max_bytes`), as writing out the zeroes by hand would take longer than it saves.
+		Everything on the device is gone afterwards.
+
+		:return: The ioctl that did the job (`BLKDISCARD`, `BLKSECDISCARD` or `BLKZEROOUT`), or `None` if the device supports none of them.
+		:rtype: str
+		"""
+		limits = queue_limits(self.path)
+
+		attempts = []
+		if limits['discard_max_bytes']:
+			attempts.append(('BLKDISCARD', BLKDISCARD))
+			if secure_fallback:
+				attempts.append(('BLKSECDISCARD', BLKSECDISCARD))
+		if zeroout_fallback and limits['write_zeroes_max_bytes']:
+			attempts.append(('BLKZEROOUT', BLKZEROOUT))
+
+		if not attempts:
+			log(f'{self.path} does not support discard, skipping it.', level=3)
+			return None
+
+		try:
+			fd = os.open(self.path, os.O_WRONLY | os.O_EXCL)
+		except OSError as err:
+			log(f'Can not discard {self.path}: {err}', level=3)
+			return None
+
+		try:
+			size = os.lseek(fd, 0, os.SEEK_END)
+			for name, request in attempts:
+				started = time.time()
+				try:
+					fcntl.ioctl(fd, request, struct.pack('QQ', 0, size))
+				except OSError as err:
+					log(f'{name} failed on {self.path}: {err}', level=3)
+					continue
+
+				elapsed = max(time.time() - started, 0.000001)
+				log(f'Discarded {human_size(size)} of {self.path} with {name} in {elapsed:.2f}s ({human_size(int(size / elapsed))}/s)')
+				self.trimmed = True
+				# Discarded blocks only read back as zeroes where the queue says so, a zeroout always does.
+				self.zeroed = name == 'BLKZEROOUT' or bool(limits['discard_zeroes_data'])
+				self.invalidate_partitions()
+				return name
+		finally:
+			os.close(fd)
+		return None
+
+	def misaligned_partitions(self, sysfs='/sys'):
+		"""
+		Lists the partitions on the device that don't start on a multiple of its physical block size,
+		minimum I/O size (RAID chunk) or optimal I/O size (RAID stripe), each of which costs
+		read-modify-write cycles on writes. Every one of them is logged as a warning.
+
+		:return: A list of `(partition path, start in bytes)`
+		:rtype: list
+		"""
+		limits = queue_limits(self.path, sysfs=sysfs)
+		alignment, offset = partition_alignment(limits, grain=1)
+		device = f'{sysfs}/class/block/{os.path.basename(os.path.realpath(self.path))}'
+		if not os.path.isdir(device):
+			return []
+
+		misaligned = []
+		for entry in os.scandir(device):
+			if not os.path.isfile(f'{entry.path}/partition'):
+				continue
+			start = int(_read_sysfs(f'{entry.path}/start', 0)) * 512 # Always in 512 byte units
+			if (start - offset) % alignment:
+				log(f'Partition /dev/{entry.name} starts at byte {start}, which is not aligned to the {alignment} byte I/O size of {self.path}.', fg='yellow')
+				misaligned.append((f'/dev/{entry.name}', start))
+		return misaligned
+
+	def invalidate_partitions(self):
+		"""
+		Marks the partition table as changed, the next read of
+		:py:attr:`~archinstall.BlockDevice.partitions` re-reads it from the device.
+		"""
+		self.generation += 1
+		topology.invalidate()
+
 	@property
 	def partitions(self):
+		if self.part_cache_generation == self.generation:
+			return {k: self.part_cache[k] for k in sorted(self.part_cache)}
+
 		o = b''.join(sys_command(f'partprobe {self.path}'))
 
 		#o = b''.join(sys_command('/usr/bin/lsblk -o name -J -b {dev}'.format(dev=dev)))
@@ -69,14 +455,27 @@ class BlockDevice():
 			raise DiskError(f'Error getting JSON output from:', f'/usr/bin/lsblk -J {self.path}')
 
 		r = json.loads(o.decode('UTF-8'))
+		found = set()
 		if len(r['blockdevices']) and 'children' in r['blockdevices'][0]:
 			root_path = f"/dev/{r['blockdevices'][0]['name']}"
 			for part in r['blockdevices'][0]['children']:
 				part_id = part['name'][len(os.path.basename(self.path)):]
+				found.add(part_id)
 				if part_id not in self.part_cache:
-					## TODO: Force over-write even if in cache?
 					self.part_cache[part_id] = Partition(root_path + part_id, part_id=part_id, size=part['size'])
+					self.part_cache[part_id].trimmed = self.trimmed
+					self.part_cache[part_id].zeroed = self.zeroed
+				else:
+					# Keep the same instance (and with it the filesystem and mountpoint we know of), but refresh the size.
+					self.part_cache[part_id].size = part['size']
+
+		# Partitions that were removed, for instance by a new partition label.
+		for part_id in list(self.part_cache):
+			if part_id not in found:
+				del(self.part_cache[part_id])
 
+		self.part_cache_generation = self.generation
+		self.misaligned_partitions()
 		return {k: self.part_cache[k] for k in sorted(self.part_cache)}
 
 	@property
@@ -85,6 +484,24 @@ class BlockDevice():
 		return [all_partitions[k] for k in all_partitions]
 
 
+# Options for Partition.format(), turned into mkfs arguments by Partition.mkfs_options()
+#   lazy_init        - ext4: initialize the inode tables and journal in the background after mounting
+#   discard          - Discard the device while formatting (skipped anyway if the device was trimmed)
+#   block_size_hint  - Use the physical (ext4) or logical (fat32) block size from sysfs
+#   stripe_hints     - ext4: stride and stripe width from the minimum and optimal I/O size in sysfs,
+#                      on by default and only applies to devices reporting a stripe (RAID, some SMR/NVMe)
+#   checksum         - btrfs: checksum algorithm (crc32c, xxhash, sha256, blake2)
+#   metadata         - btrfs: metadata profile (single, dup)
+FORMAT_PROFILES = {
+	'default' : {},
+	'fast' : {'lazy_init' : True, 'discard' : False},
+	'ssd' : {'lazy_init' : True, 'block_size_hint' : True, 'checksum' : 'xxhash', 'metadata' : 'single'},
+	'raid' : {'lazy_init' : True, 'block_size_hint' : True, 'stripe_hints' : True, 'checksum' : 'xxhash'}
+}
+
+# Filesystem names used by Partition.format() that mount knows by another name
+MOUNT_TYPES = {'fat32' : 'vfat'}
+
 class Partition():
 	def __init__(self, path, part_id=None, size=-1, filesystem=None, mountpoint=None, encrypted=False):
 		if not part_id: part_id = os.path.basename(path)
@@ -94,6 +511,10 @@ class Partition():
 		self.filesystem = filesystem # TODO: Autodetect if we're reusing a partition
 		self.size = size # TODO: Refresh?
 		self.encrypted = encrypted
+		self.trimmed = False # Set once the whole device was discarded, so mkfs can skip its own discard
+		self.zeroed = False # Set if it also reads back as zeroes, which a discard alone doesn't promise
+		self.mount_options = {} # {target : [options]} of everything mounted by Partition.mount()
+		self.volume = None # The DiskArray this partition is, if any
 
 	def __repr__(self, *args, **kwargs):
 		if self.encrypted:
@@ -101,22 +522,75 @@ class Partition():
 		else:
 			return f'Partition(path={self.path}, fs={self.filesystem}, mounted={self.mountpoint})'
 
-	def format(self, filesystem):
+	def mkfs_options(self, filesystem, profile='default'):
+		"""
+		Translates a format profile (a name in `FORMAT_PROFILES` or a `dict` of the same shape)
+		into `mkfs` arguments for this partition, reading block size and stripe hints from sysfs where asked to.
+		"""
+		if type(profile) == str:
+			if not profile in FORMAT_PROFILES:
+				raise DiskError(f'Unknown format profile "{profile}", available profiles: {", ".join(FORMAT_PROFILES)}')
+			profile = FORMAT_PROFILES[profile]
+
+		limits = queue_limits(self.path)
+		# The discard pass of mkfs is pointless on a device that was just trimmed as a whole
+		discard = profile.get('discard', True) and not self.trimmed
+		options = []
+
+		if filesystem == 'ext4':
+			extended = []
+			block_size = 4096 # What mke2fs picks for anything but tiny filesystems, and the largest a page allows
+			if profile.get('block_size_hint') and limits['physical_block_size'] >= block_size:
+				options += ['-b', str(block_size)] # Never let 4K sector drives end up with 1K blocks
+			if profile.get('lazy_init'):
+				extended += ['lazy_itable_init=1', 'lazy_journal_init=1']
+			if not discard:
+				extended.append('nodiscard')
+			if profile.get('stripe_hints', True) and limits['minimum_io_size'] > block_size and limits['optimal_io_size']:
+				extended += [f"stride={limits['minimum_io_size'] // block_size}", f"stripe_width={limits['optimal_io_size'] // block_size}"]
+			if extended:
+				options += ['-E', ','.join(extended)] # mke2fs only honors the last -E
+		elif filesystem == 'btrfs':
+			if not discard:
+				options.append('--nodiscard')
+			if profile.get('checksum'):
+				options += ['--csum', profile['checksum']]
+			if profile.get('metadata'):
+				options += ['-m', profile['metadata']]
+		elif filesystem == 'fat32':
+			if profile.get('block_size_hint'):
+				options += ['-S', str(limits['logical_block_size'])]
+
+		return options
+
+	def format(self, filesystem, profile='default', options=[]):
+		"""
+		Formats the partition.
+
+		:param profile: A name in `FORMAT_PROFILES` (`default`, `fast`, `ssd`, `raid`) or a `dict` of the same shape.
+		:type profile: str, optional
+
+		:param options: Extra `mkfs` arguments, passed as is after the ones from the profile.
+		:type options: list, optional
+		"""
 		log(f'Formatting {self} -> {filesystem}')
+		topology.invalidate() # New filesystem type and label
+		arguments = ' '.join(shlex.quote(option) for option in self.mkfs_options(filesystem, profile) + list(options))
+
 		if filesystem == 'btrfs':
-			o = b''.join(sys_command(f'/usr/bin/mkfs.btrfs -f {self.path}'))
+			o = b''.join(sys_command(f'/usr/bin/mkfs.btrfs -f {arguments} {self.path}'))
 			if not b'UUID' in o:
 				raise DiskError(f'Could not format {self.path} with {filesystem} because: {o}')
 			self.filesystem = 'btrfs'
 		elif filesystem == 'fat32':
-			o = b''.join(sys_command(f'/usr/bin/mkfs.vfat -F32 {self.path}'))
+			o = b''.join(sys_command(f'/usr/bin/mkfs.vfat -F32 {arguments} {self.path}'))
 			if (b'mkfs.fat' not in o and b'mkfs.vfat' not in o) or b'command not found' in o:
 				raise DiskError(f'Could not format {self.path} with {filesystem} because: {o}')
 			self.filesystem = 'fat32'
 		elif filesystem == 'ext4':
-			if (handle := sys_command(f'/usr/bin/mkfs.ext4 -F {self.path}')).exit_code != 0:
+			if (handle := sys_command(f'/usr/bin/mkfs.ext4 -F {arguments} {self.path}')).exit_code != 0:
 				raise DiskError(f'Could not format {self.path} with {filesystem} because: {b"".join(handle)}')
-			self.filesystem = 'fat32'
+			self.filesystem = 'ext4'
 		else:
 			raise DiskError(f'Fileformat {filesystem} is not yet implemented.')
 		return True
@@ -134,40 +608,317 @@ class Partition():
 		if not self.encrypted:
 			return self.path
 		else:
-			for blockdevice in json.loads(b''.join(sys_command('lsblk -J')).decode('UTF-8'))['blockdevices']:
-				if (parent := self.find_parent_of(blockdevice, os.path.basename(self.path))):
-					return f"/dev/{parent}"
+			if (parent := topology.parent_of(self.path)):
+				return parent
 			raise DiskError(f'Could not find appropriate parent for encrypted partition {self}')
 
-	def mount(self, target, fs=None, options=''):
-		if not self.mountpoint:
-			log(f'Mounting {self} to {target}')
+	def default_mount_options(self, filesystem, compression='zstd:3'):
+		"""
+		Mount options suited for the device the partition is on: `noatime` everywhere and for btrfs
+		`compress` and `space_cache=v2`, plus `ssd` and `discard=async` on non-rotational devices that can discard.
+		"""
+		limits = queue_limits(self.path)
+		options = ['noatime']
+		if filesystem == 'btrfs':
+			if compression:
+				options.append(f'compress={compression}')
+			options.append('space_cache=v2')
+			if not limits['rotational']:
+				options.append('ssd')
+				if limits['discard_max_bytes']:
+					options.append('discard=async')
+		return options
+
+	def mount(self, target, fs=None, options=None, subvolume=None):
+		"""
+		Mounts the partition, recording the first mountpoint in `Partition.mountpoint`.
+
+		:param options: Mount options as a list or a comma separated string, defaults to :py:func:`~archinstall.Partition.default_mount_options`.
+		:type options: list, optional
+
+		:param subvolume: A btrfs subvolume to mount instead of the top level one. A partition can have several subvolumes mounted.
+		:type subvolume: str, optional
+		"""
+		if not self.mountpoint or subvolume:
+			log(f'Mounting {self}{f" subvolume {subvolume}" if subvolume else ""} to {target}')
 			if not fs:
 				if not self.filesystem: raise DiskError(f'Need to format (or define) the filesystem on {self} before mounting.')
 				fs = self.filesystem
+			if options is None:
+				options = self.default_mount_options(fs)
+			elif type(options) == str:
+				options = [option for option in options.split(',') if option]
+			if subvolume:
+				options = list(options) + [f'subvol={subvolume}']
 			## libc has some issues with loop devices, defaulting back to sys calls
 		#	ret = libc.mount(self.path.encode(), target.encode(), fs.encode(), 0, options.encode())
 		#	if ret < 0:
 		#		errno = ctypes.get_errno()
 		#		raise OSError(errno, f"Error mounting {self.path} ({fs}) on {target} with options '{options}': {os.strerror(errno)}")
-			if sys_command(f'/usr/bin/mount {self.path} {target}').exit_code == 0:
-				self.mountpoint = target
+			topology.invalidate()
+			if sys_command(f'/usr/bin/mount -t {MOUNT_TYPES.get(fs, fs)} {"-o " + ",".join(options) if options else ""} {self.path} {target}').exit_code == 0:
+				if not self.mountpoint:
+					self.mountpoint = target
+				self.mount_options[target] = options
 				return True
 
+	def unmount(self, target=None):
+		"""
+		Unmounts `target`, or `Partition.mountpoint` if not given.
+		"""
+		if not (target := target or self.mountpoint):
+			return True
+
+		topology.invalidate()
+		if sys_command(f'/usr/bin/umount {target}').exit_code == 0:
+			self.mount_options.pop(target, None)
+			if target == self.mountpoint:
+				self.mountpoint = None
+			return True
+
+# https://en.wikipedia.org/wiki/GUID_Partition_Table#Partition_type_GUIDs
+GPT_PARTITION_TYPES = {
+	'esp' : 'C12A7328-F81F-11D2-BA4B-00A0C93EC93B',
+	'bios' : '21686148-6449-6E6F-744E-656564454649',
+	'linux' : '0FC63DAF-8483-4772-8E79-3D69D8477DE4',
+	'swap' : '0657FD6D-A4AB-43C4-84E5-0933C84B4F4F',
+	'home' : '933AC7E1-2EB4-4F13-B844-0E14E2AEF915',
+	'lvm' : 'E6D6D379-F507-44C2-A23C-238F2A3DF928',
+	'raid' : 'A19D880F-05FC-4D3B-A006-743F0F84911E',
+	'msftdata' : 'EBD0A0A2-B9E5-4433-87C0-68B6B72699C7'
+}
+
+# parted flags expressed as either a partition type or a GPT attribute
+GPT_FLAG_TYPES = {'boot' : 'esp', 'esp' : 'esp', 'bios_grub' : 'bios', 'swap' : 'swap', 'lvm' : 'lvm', 'raid' : 'raid'}
+GPT_FLAG_ATTRIBUTES = {'legacy_boot' : 'LegacyBIOSBootable', 'hidden' : 'RequiredPartition'}
+
+SIZE_UNITS = {
+	'B' : 1, 's' : 512,
+	'KiB' : 1024, 'MiB' : 1024**2, 'GiB' : 1024**3, 'TiB' : 1024**4,
+	'kB' : 1000, 'MB' : 1000**2, 'GB' : 1000**3, 'TB' : 1000**4
+}
+
+GPT_ENTRY_ARRAY_SIZE = 128*128 # 128 entries of 128 bytes each
+PLAN_ALIGNMENT = 4096 # Granularity of starts and sizes, so they're whole sectors on 4Kn drives as well
+
+def parse_size(value, disk_size=None):
+	"""
+	Converts a parted style position such as `1MiB`, `2048s` or `100%` into bytes.
+	Percentages need `disk_size`, except for `100%` which returns `None` meaning *the rest of the disk*.
+	Negative positions (`-8GiB`) count back from the end of the disk and need `disk_size` too.
+	"""
+	if type(value) == int:
+		return value
+	value = value.strip()
+
+	if value.startswith('-'):
+		if disk_size is None:
+			raise DiskError(f'Can not resolve "{value}" without knowing the size of the disk.')
+		return disk_size - parse_size(value[1:])
+
+	if value.endswith('%'):
+		percent = float(value[:-1])
+		if percent == 100 and disk_size is None:
+			return None
+		if disk_size is None:
+			raise DiskError(f'Can not resolve "{value}" without knowing the size of the disk.')
+		return int(disk_size * percent / 100)
+
+	if (match := re.match(r'^([0-9.]+)\s*([A-Za-z]*)$', value)) is None or match.group(2) not in SIZE_UNITS:
+		raise DiskError(f'Unknown size "{value}", expected a number followed by one of: {", ".join(SIZE_UNITS)} or %')
+	return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+class PartitionPlan():
+	"""
+	A complete partition layout that's validated as a whole and then written in one go
+	by :py:func:`~archinstall.Filesystem.apply`, instead of one `parted` call per
+	partition, name and flag (each of which makes the kernel re-read the partition table).
+
+	Partitions are numbered in the order they're added, starting at `0` like
+	:py:func:`~archinstall.Filesystem.set_name` and :py:func:`~archinstall.Filesystem.set`::
+
+		plan = archinstall.PartitionPlan()
+		plan.add(start='1MiB', end='513MiB', name='EFI', flags=['boot'])
+		plan.add(start='513MiB', end='100%')
+		harddrive.apply(plan)
+
+	:param label: The partition table type, only `gpt` is supported.
+	:type label: str, optional
+	"""
+	def __init__(self, label='gpt'):
+		if label != 'gpt':
+			raise DiskError(f'Unsupported partition table "{label}" in {self.__class__.__name__}, only "gpt" is supported.')
+		self.label = label
+		self.partitions = []
+
+	def __repr__(self, *args, **kwargs):
+		return f'PartitionPlan(label={self.label}, partitions={len(self.partitions)})'
+
+	def __len__(self):
+		return len(self.partitions)
+
+	def add(self, start, end, name=None, type='linux', flags=(), format=None):
+		"""
+		Adds a partition to the plan and returns its index.
+
+		:param start: Where the partition starts, in parted notation (`1MiB`, `2048s`, `10%`).
+		:param end: Where the partition ends (exclusive), `100%` for the rest of the disk.
+
+		:param type: A key of `GPT_PARTITION_TYPES` or a partition type GUID.
+		:type type: str, optional
+
+		:param flags: parted flags, such as `boot`, `esp` or `legacy_boot`.
+		:type flags: list, optional
+
+		:param format: The filesystem the partition is meant for, only kept as a hint for the caller.
+		:type format: str, optional
+		"""
+		self.partitions.append({'start' : start, 'end' : end, 'name' : name, 'type' : type, 'flags' : [], 'format' : format})
+		for flag in flags:
+			self.set(len(self.partitions)-1, flag)
+		return len(self.partitions)-1
+
+	def set_name(self, partition:int, name:str):
+		self.partitions[partition]['name'] = name
+
+	def set(self, partition:int, flag:str):
+		"""
+		Sets a parted flag, `esp on` and `esp` are the same thing.
+		"""
+		flag, *state = flag.split()
+		if state and state[0] == 'off':
+			if flag in self.partitions[partition]['flags']:
+				self.partitions[partition]['flags'].remove(flag)
+		elif flag not in self.partitions[partition]['flags']:
+			self.partitions[partition]['flags'].append(flag)
+
+	def resolve(self, disk_size=None, sector_size=512, alignment=PLAN_ALIGNMENT, alignment_offset=0):
+		"""
+		Validates the whole plan and resolves it into byte positions.
+		Starts are rounded up and ends rounded down to `alignment_offset + n * alignment`,
+		see :py:func:`~archinstall.partition_alignment`. Nothing is written to the disk if this raises.
+
+		:param disk_size: The size of the disk in bytes, the bounds can only be checked if it's known.
+		:type disk_size: int, optional
+
+		:param sector_size: The logical sector size, which decides how much room the GPT itself takes up.
+		:type sector_size: int, optional
+
+		:param alignment: The boundary partitions start and end on, in bytes.
+		:type alignment: int, optional
+
+		:param alignment_offset: The `alignment_offset` of the device in bytes.
+		:type alignment_offset: int, optional
+
+		:return: A list of `{'start', 'size', 'name', 'type', 'attributes'}` where `size` is `None` for *the rest of the disk*.
+		:rtype: list
+
+		:raises DiskError: On overlapping, out of bounds or unknown anything.
+		"""
+		if not self.partitions:
+			raise DiskError(f'{self} has no partitions.')
+		if len(self.partitions) > 128:
+			raise DiskError(f'{self} has more partitions than a GPT can hold (128).')
+
+		entry_sectors = -(-GPT_ENTRY_ARRAY_SIZE // sector_size)
+		usable_start = (2 + entry_sectors) * sector_size # Protective MBR, header and entries
+		usable_end = disk_size - (1 + entry_sectors) * sector_size if disk_size else None # Backup entries and header
+		resolved = []
+		for index, partition in enumerate(self.partitions):
+			start = parse_size(partition['start'], disk_size)
+			end = parse_size(partition['end'], disk_size)
+
+			if start is None:
+				raise DiskError(f'Partition {index} can not start at {partition["start"]}.')
+			if start < usable_start:
+				raise DiskError(f'Partition {index} starts at byte {start}, inside the GPT header (first {usable_start} bytes).')
+			if end is None and index != len(self.partitions)-1:
+				raise DiskError(f'Partition {index} fills the rest of the disk, but is not the last partition.')
+			if end is not None and usable_end and end > usable_end:
+				if not str(partition['end']).endswith('%'):
+					raise DiskError(f'Partition {index} ends at byte {end}, beyond the end of the disk ({usable_end}).')
+				end = usable_end # A percentage of the disk overlapping the backup GPT
+
+			start += (alignment_offset - start) % alignment
+			if end is not None:
+				end -= (end - alignment_offset) % alignment
+				if end <= start:
+					raise DiskError(f'Partition {index} ({partition["start"]} - {partition["end"]}) is empty once aligned to {alignment} bytes.')
+			if resolved and (previous := resolved[-1])['start'] + previous['size'] > start:
+				raise DiskError(f'Partition {index} starts at {partition["start"]}, overlapping partition {index-1}. Partitions have to be added in order.')
+
+			partition_type = partition['type']
+			attributes = []
+			for flag in partition['flags']:
+				if flag in GPT_FLAG_TYPES:
+					partition_type = GPT_FLAG_TYPES[flag]
+				elif flag in GPT_FLAG_ATTRIBUTES:
+					attributes.append(GPT_FLAG_ATTRIBUTES[flag])
+				else:
+					raise DiskError(f'Unsupported flag "{flag}" on partition {index}.')
+
+			if partition_type in GPT_PARTITION_TYPES:
+				partition_type = GPT_PARTITION_TYPES[partition_type]
+			elif not re.match(r'^[0-9A-Fa-f]{8}-([0-9A-Fa-f]{4}-){3}[0-9A-Fa-f]{12}$', partition_type):
+				raise DiskError(f'Unknown partition type "{partition_type}" on partition {index}.')
+
+			if partition['name'] and (len(partition['name']) > 36 or '"' in partition['name']):
+				raise DiskError(f'Partition name "{partition["name"]}" must be at most 36 characters and not contain quotes.')
+
+			resolved.append({
+				'start' : start,
+				'size' : end - start if end is not None else None,
+				'name' : partition['name'],
+				'type' : partition_type.upper(),
+				'attributes' : attributes
+			})
+		return resolved
+
+	def sfdisk_script(self, disk_size=None, sector_size=512, **kwargs):
+		"""
+		Renders the plan as a `sfdisk` script, see `man sfdisk` under *INPUT FORMATS*.
+		Positions are given in (logical) sectors, `kwargs` are passed on to :py:func:`~archinstall.PartitionPlan.resolve`.
+		"""
+		script = [f'label: {self.label}', f'sector-size: {sector_size}']
+		for partition in self.resolve(disk_size, sector_size, **kwargs):
+			line = [f'start={partition["start"] // sector_size}']
+			if partition['size'] is not None:
+				line.append(f'size={partition["size"] // sector_size}')
+			line.append(f'type={partition["type"]}')
+			if partition['name']:
+				line.append(f'name="{partition["name"]}"')
+			if partition['attributes']:
+				line.append(f'attrs="{" ".join(partition["attributes"])}"')
+			script.append(', '.join(line))
+		return '\n'.join(script) + '\n'
+
 class Filesystem():
 	# TODO:
 	#   When instance of a HDD is selected, check all usages and gracefully unmount them
 	#   as well as close any crypto handles.
-	def __init__(self, blockdevice, mode=GPT):
+	def __init__(self, blockdevice, mode=GPT, discard=False):
+		"""
+		:param discard: Discard the whole device (see :py:func:`~archinstall.BlockDevice.discard`) before writing the partition table.
+		    The partitions are then marked as trimmed and :py:func:`~archinstall.Partition.format` skips its own discard.
+		:type discard: bool, optional
+		"""
 		self.blockdevice = blockdevice
 		self.mode = mode
+		self.discard = discard
 
 	def __enter__(self, *args, **kwargs):
+		if self.discard:
+			self.blockdevice.discard()
 		if self.mode == GPT:
+			self.blockdevice.invalidate_partitions()
 			if sys_command(f'/usr/bin/parted -s {self.blockdevice.device} mklabel gpt',).exit_code == 0:
 				return self
 			else:
 				raise DiskError(f'Problem setting the partition format to GPT:', f'/usr/bin/parted -s {self.blockdevice.device} mklabel gpt')
+		elif self.mode == GPT_DIRECT:
+			self.blockdevice.invalidate_partitions()
+			GPTWriter(self.blockdevice.device).write([])
+			return self
 		else:
 			raise DiskError(f'Unknown mode selected to format in: {self.mode}')
 
@@ -179,6 +930,7 @@ class Filesystem():
 		return True
 
 	def raw_parted(self, string:str):
+		self.blockdevice.invalidate_partitions()
 		x = sys_command(f'/usr/bin/parted -s {string}')
 		o = b''.join(x)
 		return x
@@ -192,15 +944,59 @@ class Filesystem():
 		"""
 		return self.raw_parted(string).exit_code
 
-	def use_entire_disk(self, prep_mode=None):
-		self.add_partition('primary', start='1MiB', end='513MiB', format='fat32')
-		self.set_name(0, 'EFI')
-		self.set(0, 'boot on')
-		self.set(0, 'esp on') # TODO: Redundant, as in GPT mode it's an alias for "boot on"? https://www.gnu.org/software/parted/manual/html_node/set.html
+	def apply(self, plan:PartitionPlan):
+		"""
+		Writes a whole :py:class:`~archinstall.PartitionPlan` with a single `sfdisk` call,
+		or with :py:class:`~archinstall.GPTWriter` in `GPT_DIRECT` mode, replacing the current partition table.
+		The plan is validated before anything is written, and the partitions are re-read once afterwards.
+
+		:raises DiskError: If the plan doesn't validate or `sfdisk` fails.
+		"""
+		limits = queue_limits(self.blockdevice.path)
+		alignment, alignment_offset = partition_alignment(limits)
+
+		if self.mode == GPT_DIRECT:
+			log(f'Writing {plan} to {self.blockdevice}')
+			self.blockdevice.invalidate_partitions()
+			GPTWriter(self.blockdevice.device).write(plan, alignment=alignment, alignment_offset=alignment_offset)
+			return self._wait_for_partitions()
+
+		script = plan.sfdisk_script(self.blockdevice.size, limits['logical_block_size'], alignment=alignment, alignment_offset=alignment_offset)
+		log(f'Applying {plan} to {self.blockdevice}')
+
+		self.blockdevice.invalidate_partitions()
+		handle = sys_command(f'/usr/bin/sfdisk --wipe always --wipe-partitions always {self.blockdevice.device}', input=script.encode('UTF-8'), surpress_errors=True)
+		if handle.exit_code != 0:
+			raise DiskError(f'Could not apply {plan} to {self.blockdevice}: {handle.trace_log.decode("UTF-8")}')
+
+		# sfdisk tells the kernel about the new table once, after it's been written in full.
+		return self._wait_for_partitions()
+
+	def _wait_for_partitions(self):
+		partitions = self.blockdevice.partitions
+		wait_for_devices([partition.path for partition in partitions.values()])
+		return partitions
+
+	def use_entire_disk(self, prep_mode=None, swap=None):
+		"""
+		Lays out the whole disk as an EFI partition and a root partition.
+
+		:param swap: Size of a swap partition at the end of the disk (`8GiB`), see :py:func:`~archinstall.swap_policy`.
+		    It's the third partition, after EFI and root.
+		:type swap: str, int, optional
+		"""
+		root_end = '100%'
+		if swap:
+			root_end = f'-{swap}B' if type(swap) == int else f'-{swap}'
+		plan = PartitionPlan()
+		plan.add(start='1MiB', end='513MiB', name='EFI', flags=['boot'], format='fat32')
 		if prep_mode == 'luks2':
-			self.add_partition('primary', start='513MiB', end='100%')
+			plan.add(start='513MiB', end=root_end)
 		else:
-			self.add_partition('primary', start='513MiB', end='100%', format='ext4')
+			plan.add(start='513MiB', end=root_end, format='ext4')
+		if swap:
+			plan.add(start=root_end, end='100%', name='swap', type='swap', format='swap')
+		self.apply(plan)
 
 	def add_partition(self, type, start, end, format=None):
 		log(f'Adding partition to {self.blockdevice}')
@@ -215,30 +1011,251 @@ class Filesystem():
 	def set(self, partition:int, string:str):
 		return self.parted(f'{self.blockdevice.device} set {partition+1} {string}') == 0
 
+HOTPLUG_BUSES = ("usb", "ieee1394", "mmc", "pcmcia", "firewire")
+
+def hotplug_devices(sysfs='/sys'):
+	"""
+	Returns the real sysfs paths of every device sitting on a hotplug bus (usb, mmc etc).
+	A block device is hotplugged if any of these is one of its ancestors.
+	Built once per scan, rather than once per block device.
+	"""
+	devices = set()
+	for bus in HOTPLUG_BUSES:
+		if os.path.isdir(f'{sysfs}/bus/{bus}/devices'):
+			for device in os.scandir(f'{sysfs}/bus/{bus}/devices'):
+				devices.add(os.path.realpath(device.path))
+	return devices
+
+def is_hotplugged(device_path, hotplug_index):
+	while len(device_path) > 1:
+		if device_path in hotplug_index:
+			return True
+		device_path = os.path.dirname(device_path)
+	return False
+
 def device_state(name, *args, **kwargs):
+	"""
+	Returns `True` for fixed (non removable, not hotplugged) drives and `None` otherwise.
+
+	:param hotplug_index: The result of :py:func:`~archinstall.hotplug_devices`, to avoid re-scanning the buses for every drive.
+	:type hotplug_index: set, optional
+	"""
 	# Based out of: https://askubuntu.com/questions/528690/how-to-get-list-of-all-non-removable-disk-device-names-ssd-hdd-and-sata-ide-onl/528709#528709
-	if os.path.isfile('/sys/block/{}/device/block/{}/removable'.format(name, name)):
-		with open('/sys/block/{}/device/block/{}/removable'.format(name, name)) as f:
+	sysfs = kwargs.get('sysfs', '/sys')
+	if os.path.isfile('{}/block/{}/removable'.format(sysfs, name)):
+		with open('{}/block/{}/removable'.format(sysfs, name)) as f:
 			if f.read(1) == '1':
 				return
 
-	path = ROOT_DIR_PATTERN.sub('', os.readlink('/sys/block/{}'.format(name)))
-	hotplug_buses = ("usb", "ieee1394", "mmc", "pcmcia", "firewire")
-	for bus in hotplug_buses:
-		if os.path.exists('/sys/bus/{}'.format(bus)):
-			for device_bus in os.listdir('/sys/bus/{}/devices'.format(bus)):
-				device_link = ROOT_DIR_PATTERN.sub('', os.readlink('/sys/bus/{}/devices/{}'.format(bus, device_bus)))
-				if re.search(device_link, path):
-					return
+	if (hotplug_index := kwargs.get('hotplug_index')) is None:
+		hotplug_index = hotplug_devices(sysfs)
+
+	if is_hotplugged(os.path.realpath('{}/block/{}'.format(sysfs, name)), hotplug_index):
+		return
 	return True
 
-# lsblk --json -l -n -o path
+def human_size(size):
+	"""
+	Formats a size in bytes the way `lsblk` does, for instance `512M` or `238.5G`.
+	"""
+	exponent = 0
+	for exponent, suffix in enumerate(('B', 'K', 'M', 'G', 'T', 'P', 'E')):
+		if size < 1024 ** (exponent + 1):
+			break
+
+	whole, fraction = divmod(size, 1024 ** exponent)
+	fraction = ((fraction * 1000) // 1024 ** exponent + 50) // 100 # Round to one decimal
+	if fraction >= 10:
+		whole, fraction = whole + 1, 0
+	return f'{whole}.{fraction}{suffix}' if fraction else f'{whole}{suffix}'
+
+def _read_sysfs(path, default=None):
+	try:
+		with open(path, 'r') as fh:
+			return fh.read().strip()
+	except OSError:
+		return default
+
+QUEUE_LIMITS = ('logical_block_size', 'physical_block_size', 'minimum_io_size', 'optimal_io_size', 'discard_granularity', 'discard_max_bytes', 'discard_zeroes_data', 'write_zeroes_max_bytes', 'rotational')
+
+def queue_limits(path, sysfs='/sys'):
+	"""
+	Returns the I/O limits of a block device from `queue/` in sysfs, as integers.
+	Partitions don't have a queue of their own, so the limits of the disk they're on are used,
+	along with the `alignment_offset` of the partition itself.
+	Anything that's not a block device (such as an image file) gets the limits of a plain 512 byte sector disk.
+	"""
+	limits = {'logical_block_size' : 512, 'physical_block_size' : 512, 'minimum_io_size' : 512, 'optimal_io_size' : 0,
+		'discard_granularity' : 0, 'discard_max_bytes' : 0, 'discard_zeroes_data' : 0, 'write_zeroes_max_bytes' : 0, 'rotational' : 1, 'alignment_offset' : 0}
+
+	device = os.path.realpath(f'{sysfs}/class/block/{os.path.basename(os.path.realpath(path))}')
+	if not os.path.isdir(device):
+		return limits
+
+	limits['alignment_offset'] = int(_read_sysfs(f'{device}/alignment_offset', 0))
+	if not os.path.isdir(f'{device}/queue') and os.path.isdir(f'{os.path.dirname(device)}/queue'):
+		device = os.path.dirname(device)
+
+	for limit in QUEUE_LIMITS:
+		limits[limit] = int(_read_sysfs(f'{device}/queue/{limit}', limits[limit]))
+	return limits
+
+def partition_alignment(limits, grain=1024*1024):
+	"""
+	Works out where partitions should start from the I/O limits of a device (see :py:func:`~archinstall.queue_limits`):
+	the least common multiple of `grain` (the 1MiB every partitioning tool uses), the physical block size,
+	the minimum I/O size (RAID chunk) and the optimal I/O size (RAID stripe).
+	Anything that isn't a multiple of the physical block size, or would push the alignment past 64MiB, is
+	assumed to be bogus (some USB bridges report odd optimal I/O sizes) and left out, like libblkid does.
+
+	:return: `(alignment, offset)` in bytes, partitions start at `offset + n * alignment`.
+	:rtype: tuple
+	"""
+	alignment = grain
+	for limit in ('physical_block_size', 'minimum_io_size', 'optimal_io_size'):
+		if not (value := limits[limit]) or value % limits['physical_block_size']:
+			continue
+		if (candidate := alignment * value // math.gcd(alignment, value)) <= 64*1024*1024:
+			alignment = candidate
+	return alignment, limits['alignment_offset'] % alignment
+
+def read_mountinfo(mountinfo='/proc/self/mountinfo'):
+	"""
+	Returns `{"major:minor" : mountpoint}` with the first mountpoint of every mounted device,
+	along with `{source : mountpoint}` for the `/dev` path it was mounted from.
+	btrfs (among others) reports an anonymous `0:N` device number rather than the device's own,
+	so those are only found by their source.
+	"""
+	unescape = lambda field: re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), field) # "\\040" for a space and such
+
+	mounts = {}
+	with open(mountinfo, 'r') as fh:
+		for line in fh:
+			fields = line.rstrip('\n').split(' ')
+			mountpoint = unescape(fields[4])
+			mounts.setdefault(fields[2], mountpoint)
+
+			# Optional fields come before the "-" separator, then the filesystem type and the source.
+			if '-' in fields[6:] and len(fields) > (separator := fields.index('-', 6)) + 2:
+				if (source := unescape(fields[separator + 2])).startswith('/dev/'):
+					mounts.setdefault(source, mountpoint)
+					if source.startswith('/dev/disk/'): # by-uuid and such, the devices are looked up by /dev/<name>
+						mounts.setdefault(os.path.realpath(source), mountpoint)
+	return mounts
+
+def _udev_label(dev, udev_data):
+	try:
+		with open(f'{udev_data}/b{dev}', 'r') as fh:
+			for line in fh:
+				if line.startswith('E:ID_FS_LABEL='):
+					return line[14:].strip()
+	except OSError:
+		pass
+
+def _device_type(name, device_dir):
+	if os.path.isfile(f'{device_dir}/partition'):
+		return 'part'
+	elif name.startswith('loop'):
+		return 'loop'
+	elif name.startswith('dm-'):
+		uuid = _read_sysfs(f'{device_dir}/dm/uuid', '')
+		for prefix, dm_type in (('CRYPT-', 'crypt'), ('LVM-', 'lvm'), ('mpath-', 'mpath'), ('part', 'part')):
+			if uuid.startswith(prefix):
+				return dm_type
+		return 'dm'
+	elif name.startswith('md'):
+		return _read_sysfs(f'{device_dir}/md/level', 'md')
+	elif name.startswith('sr'):
+		return 'rom'
+	return 'disk'
+
+def enumerate_block_devices(sysfs='/sys', mountinfo='/proc/self/mountinfo', udev_data='/run/udev/data'):
+	"""
+	Lists every block device (disks and their partitions) straight from sysfs,
+	with the same information as `lsblk --json -l -o path,size,type,mountpoint,label,pkname,rm,hotplug`.
+	Unused loop devices and RAM disks are skipped, just like `lsblk` does.
+
+	Device mapper and md devices are listed under what they're built on (their `slaves/`), found through
+	the `holders/` of every disk and partition. Like `lsblk`, one built on several devices (a RAID or a multipath device)
+	is listed once for each of them.
+
+	The roots can be pointed at a fake sysfs tree.
+
+	:return: A list of `{'path', 'size', 'type', 'mountpoint', 'label', 'pkname', 'rm', 'hotplug'}`
+	:rtype: list
+	"""
+	mounts = read_mountinfo(mountinfo)
+	hotplug_index = hotplug_devices(sysfs)
+	devices = []
+
+	def describe(name, device_dir, parent=None, disk=None):
+		sectors = int(_read_sysfs(f'{device_dir}/size', '0'))
+		device_type = _device_type(name, device_dir)
+		dev = _read_sysfs(f'{device_dir}/dev', '')
+		if (device_type == 'loop' and not sectors) or dev.startswith('1:'):
+			return None
+
+		if name.startswith('dm-') and (dm_name := _read_sysfs(f'{device_dir}/dm/name')):
+			path = f'/dev/mapper/{dm_name}'
+		else:
+			path = f'/dev/{name}'
+
+		return {
+			'path' : path,
+			'size' : human_size(sectors * 512), # Always in 512 byte sectors, regardless of the logical block size
+			'type' : device_type,
+			'mountpoint' : mounts.get(dev) or mounts.get(path) or mounts.get(f'/dev/{name}'),
+			'label' : _udev_label(dev, udev_data),
+			'pkname' : parent,
+			# Partitions are as removable and hotplugged as their disk
+			'rm' : disk['rm'] if disk else _read_sysfs(f'{device_dir}/removable', '0') == '1',
+			'hotplug' : disk['hotplug'] if disk else is_hotplugged(device_dir, hotplug_index)
+		}
+
+	def add(name, device_dir, parent=None, disk=None):
+		if not (info := describe(name, device_dir, parent, disk)):
+			return
+		devices.append(info)
+
+		if info['type'] != 'part':
+			for entry in sorted(os.scandir(device_dir), key=lambda entry: entry.name):
+				if entry.is_dir(follow_symlinks=False) and os.path.isfile(f'{entry.path}/partition'):
+					add(entry.name, entry.path, parent=name, disk=info)
+
+		# dm-crypt, LVM and md stacked on top of this device, which may have more stacked on them.
+		try:
+			holders = sorted(os.listdir(f'{device_dir}/holders'))
+		except OSError:
+			holders = []
+		for holder in holders:
+			add(holder, os.path.realpath(f'{device_dir}/holders/{holder}'), parent=name)
+
+	for disk in sorted(os.scandir(f'{sysfs}/block'), key=lambda entry: entry.name):
+		# Anything built on other devices turns up under their holders instead.
+		if os.path.isdir(f'{disk.path}/slaves') and os.listdir(f'{disk.path}/slaves'):
+			continue
+		# The entries in /sys/block are relative links into /sys/devices, one readlink rather than a realpath walk
+		add(disk.name, os.path.normpath(f'{sysfs}/block/{os.readlink(disk.path)}') if disk.is_symlink() else disk.path)
+
+	return devices
+
 def all_disks(*args, **kwargs):
+	"""
+	Returns `{path : BlockDevice}` of all block devices, read from sysfs without spawning `lsblk`.
+
+	:param partitions: Include partitions as well.
+	:type partitions: bool, optional
+
+	:param fixed: Leave out removable and hotplugged drives (USB sticks, SD cards), like :py:func:`~archinstall.device_state` does.
+	:type fixed: bool, optional
+	"""
 	if not 'partitions' in kwargs: kwargs['partitions'] = False
+	if not 'fixed' in kwargs: kwargs['fixed'] = False
 	drives = OrderedDict()
-	#for drive in json.loads(sys_command(f'losetup --json', *args, **lkwargs, hide_from_log=True)).decode('UTF_8')['loopdevices']:
-	for drive in json.loads(b''.join(sys_command(f'lsblk --json -l -n -o path,size,type,mountpoint,label,pkname', *args, **kwargs, hide_from_log=True)).decode('UTF_8'))['blockdevices']:
+	for drive in enumerate_block_devices(**{key: kwargs[key] for key in ('sysfs', 'mountinfo', 'udev_data') if key in kwargs}):
 		if not kwargs['partitions'] and drive['type'] == 'part': continue
+		if kwargs['fixed'] and (drive['rm'] or drive['hotplug']): continue
+		if drive['path'] in drives: continue # Listed once per device it's built on, keep the first
 
 		drives[drive['path']] = BlockDevice(drive['path'], drive)
 	return drives
\ No newline at end of file
@@ -5,4 +5,6 @@ class DiskError(BaseException):
 class ProfileError(BaseException):
 	pass
 class SysCallError(BaseException):
+	pass
+class StepError(BaseException):
 	pass
\ No newline at end of file
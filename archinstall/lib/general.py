@@ -1,9 +1,16 @@
 import os, json, hashlib, shlex, sys
-import time, pty
-from subprocess import Popen, STDOUT, PIPE, check_output
+import time, pty, termios, asyncio, tempfile
+from collections import deque
+from subprocess import Popen, STDOUT, PIPE, DEVNULL, check_output
 from select import epoll, EPOLLIN, EPOLLHUP
 from .exceptions import *
 from .output import *
+from .journal import TraceJournal
+from .instrumentation import instrumentation
+from .cassette import Cassette
+
+# Every sys_command ends up as a record in this journal, see TraceJournal.find()
+trace_journal = TraceJournal(f"{os.path.expanduser('~')}/.cache/archinstall/trace.journal", compress=True)
 
 def gen_uid(entropy_length=256):
 	return hashlib.sha512(os.urandom(entropy_length)).hexdigest()
@@ -22,13 +29,177 @@ def multisplit(s, splitters):
 		s = ns
 	return s
 
+# Resolved binaries, keyed by (name, $PATH).
+# Only hits are cached, as binaries might get installed during the run.
+__binary_cache__ = {}
+
 def locate_binary(name):
+	"""
+	Returns the full path of a binary, found in `$PATH` unless it's already an absolute path.
+	`None` if there's no such binary.
+	"""
+	if name.startswith('/'):
+		return name if os.path.isfile(name) else None
+	if (cached := __binary_cache__.get((name, os.environ['PATH']))):
+		return cached
+
 	for PATH in os.environ['PATH'].split(':'):
-		for root, folders, files in os.walk(PATH):
-			for file in files:
-				if file == name:
-					return os.path.join(root, file)
-			break # Don't recurse
+		if os.path.isfile(path := os.path.join(PATH, name)):
+			__binary_cache__[(name, os.environ['PATH'])] = path
+			return path
+
+class TraceLog():
+	"""
+	Append-only output store for :py:class:`~archinstall.sys_command`.
+	Chunks are kept as-is (no concatenation on append), the most recent
+	`max_memory` bytes stay in memory and anything older is spilled
+	to an anonymous temporary file.
+
+	It behaves enough like `bytes` for `decode()`, slicing, `split()`,
+	`in` and line iteration to keep working for existing callers.
+
+	:param max_memory: How many bytes of the most recent output to keep in memory.
+	:type max_memory: int
+	"""
+	def __init__(self, max_memory=4*1024*1024, read_size=65536):
+		self.max_memory = max_memory
+		self.read_size = read_size
+		self.chunks = deque()
+		self.size = 0
+		self.memory_start = 0 # Absolute offset of the first byte held in self.chunks, everything before it is spilled
+		self._spill_handle = None
+
+	def __len__(self):
+		return self.size
+
+	def __bytes__(self):
+		return self.read()
+
+	def __repr__(self, *args, **kwargs):
+		return f"TraceLog(size={self.size}, in_memory={self.size - self.memory_start})"
+
+	def __contains__(self, data):
+		return data in self.read()
+
+	def __getitem__(self, key):
+		if type(key) != slice:
+			return self.read(key, key+1 if key != -1 else None)[0]
+		if key.step not in (None, 1):
+			raise ValueError('TraceLog only supports continuous slices.')
+		return self.read(key.start, key.stop)
+
+	def __iter__(self):
+		"""
+		Yields the output line by line (split on `\\n` just like `bytes.split()`),
+		without ever joining the whole output together.
+		"""
+		remainder = b''
+		for chunk in self.iter_chunks():
+			lines = (remainder + chunk).split(b'\n')
+			remainder = lines.pop()
+			yield from lines
+		yield remainder
+
+	def append(self, data):
+		if not len(data): return
+		self.chunks.append(data)
+		self.size += len(data)
+
+		while self.size - self.memory_start > self.max_memory and len(self.chunks) > 1:
+			if not self._spill_handle:
+				self._spill_handle = tempfile.TemporaryFile(prefix='archinstall-')
+			chunk = self.chunks.popleft()
+			self._spill_handle.write(chunk)
+			self.memory_start += len(chunk)
+
+	def iter_chunks(self, start=0, end=None):
+		"""
+		Yields the stored output between the absolute offsets `start` and `end`,
+		chunk by chunk, reading anything that has been spilled from disk.
+		"""
+		if end is None or end > self.size: end = self.size
+		if start >= end: return
+
+		if start < self.memory_start:
+			self._spill_handle.flush()
+			# pread() leaves the file position alone, so appending can carry on afterwards.
+			while start < min(end, self.memory_start) and (data := os.pread(self._spill_handle.fileno(), min(self.read_size, min(end, self.memory_start) - start), start)):
+				start += len(data)
+				yield data
+			start = self.memory_start
+
+		position = self.memory_start
+		for chunk in self.chunks:
+			if position >= end: break
+			if position + len(chunk) > start:
+				yield chunk[max(start - position, 0):end - position]
+			position += len(chunk)
+
+	def read(self, start=None, end=None):
+		start, end, _ = slice(start, end).indices(self.size)
+		return b''.join(self.iter_chunks(start, end))
+
+	def split(self, *args, **kwargs):
+		return self.read().split(*args, **kwargs)
+
+	def tail(self, length):
+		return self.read(max(self.size - length, 0))
+
+	def decode(self, fmt='UTF-8', *args, **kwargs):
+		return self.read().decode(fmt, *args, **kwargs)
+
+class TriggerMatcher():
+	"""
+	Case insensitive multi-pattern matcher used for the `events` of :py:class:`~archinstall.sys_command`.
+	Output is fed to it as it arrives and searched with `bytes.find()` for every trigger still pending.
+	The only state kept between reads is the tail of the previous one (one byte short of the longest trigger),
+	so that triggers split over two reads are still found.
+
+	:param events: A `dict` of `{trigger : response}`, both `str` or `bytes`.
+	:type events: dict
+	"""
+	def __init__(self, events):
+		self.triggers = []
+		self.responses = []
+		for trigger, response in events.items():
+			if type(trigger) != bytes: trigger = bytes(trigger, 'UTF-8')
+			if type(response) != bytes: response = bytes(response, 'UTF-8')
+			self.triggers.append(trigger)
+			self.responses.append(response)
+
+		self.lowered = [trigger.lower() for trigger in self.triggers]
+		self.pending = set(range(len(self.triggers)))
+		self.carry = max((len(trigger) for trigger in self.triggers), default=1) - 1
+		self.tail = b''
+
+	def __len__(self):
+		return len(self.pending)
+
+	def __repr__(self, *args, **kwargs):
+		return f"TriggerMatcher(pending={[self.triggers[index] for index in sorted(self.pending)]})"
+
+	def feed(self, data):
+		"""
+		Consumes newly read output and returns a list of `(trigger, response)`
+		for every trigger that matched, in the order they appeared.
+		A trigger only ever fires once.
+		"""
+		fired = []
+		if not self.pending: return fired
+
+		window = self.tail + data.lower()
+		found = []
+		for index in self.pending:
+			if (position := window.find(self.lowered[index])) != -1:
+				found.append((position + len(self.lowered[index]), index))
+
+		for _, index in sorted(found):
+			self.pending.remove(index)
+			fired.append((self.triggers[index], self.responses[index]))
+
+		# The tail is too short to hold a whole trigger, so nothing in it is ever found twice.
+		self.tail = window[max(len(window) - self.carry, 0):]
+		return fired
 
 class sys_command():#Thread):
 	"""
@@ -38,8 +209,15 @@ class sys_command():#Thread):
 		if not 'worker_id' in kwargs: kwargs['worker_id'] = gen_uid()
 		if not 'emulate' in kwargs: kwargs['emulate'] = False
 		if not 'surpress_errors' in kwargs: kwargs['surpress_errors'] = False
+		if not 'stream' in kwargs: kwargs['stream'] = False
+		if not 'pty' in kwargs: kwargs['pty'] = 'events' in kwargs # Only interactive commands need a terminal
+		if not 'trace_memory' in kwargs: kwargs['trace_memory'] = 4*1024*1024 # Bytes of output kept in memory, the rest goes to a temporary file
+		if not 'exec_dir' in kwargs: kwargs['exec_dir'] = None # Working directory of the child, defaults to the current one
+		if not 'input' in kwargs: kwargs['input'] = None # Bytes written to the stdin of the child (pipe mode only), for instance a sfdisk script
+		if not 'merge_stderr' in kwargs: kwargs['merge_stderr'] = True # False keeps stderr out of the output and in self.stderr instead (pipe mode only)
+		if not 'sensitive' in kwargs: kwargs['sensitive'] = False # The command line holds secrets (passwords), keep it out of logs and the journal
 		if kwargs['emulate']:
-			log(f"Starting command '{cmd}' in emulation mode.")
+			log(f"Starting command '{'<redacted>' if kwargs['sensitive'] else cmd}' in emulation mode.")
 		self.raw_cmd = cmd
 		try:
 			self.cmd = shlex.split(cmd)
@@ -51,39 +229,71 @@ class sys_command():#Thread):
 		self.callback = callback
 		self.pid = None
 		self.exit_code = None
+		self.rusage = None
 		self.started = time.time()
 		self.ended = None
 		self.worker_id = kwargs['worker_id']
-		self.trace_log = b''
 		self.status = 'starting'
 
-		user_catalogue = os.path.expanduser('~')
-		self.cwd = f"{user_catalogue}/.cache/archinstall/workers/{kwargs['worker_id']}/"
-		self.exec_dir = f'{self.cwd}/{os.path.basename(self.cmd[0])}_workingdir'
+		self.exec_dir = kwargs['exec_dir']
+		self.trace_log = TraceLog(max_memory=kwargs['trace_memory'])
+		self.stderr = b''
 
-		if not self.cmd[0][0] == '/':
-			# "which" doesn't work as it's a builin to bash.
-			# It used to work, but for whatever reason it doesn't anymore. So back to square one..
-			
-			#log('Worker command is not executed with absolute path, trying to find: {}'.format(self.cmd[0]), origin='spawn', level=5)
-			#log('This is the binary {} for {}'.format(o.decode('UTF-8'), self.cmd[0]), origin='spawn', level=5)
-			self.cmd[0] = locate_binary(self.cmd[0])
+		# "which" doesn't work as it's a builin to bash.
+		# It used to work, but for whatever reason it doesn't anymore. So back to square one..
+		# Absolute paths are handed back as they are.
 
-		if not os.path.isdir(self.exec_dir):
-			os.makedirs(self.exec_dir)
+		#log('Worker command is not executed with absolute path, trying to find: {}'.format(self.cmd[0]), origin='spawn', level=5)
+		#log('This is the binary {} for {}'.format(o.decode('UTF-8'), self.cmd[0]), origin='spawn', level=5)
+		if (binary := locate_binary(self.cmd[0])):
+			self.cmd[0] = binary
+		elif not (kwargs['emulate'] or (Cassette.active and Cassette.active.mode == 'replay')):
+			# Nothing is spawned when emulating or replaying, so the binary doesn't have to be there.
+			raise RequirementError(f'Binary {self.cmd[0]} does not exist, can not run: {self.redacted_cmd}')
 
 		if start_callback: start_callback(self, *args, **kwargs)
-		self.run()
+		if not kwargs['stream']:
+			self.run()
 
 	def __iter__(self, *args, **kwargs):
-		for line in self.trace_log.split(b'\n'):
-			yield line
+		if self.status == 'starting':
+			# sys_command(..., stream=True) hasn't been started yet,
+			# so we run it here and hand out lines as they arrive.
+			yield from self.stream()
+		else:
+			yield from self.trace_log
+
+	def stream(self):
+		"""
+		Runs the command and yields each line of output (without the trailing `\\n`)
+		as soon as it's been read, rather than waiting for the command to finish.
+		Requires the command to have been created with `stream=True`.
+		"""
+		remainder = b''
+		for output in self.execute():
+			lines = (remainder + output).split(b'\n')
+			remainder = lines.pop()
+			yield from lines
+		yield remainder
 
 	def __repr__(self, *args, **kwargs):
 		return f"{self.cmd, self.trace_log}"
 
+	@property
+	def redacted_cmd(self):
+		"""
+		The command line as it's safe to show or store, only the binary for `sensitive=True` commands.
+		"""
+		if self.kwargs['sensitive']:
+			return f'{self.cmd[0]} <redacted>'
+		return self.raw_cmd
+
 	def decode(self, fmt='UTF-8'):
-		return self.trace_log.decode(fmt)
+		"""
+		The output as text, without leading or trailing whitespace, whether it was run over a pipe or a pty.
+		`self.trace_log` has the output exactly as the command wrote it.
+		"""
+		return self.trace_log.decode(fmt).strip()
 
 	def dump(self):
 		return {
@@ -94,26 +304,120 @@ class sys_command():#Thread):
 			'ended' : self.ended,
 			'started_pprint' : '{}-{}-{} {}:{}:{}'.format(*time.localtime(self.started)),
 			'ended_pprint' : '{}-{}-{} {}:{}:{}'.format(*time.localtime(self.ended)) if self.ended else None,
-			'exit_code' : self.exit_code
+			'exit_code' : self.exit_code,
+			'cpu_time' : self.rusage.ru_utime + self.rusage.ru_stime if self.rusage else None,
+			'max_rss' : self.rusage.ru_maxrss if self.rusage else None,
+			'output_bytes' : len(self.trace_log)
 		}
 
 	def run(self):
+		for output in self.execute():
+			pass
+
+	def execute(self):
+		"""
+		Starts the command and yields each chunk of output as it's read.
+		The output is also stored in `self.trace_log`.
+
+		Commands are run over plain pipes unless `pty=True` is given,
+		which is the default when `events` are used, since those
+		usually wait for a prompt that's only shown on a terminal.
+
+		With `emulate=True`, or while a :py:class:`~archinstall.Cassette` is replaying,
+		nothing is spawned at all.
+		"""
+		if self.kwargs['emulate'] or (Cassette.active and Cassette.active.mode == 'replay'):
+			yield from self._execute_emulated()
+		elif self.kwargs['pty']:
+			yield from self._execute_pty()
+		else:
+			yield from self._execute_pipe()
+
+	def _execute_emulated(self):
+		self.status = 'running'
+
+		if Cassette.active and Cassette.active.mode == 'replay':
+			output, self.exit_code = Cassette.active.replay(self)
+			self.trace_log.append(output)
+			if len(output):
+				yield output
+		else:
+			self.exit_code = 0
+
+		self.status = 'done'
+		self._finish()
+
+	def _execute_pipe(self):
+		self.status = 'running'
+
+		# A file rather than a second pipe, so a child filling up stderr can't block while stdout is being read.
+		stderr = STDOUT if self.kwargs['merge_stderr'] else tempfile.TemporaryFile(prefix='archinstall-')
+		try:
+			process = Popen(self.cmd, cwd=self.exec_dir, stdin=DEVNULL if self.kwargs['input'] is None else PIPE, stdout=PIPE, stderr=stderr)
+		except (FileNotFoundError, TypeError):
+			if stderr != STDOUT:
+				stderr.close()
+			log(f"{self.cmd[0]} does not exist.", origin='spawn', level=2)
+			self.status = 'done'
+			self.exit_code = 1
+			self._finish()
+			return
+
+		self.pid = process.pid
+		if self.kwargs['input'] is not None:
+			# Small enough to fit in the pipe buffer, so it's written up front rather than interleaved with the reads.
+			try:
+				process.stdin.write(self.kwargs['input'])
+			except BrokenPipeError:
+				pass # The child exited without reading it, the exit code tells the rest
+			finally:
+				try:
+					process.stdin.close()
+				except BrokenPipeError:
+					pass
+
+		# A blocking read returns as soon as there's output, and b'' once the child closed its end.
+		while (output := os.read(process.stdout.fileno(), 8192)):
+			self.trace_log.append(output)
+			yield output
+
+			if 'debug' in self.kwargs and self.kwargs['debug']:
+				log(self.cmd, 'gave:', output.decode('UTF-8'))
+
+			if 'on_output' in self.kwargs:
+				self.kwargs['on_output'](self.kwargs['worker'], output)
+
+		process.stdout.close()
+		# wait4() instead of process.wait() to get the resource usage of the child.
+		_, status, self.rusage = os.wait4(process.pid, 0)
+		self.exit_code = process.returncode = os.waitstatus_to_exitcode(status)
+		if stderr != STDOUT:
+			stderr.seek(0)
+			self.stderr = stderr.read()
+			stderr.close()
+
+		self.status = 'done'
+		self._finish()
+
+	def _execute_pty(self):
 		self.status = 'running'
-		old_dir = os.getcwd()
-		os.chdir(self.exec_dir)
 		self.pid, child_fd = pty.fork()
 		if not self.pid: # Child process
+			# Only the child changes directory, the working directory
+			# of the parent (and any other running command) is left alone.
+			if self.exec_dir:
+				os.chdir(self.exec_dir)
+			# No \n -> \r\n translation, so the output is the same as over a pipe
+			attributes = termios.tcgetattr(1)
+			attributes[1] &= ~termios.ONLCR
+			termios.tcsetattr(1, termios.TCSANOW, attributes)
 			# Replace child process with our main process
-			if not self.kwargs['emulate']:
-				try:
-					os.execv(self.cmd[0], self.cmd)
-				except FileNotFoundError:
-					self.status = 'done'
-					log(f"{self.cmd[0]} does not exist.", origin='spawn', level=2)
-					self.exit_code = 1
-					return False
-
-		os.chdir(old_dir)
+			try:
+				os.execv(self.cmd[0], self.cmd)
+			except (FileNotFoundError, TypeError):
+				log(f"{self.cmd[0]} does not exist.", origin='spawn', level=2)
+			# Never let the forked child carry on running the parents code.
+			os._exit(1)
 
 		poller = epoll()
 		poller.register(child_fd, EPOLLIN | EPOLLHUP)
@@ -122,57 +426,44 @@ class sys_command():#Thread):
 			log(f'[D] Using triggers for command: {self.cmd}')
 			log(json.dumps(self.kwargs['events']))
 
+		if 'events' in self.kwargs:
+			triggers = TriggerMatcher(self.kwargs['events'])
+
 		alive = True
-		last_trigger_pos = 0
-		while alive and not self.kwargs['emulate']:
+		while alive:
 			for fileno, event in poller.poll(0.1):
 				try:
-					output = os.read(child_fd, 8192).strip()
-					self.trace_log += output
+					output = os.read(child_fd, 8192)
+					self.trace_log.append(output)
 				except OSError:
 					alive = False
 					break
 
+				if len(output):
+					yield output
+
 				if 'debug' in self.kwargs and self.kwargs['debug'] and len(output):
 					log(self.cmd, 'gave:', output.decode('UTF-8'))
 
 				if 'on_output' in self.kwargs:
 					self.kwargs['on_output'](self.kwargs['worker'], output)
 
-				lower = output.lower()
-				broke = False
 				if 'events' in self.kwargs:
-					for trigger in list(self.kwargs['events']):
-						if type(trigger) != bytes:
-							original = trigger
-							trigger = bytes(original, 'UTF-8')
-							self.kwargs['events'][trigger] = self.kwargs['events'][original]
-							del(self.kwargs['events'][original])
-						if type(self.kwargs['events'][trigger]) != bytes:
-							self.kwargs['events'][trigger] = bytes(self.kwargs['events'][trigger], 'UTF-8')
-
-						if trigger.lower() in self.trace_log[last_trigger_pos:].lower():
-							trigger_pos = self.trace_log[last_trigger_pos:].lower().find(trigger.lower())
-
+					if (fired := triggers.feed(output)):
+						for trigger, response in fired:
 							if 'debug' in self.kwargs and self.kwargs['debug']:
-								log(f"Writing to subprocess {self.cmd[0]}: {self.kwargs['events'][trigger].decode('UTF-8')}")
-								log(f"Writing to subprocess {self.cmd[0]}: {self.kwargs['events'][trigger].decode('UTF-8')}", origin='spawn', level=5)
+								log(f"Writing to subprocess {self.cmd[0]}: {response.decode('UTF-8')}")
+								log(f"Writing to subprocess {self.cmd[0]}: {response.decode('UTF-8')}", origin='spawn', level=5)
 
-							last_trigger_pos = trigger_pos
-							os.write(child_fd, self.kwargs['events'][trigger])
-							del(self.kwargs['events'][trigger])
-							broke = True
-							break
-
-					if broke:
+							os.write(child_fd, response)
 						continue
 
 					## Adding a exit trigger:
-					if len(self.kwargs['events']) == 0:
+					if len(triggers) == 0:
 						if 'debug' in self.kwargs and self.kwargs['debug']:
 							log(f"Waiting for last command {self.cmd[0]} to finish.", origin='spawn', level=4)
 
-						if bytes(f']$'.lower(), 'UTF-8') in self.trace_log[0-len(f']$')-5:].lower():
+						if bytes(f']$'.lower(), 'UTF-8') in self.trace_log.tail(len(f']$')+5).lower():
 							if 'debug' in self.kwargs and self.kwargs['debug']:
 								log(f"{self.cmd[0]} has finished.")
 							alive = False
@@ -183,31 +474,154 @@ class sys_command():#Thread):
 		if 'debug' in self.kwargs and self.kwargs['debug']:
 			log(f"{self.cmd[0]} waiting for exit code.")
 
-		if not self.kwargs['emulate']:
+		try:
+			_, status, self.rusage = os.wait4(self.pid, 0)
+			self.exit_code = os.waitstatus_to_exitcode(status)
+		except ChildProcessError:
 			try:
-				self.exit_code = os.waitpid(self.pid, 0)[1]
+				self.exit_code = os.waitstatus_to_exitcode(os.waitpid(child_fd, 0)[1])
 			except ChildProcessError:
-				try:
-					self.exit_code = os.waitpid(child_fd, 0)[1]
-				except ChildProcessError:
-					self.exit_code = 1
-		else:
-			self.exit_code = 0
+				self.exit_code = 1
+
+		self._finish()
 
+	def _finish(self):
 		if 'debug' in self.kwargs and self.kwargs['debug']:
 			log(f"{self.cmd[0]} got exit code: {self.exit_code}")
 
 		if 'ignore_errors' in self.kwargs:
 			self.exit_code = 0
 
+		self.ended = time.time()
+		self.journal()
+		self.instrument()
+
+		if Cassette.active and Cassette.active.mode == 'record':
+			Cassette.active.record(self)
+
 		if self.exit_code != 0 and not self.kwargs['surpress_errors']:
-			log(f"'{self.raw_cmd}' did not exit gracefully, exit code {self.exit_code}.")
+			log(f"'{self.redacted_cmd}' did not exit gracefully, exit code {self.exit_code}.")
 			log(self.trace_log.decode('UTF-8'))
-			raise SysCallError(f"'{self.raw_cmd}' did not exit gracefully, exit code {self.exit_code}.\n{self.trace_log.decode('UTF-8')}")
+			raise SysCallError(f"'{self.redacted_cmd}' did not exit gracefully, exit code {self.exit_code}.\n{self.trace_log.decode('UTF-8')}")
+
+	def instrument(self):
+		"""
+		Records wall time, child CPU time, peak RSS and output size in :py:data:`~archinstall.instrumentation`.
+		The command line of `sensitive=True` commands is redacted.
+		CPU time and peak RSS are only known when the child was reaped through `wait4()`.
+		"""
+		instrumentation.add(os.path.basename(str(self.cmd[0])), 'sys_command', self.started, self.ended,
+			cmd=self.redacted_cmd, # Ends up in Chrome traces attached to bug reports
+			worker_id=self.worker_id,
+			exit_code=self.exit_code,
+			cpu_time=self.rusage.ru_utime + self.rusage.ru_stime if self.rusage else None,
+			max_rss=self.rusage.ru_maxrss if self.rusage else None,
+			output_bytes=len(self.trace_log))
+
+	def journal(self):
+		"""
+		Stores the command, its timestamps, exit code and output in :py:data:`~archinstall.trace_journal`.
+		Commands run with `sensitive=True` are not journalled at all.
+		"""
+		if self.kwargs['sensitive']:
+			return None
+		return trace_journal.record(self.worker_id, self.trace_log.iter_chunks(),
+			cmd=self.raw_cmd,
+			status=self.status,
+			started=self.started,
+			ended=self.ended,
+			exit_code=self.exit_code)
+
+class async_sys_command(sys_command):
+	"""
+	The asyncio counterpart of :py:class:`~archinstall.sys_command`.
+	The command is not started on creation but when awaited,
+	which makes it possible to run many commands from one event loop::
 
-		self.ended = time.time()
-		with open(f'{self.cwd}/trace.log', 'wb') as fh:
-			fh.write(self.trace_log)
+		lsblk, losetup = await asyncio.gather(async_sys_command('lsblk --json'), async_sys_command('losetup --json'))
+
+	Output ends up in `trace_log`, and a non-zero exit code raises
+	:py:class:`~archinstall.SysCallError` just like for `sys_command`.
+	The child runs without a pty, in `exec_dir` if one is given.
+
+	:param timeout: Seconds to wait for the command before it's killed. It's then handled like any other
+	    non-zero exit code, a `SysCallError` unless `surpress_errors` is given.
+	:type timeout: float, optional
+	"""
+	def __init__(self, cmd, callback=None, start_callback=None, *args, **kwargs):
+		if not 'timeout' in kwargs: kwargs['timeout'] = None
+		kwargs['stream'] = True # Started when awaited, not on creation
+		super().__init__(cmd, callback, start_callback, *args, **kwargs)
+
+	def __await__(self):
+		return self.execute_async().__await__()
+
+	def __iter__(self, *args, **kwargs):
+		yield from self.trace_log
+
+	def run(self):
+		raise SysCallError(f"'{self.redacted_cmd}' is an async_sys_command and needs to be awaited.")
+
+	async def _communicate(self, triggers):
+		while (output := await self.process.stdout.read(8192)):
+			self.trace_log.append(output)
+
+			if 'debug' in self.kwargs and self.kwargs['debug']:
+				log(self.cmd, 'gave:', output.decode('UTF-8'))
+
+			if 'on_output' in self.kwargs:
+				self.kwargs['on_output'](self.kwargs['worker'], output)
+
+			if triggers:
+				for trigger, response in triggers.feed(output):
+					if 'debug' in self.kwargs and self.kwargs['debug']:
+						log(f"Writing to subprocess {self.cmd[0]}: {response.decode('UTF-8')}", origin='spawn', level=5)
+					self.process.stdin.write(response)
+					await self.process.stdin.drain()
+
+		return await self.process.wait()
+
+	async def execute_async(self):
+		"""
+		Starts the command, waits for it (or the timeout) and returns `self`.
+		If the awaiting task is cancelled, the child is killed before the cancellation propagates.
+		"""
+		if self.kwargs['emulate'] or (Cassette.active and Cassette.active.mode == 'replay'):
+			for output in self._execute_emulated():
+				pass
+			return self
+
+		self.status = 'running'
+		triggers = TriggerMatcher(self.kwargs['events']) if 'events' in self.kwargs else None
+
+		try:
+			self.process = await asyncio.create_subprocess_exec(*self.cmd,
+				cwd=self.exec_dir,
+				stdin=PIPE if triggers else DEVNULL,
+				stdout=PIPE,
+				stderr=STDOUT)
+		except (FileNotFoundError, TypeError):
+			log(f"{self.cmd[0]} does not exist.", origin='spawn', level=2)
+			self.status = 'done'
+			self.exit_code = 1
+			self._finish()
+			return self
+
+		self.pid = self.process.pid
+		try:
+			self.exit_code = await asyncio.wait_for(self._communicate(triggers), self.kwargs['timeout'])
+		except asyncio.TimeoutError:
+			log(f"'{self.redacted_cmd}' did not finish within {self.kwargs['timeout']} seconds, killing it.", origin='spawn', level=3)
+		finally:
+			if self.process.returncode is None:
+				self.process.kill()
+				await self.process.wait()
+
+		# Killed by the timeout, the exit code is the (negative) signal like for sys_command, and _finish() takes it from there.
+		self.exit_code = self.process.returncode
+		self.status = 'done'
+		self._finish()
+		return self
 
 def prerequisit_check():
 	if not os.path.isdir('/sys/firmware/efi'):
@@ -0,0 +1,217 @@
+import os, stat, uuid, zlib, fcntl, struct
+from .exceptions import *
+from .output import log
+
+GPT_SIGNATURE = b'EFI PART'
+GPT_REVISION = 0x00010000
+# signature, revision, header size, header crc32, reserved, current lba, backup lba,
+# first usable lba, last usable lba, disk guid, entries lba, number of entries, entry size, entries crc32
+GPT_HEADER = struct.Struct('<8sIIIIQQQQ16sQIII')
+# type guid, unique guid, first lba, last lba (inclusive), attributes, name (UTF-16LE)
+GPT_ENTRY = struct.Struct('<16s16sQQQ72s')
+GPT_ENTRIES = 128
+
+# Bit numbers of the GPT partition attributes, same names as sfdisk uses.
+GPT_ATTRIBUTES = {'RequiredPartition' : 0, 'NoBlockIOProtocol' : 1, 'LegacyBIOSBootable' : 2}
+
+BLKSSZGET = 0x1268 # Logical sector size
+BLKRRPART = 0x125F # Re-read partition table
+
+class GPTWriter():
+	"""
+	Writes a GUID partition table straight onto a block device or image file,
+	without calling out to `parted` or `sfdisk`: the protective MBR, the primary and backup headers
+	and both partition entry arrays, including their CRC32's. Everything is read back and checked afterwards.
+
+	Used by :py:class:`~archinstall.Filesystem` in `GPT_DIRECT` mode::
+
+		with archinstall.Filesystem(harddrive, archinstall.GPT_DIRECT) as fs:
+			fs.use_entire_disk('luks2')
+
+	:param path: A block device or a (sparse) image file.
+	:type path: str
+
+	:param sector_size: The logical sector size, read from the device if not given (512 for files).
+	:type sector_size: int, optional
+	"""
+	def __init__(self, path, sector_size=None):
+		self.path = path
+		with open(self.path, 'rb') as fh:
+			mode = os.fstat(fh.fileno()).st_mode
+			self.block_device = stat.S_ISBLK(mode)
+			self.size = fh.seek(0, os.SEEK_END)
+
+			if sector_size is None:
+				sector_size = 512
+				if self.block_device:
+					sector_size = struct.unpack('i', fcntl.ioctl(fh.fileno(), BLKSSZGET, struct.pack('i', 0)))[0]
+		self.sector_size = sector_size
+
+		self.entry_sectors = -(-GPT_ENTRIES*GPT_ENTRY.size // self.sector_size)
+		self.last_lba = self.size // self.sector_size - 1
+		self.first_usable_lba = 2 + self.entry_sectors
+		self.last_usable_lba = self.last_lba - 1 - self.entry_sectors
+
+		if self.last_usable_lba <= self.first_usable_lba:
+			raise DiskError(f'{self.path} is too small to hold a GPT ({self.size} bytes).')
+
+	def __repr__(self, *args, **kwargs):
+		return f'GPTWriter({self.path}, sector_size={self.sector_size}, size={self.size})'
+
+	def entries(self, partitions):
+		"""
+		Builds the raw partition entry array out of resolved partitions, see :py:func:`~archinstall.PartitionPlan.resolve`.
+		"""
+		if len(partitions) > GPT_ENTRIES:
+			raise DiskError(f'A GPT can hold at most {GPT_ENTRIES} partitions, got {len(partitions)}.')
+
+		array = bytearray(GPT_ENTRIES*GPT_ENTRY.size)
+		for index, partition in enumerate(partitions):
+			first_lba = partition['start'] // self.sector_size
+			if partition['size'] is None:
+				last_lba = self.last_usable_lba
+			else:
+				last_lba = (partition['start'] + partition['size']) // self.sector_size - 1
+
+			if partition['start'] % self.sector_size or (partition['size'] or 0) % self.sector_size:
+				raise DiskError(f'Partition {index} is not aligned to the {self.sector_size} byte sectors of {self.path}.')
+			if first_lba < self.first_usable_lba or last_lba > self.last_usable_lba or last_lba < first_lba:
+				raise DiskError(f'Partition {index} (LBA {first_lba} - {last_lba}) is outside of the usable LBA range {self.first_usable_lba} - {self.last_usable_lba} of {self.path}.')
+
+			attributes = 0
+			for attribute in partition['attributes']:
+				attributes |= 1 << GPT_ATTRIBUTES[attribute]
+
+			GPT_ENTRY.pack_into(array, index*GPT_ENTRY.size,
+				uuid.UUID(partition['type']).bytes_le,
+				uuid.UUID(partition['uuid']).bytes_le if partition.get('uuid') else uuid.uuid4().bytes_le,
+				first_lba,
+				last_lba,
+				attributes,
+				(partition['name'] or '').encode('UTF-16LE')
+			)
+		return bytes(array)
+
+	def header(self, disk_guid, entries_crc, backup=False):
+		if backup:
+			current_lba, backup_lba, entries_lba = self.last_lba, 1, self.last_lba - self.entry_sectors
+		else:
+			current_lba, backup_lba, entries_lba = 1, self.last_lba, 2
+
+		fields = [GPT_SIGNATURE, GPT_REVISION, GPT_HEADER.size, 0, 0, current_lba, backup_lba,
+			self.first_usable_lba, self.last_usable_lba, disk_guid.bytes_le, entries_lba, GPT_ENTRIES, GPT_ENTRY.size, entries_crc]
+		# The header CRC32 is calculated with the field itself set to zero
+		fields[3] = zlib.crc32(GPT_HEADER.pack(*fields))
+		return GPT_HEADER.pack(*fields).ljust(self.sector_size, b'\x00')
+
+	def protective_mbr(self):
+		mbr = bytearray(self.sector_size)
+		# Status, CHS start, type 0xEE, CHS end, first LBA and number of sectors (capped at 32 bits)
+		struct.pack_into('<B3sB3sII', mbr, 446, 0x00, b'\x00\x02\x00', 0xEE, b'\xff\xff\xff', 1, min(self.last_lba, 0xFFFFFFFF))
+		mbr[510:512] = b'\x55\xaa'
+		return bytes(mbr)
+
+	def write(self, plan, **kwargs):
+		"""
+		Writes a :py:class:`~archinstall.PartitionPlan` (or an already resolved list of partitions),
+		replacing whatever partition table was there. `kwargs` are passed on to :py:func:`~archinstall.PartitionPlan.resolve`.
+
+		:return: The disk GUID.
+		:rtype: str
+		"""
+		partitions = plan.resolve(self.size, self.sector_size, **kwargs) if hasattr(plan, 'resolve') else plan
+		entries = self.entries(partitions)
+		disk_guid = uuid.uuid4()
+		entries_crc = zlib.crc32(entries)
+
+		fd = os.open(self.path, os.O_RDWR)
+		try:
+			# Backup first, so an interrupted write leaves the primary (and the old table) intact.
+			os.pwrite(fd, entries, (self.last_lba - self.entry_sectors) * self.sector_size)
+			os.pwrite(fd, self.header(disk_guid, entries_crc, backup=True), self.last_lba * self.sector_size)
+			os.pwrite(fd, entries, 2 * self.sector_size)
+			os.pwrite(fd, self.header(disk_guid, entries_crc), self.sector_size)
+			os.pwrite(fd, self.protective_mbr(), 0)
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+
+		written = self.read()
+		if written['disk_guid'] != str(disk_guid) or len(written['partitions']) != len(partitions):
+			raise DiskError(f'The GPT read back from {self.path} does not match what was written.')
+
+		self.reread()
+		return written['disk_guid']
+
+	def _read_header(self, fh, lba):
+		fh.seek(lba * self.sector_size)
+		raw = fh.read(GPT_HEADER.size)
+		if len(raw) != GPT_HEADER.size:
+			raise DiskError(f'Could not read the GPT header at LBA {lba} of {self.path}.')
+		header = list(GPT_HEADER.unpack(raw))
+		if header[0] != GPT_SIGNATURE:
+			raise DiskError(f'No GPT signature at LBA {lba} of {self.path}.')
+
+		crc, header[3] = header[3], 0
+		if zlib.crc32(GPT_HEADER.pack(*header)) != crc:
+			raise DiskError(f'The GPT header at LBA {lba} of {self.path} has a bad CRC32.')
+
+		fh.seek(header[10] * self.sector_size)
+		entries = fh.read(header[11] * header[12])
+		if zlib.crc32(entries) != header[13]:
+			raise DiskError(f'The GPT entries of the header at LBA {lba} of {self.path} have a bad CRC32.')
+		return header, entries
+
+	def read(self):
+		"""
+		Reads and verifies both GPT headers and entry arrays.
+
+		:return: `{'disk_guid', 'partitions' : [{'number', 'start', 'size', 'type', 'uuid', 'name', 'attributes'}]}` with byte positions.
+		:rtype: dict
+
+		:raises DiskError: On missing signatures, bad CRC32's or a backup that differs from the primary.
+		"""
+		with open(self.path, 'rb') as fh:
+			fh.seek(510)
+			if fh.read(2) != b'\x55\xaa':
+				raise DiskError(f'{self.path} has no protective MBR.')
+
+			primary, entries = self._read_header(fh, 1)
+			backup, backup_entries = self._read_header(fh, primary[6])
+
+		if entries != backup_entries or primary[7:10] != backup[7:10]:
+			raise DiskError(f'The primary and backup GPT of {self.path} differ.')
+
+		partitions = []
+		for offset in range(0, len(entries), primary[12]):
+			type_guid, unique_guid, first_lba, last_lba, attributes, name = GPT_ENTRY.unpack_from(entries, offset)
+			if type_guid == b'\x00'*16:
+				continue
+			partitions.append({
+				'number' : offset // primary[12] + 1,
+				'start' : first_lba * self.sector_size,
+				'size' : (last_lba - first_lba + 1) * self.sector_size,
+				'type' : str(uuid.UUID(bytes_le=type_guid)).upper(),
+				'uuid' : str(uuid.UUID(bytes_le=unique_guid)),
+				'name' : name.decode('UTF-16LE').rstrip('\x00'),
+				'attributes' : [attribute for attribute, bit in GPT_ATTRIBUTES.items() if attributes & (1 << bit)]
+			})
+
+		return {'disk_guid' : str(uuid.UUID(bytes_le=primary[9])), 'partitions' : partitions}
+
+	def reread(self):
+		"""
+		Asks the kernel to re-read the partition table, a no-op for image files.
+		"""
+		if not self.block_device:
+			return True
+
+		fd = os.open(self.path, os.O_RDONLY)
+		try:
+			fcntl.ioctl(fd, BLKRRPART)
+			return True
+		except OSError as err:
+			log(f'Could not re-read the partition table of {self.path}: {err}', level=3)
+			return False
+		finally:
+			os.close(fd)
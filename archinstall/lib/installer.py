@@ -1,12 +1,28 @@
-import os, stat
+import os, stat, glob, time
 
 from .exceptions import *
 from .disk import *
+from .superblock import read_superblock
+from .swap import *
+from .luks import LUKS_WORKQUEUE_FLAGS, LUKS_DISCARD_FLAGS
 from .general import *
 from .user_interaction import *
 from .profiles import Profile
 from .mirrors import *
+from .instrumentation import instrumented
 
+# LUKS2 header flags the mkinitcpio encrypt hook understands as cryptdevice= options
+ENCRYPT_HOOK_FLAGS = (*LUKS_WORKQUEUE_FLAGS.values(), *LUKS_DISCARD_FLAGS.values(), 'same-cpu-crypt', 'submit-from-crypt-cpus')
+
+# The default btrfs layout, {subvolume : mountpoint inside the installation}
+BTRFS_SUBVOLUMES = {
+	'@' : '/',
+	'@home' : '/home',
+	'@var_log' : '/var/log',
+	'@pkg' : '/var/cache/pacman/pkg'
+}
+
+@instrumented('installer')
 class Installer():
 	"""
 	`Installer()` is the wrapper for most basic installation steps.
@@ -30,8 +46,18 @@ class Installer():
 	:param hostname: The given /etc/hostname for the machine.
 	:type hostname: str, optional
 
+	:param subvolumes: Lay out a btrfs `partition` as subvolumes, `True` for `BTRFS_SUBVOLUMES`
+	    or a `{subvolume : mountpoint}` dict. They're created and mounted when entering the installer.
+	:type subvolumes: bool, dict, optional
+
+	:param swap: Swap to set up during :py:func:`~archinstall.Installer.minimal_installation`, see :py:func:`~archinstall.Installer.add_swap`.
+	:type swap: bool, str, dict, class:`archinstall.Partition`, optional
+
+	:param package_database_ttl: Seconds the package database of the live medium counts as fresh, it's synced once per installation if not given.
+	:type package_database_ttl: int, optional
+
 	"""
-	def __init__(self, partition, boot_partition, *, base_packages='base base-devel linux linux-firmware efibootmgr nano', profile=None, mountpoint='/mnt', hostname='ArchInstalled'):
+	def __init__(self, partition, boot_partition, *, base_packages='base base-devel linux linux-firmware efibootmgr nano', profile=None, mountpoint='/mnt', hostname='ArchInstalled', subvolumes=None, swap=None, package_database_ttl=None):
 		self.profile = profile
 		self.hostname = hostname
 		self.mountpoint = mountpoint
@@ -46,9 +72,22 @@ class Installer():
 
 		self.partition = partition
 		self.boot_partition = boot_partition
+		self.subvolumes = BTRFS_SUBVOLUMES if subvolumes is True else (subvolumes or {})
+		self.swap = swap
+		self.package_queue = []
+		self.service_queue = []
+		self.package_database_ttl = package_database_ttl
+		self.package_database_synced = None
 
 	def __enter__(self, *args, **kwargs):
-		self.partition.mount(self.mountpoint)
+		if self.subvolumes:
+			self.create_subvolumes()
+			# Parents before children, so / is mounted before /home and /var/log before anything below it
+			for subvolume, target in sorted(self.subvolumes.items(), key=lambda item: item[1].rstrip('/').count('/')):
+				os.makedirs(os.path.normpath(f'{self.mountpoint}/{target}'), exist_ok=True)
+				self.partition.mount(os.path.normpath(f'{self.mountpoint}/{target}'), subvolume=subvolume)
+		else:
+			self.partition.mount(self.mountpoint)
 		os.makedirs(f'{self.mountpoint}/boot', exist_ok=True)
 		self.boot_partition.mount(f'{self.mountpoint}/boot')
 		return self
@@ -59,6 +98,7 @@ class Installer():
 		if len(args) >= 2 and args[1]:
 			raise args[1]
 
+		self.flush_packages()
 		if not (missing_steps := self.post_install_check()):
 			log('Installation completed without any errors. You may now reboot.', bg='black', fg='green')
 			return True
@@ -72,24 +112,96 @@ class Installer():
 		return [step for step, flag in self.helper_flags.items() if flag is False]
 
 	def pacstrap(self, *packages, **kwargs):
-		if type(packages[0]) in (list, tuple): packages = packages[0]
+		"""
+		Installs `packages`, along with everything in :py:func:`~archinstall.Installer.queue_packages`, in one transaction.
+		"""
+		if packages and type(packages[0]) in (list, tuple): packages = packages[0]
+		# Profiles hand over space separated strings as well as lists, and nested profiles tend to repeat packages
+		packages = list(dict.fromkeys(name for entry in [*self.package_queue, *packages] for name in entry.split()))
+		self.package_queue = []
+		if not packages:
+			return True
 		log(f'Installing packages: {packages}')
 
-		if (sync_mirrors := sys_command('/usr/bin/pacman -Syy')).exit_code == 0:
+		if self.sync_package_database():
 			if (pacstrap := sys_command(f'/usr/bin/pacstrap {self.mountpoint} {" ".join(packages)}', **kwargs)).exit_code == 0:
 				return True
 			else:
 				log(f'Could not strap in packages: {pacstrap.exit_code}')
-		else:
+
+	def queue_packages(self, *packages):
+		"""
+		Queues packages to be installed with the next :py:func:`~archinstall.Installer.pacstrap`, instead of in a transaction of their own.
+		The queue is flushed by anything that might need them: `pacstrap` itself, :py:func:`~archinstall.Installer.arch_chroot`,
+		:py:func:`~archinstall.Installer.user_create` and leaving the installer.
+		Services of queued packages can be enabled once they're installed, see :py:func:`~archinstall.Installer.enable_service`.
+		"""
+		if packages and type(packages[0]) in (list, tuple): packages = packages[0]
+		self.package_queue += packages
+		return True
+
+	def flush_packages(self):
+		installed = self.pacstrap() if self.package_queue else True
+		if self.service_queue:
+			services, self.service_queue = self.service_queue, []
+			if not installed:
+				log(f'Not enabling {", ".join(services)}, installing their packages failed.')
+				return installed
+			return self.enable_service(' '.join(services))
+		return installed
+
+	def sync_package_database(self, force=False):
+		"""
+		Syncs the package database of the live medium, which used to happen before every `pacstrap`.
+		Now it's done once per installation or, with `package_database_ttl`, whenever the database is older than that.
+		"""
+		if not force:
+			if self.package_database_ttl is None:
+				if self.package_database_synced:
+					return True
+			else:
+				# A database synced by an earlier run (or reflector) counts as well
+				synced = max([self.package_database_synced or 0, *(os.path.getmtime(db) for db in glob.glob('/var/lib/pacman/sync/*.db'))])
+				if time.time() - synced < self.package_database_ttl:
+					return True
+
+		if (sync_mirrors := sys_command('/usr/bin/pacman -Syy')).exit_code != 0:
 			log(f'Could not sync mirrors: {sync_mirrors.exit_code}')
+			return False
+		self.package_database_synced = time.time()
+		return True
 
 	def set_mirrors(self, mirrors):
 		return use_mirrors(mirrors, destination=f'{self.mountpoint}/etc/pacman.d/mirrorlist')
 
-	def genfstab(self, flags='-Pu'):
-		o = b''.join(sys_command(f'/usr/bin/genfstab -pU {self.mountpoint} >> {self.mountpoint}/etc/fstab'))
-		if not os.path.isfile(f'{self.mountpoint}/etc/fstab'):
-			raise RequirementError(f'Could not generate fstab, strapping in packages most likely failed (disk out of space?)\n{o}')
+	def create_subvolumes(self):
+		"""
+		Creates the btrfs subvolumes in `Installer.subvolumes` on the top level of `partition`.
+		"""
+		if self.partition.filesystem != 'btrfs':
+			raise DiskError(f'Subvolumes can only be created on btrfs, {self.partition} is {self.partition.filesystem}.')
+
+		self.partition.mount(self.mountpoint)
+		try:
+			log(f'Creating btrfs subvolumes {", ".join(self.subvolumes)}')
+			paths = ' '.join(f'{self.mountpoint}/{subvolume}' for subvolume in self.subvolumes)
+			if (handle := sys_command(f'/usr/bin/btrfs subvolume create {paths}')).exit_code != 0:
+				raise DiskError(f'Could not create the subvolumes on {self.partition}: {b"".join(handle)}')
+		finally:
+			self.partition.unmount(self.mountpoint)
+		return True
+
+	def genfstab(self, flags='-pU'):
+		# genfstab picks the options up from the live mounts, so whatever Partition.mount() used ends up in fstab.
+		# The output is appended here, as there's no shell to do the >> redirect. Only stdout though, warnings would break the fstab.
+		fstab = sys_command(f'/usr/bin/genfstab {flags} {self.mountpoint}', merge_stderr=False)
+		if fstab.exit_code != 0 or not os.path.isfile(f'{self.mountpoint}/etc/fstab'):
+			raise RequirementError(f'Could not generate fstab, strapping in packages most likely failed (disk out of space?)\n{fstab.stderr.decode("UTF-8")}{fstab.trace_log.decode("UTF-8")}')
+		if fstab.stderr:
+			log(f'genfstab: {fstab.stderr.decode("UTF-8").strip()}')
+
+		with open(f'{self.mountpoint}/etc/fstab', 'ab') as fh:
+			fh.write(bytes(fstab.trace_log))
 		return True
 
 	def set_hostname(self, hostname=None, *args, **kwargs):
@@ -114,16 +226,26 @@ class Installer():
 		return True
 
 	def activate_ntp(self):
+		"""
+		Queues `ntp` and enabling `ntpd`, both happen along with the next flush of the package queue.
+		"""
 		log(f'Installing and activating NTP.')
-		if self.pacstrap('ntp'):
-			if self.enable_service('ntpd'):
-				return True
-
-	def enable_service(self, service):
+		self.queue_packages('ntp')
+		return self.enable_service('ntpd', defer=True)
+
+	def enable_service(self, service, defer=False):
+		"""
+		:param defer: Enable it once the package queue has been flushed, for services that come from queued packages.
+		:type defer: bool, optional
+		"""
+		if defer:
+			self.service_queue.append(service)
+			return True
 		log(f'Enabling service {service}')
 		return self.arch_chroot(f'systemctl enable {service}').exit_code == 0
 
 	def run_command(self, cmd, *args, **kwargs):
+		self.flush_packages()
 		return sys_command(f'/usr/bin/arch-chroot {self.mountpoint} {cmd}')
 
 	def arch_chroot(self, cmd, *args, **kwargs):
@@ -137,9 +259,19 @@ class Installer():
 		if self.partition.filesystem == 'btrfs':
 		#if self.partition.encrypted:
 			self.base_packages.append('btrfs-progs')
+		if self.partition.volume:
+			self.base_packages += [package for package in self.partition.volume.packages if package not in self.base_packages]
+		# Decided up front, so zram-generator goes in with everything else
+		swap = self._swap_policy(self.swap) if self.swap else None
+		if swap and swap['type'] == 'zram':
+			self.base_packages.append('zram-generator')
 		
 		self.pacstrap(self.base_packages)
 		self.genfstab()
+		if self.partition.volume:
+			self.partition.volume.configure(self)
+		if swap:
+			self.add_swap(swap)
 
 		with open(f'{self.mountpoint}/etc/fstab', 'a') as fstab:
 			fstab.write('\ntmpfs /tmp tmpfs defaults,noatime,mode=1777 0 0\n') # Redundant \n at the start? who knoes?
@@ -154,18 +286,87 @@ class Installer():
 		# TODO: Use python functions for this
 		sys_command(f'/usr/bin/arch-chroot {self.mountpoint} chmod 700 /root')
 
-		if self.partition.filesystem == 'btrfs':
+		if self.partition.filesystem == 'btrfs' or self.partition.volume:
+			# Arrays have to be assembled after block devices show up, but before they get unlocked.
+			volume_hooks = ' '.join(self.partition.volume.hooks) + ' ' if self.partition.volume else ''
 			with open(f'{self.mountpoint}/etc/mkinitcpio.conf', 'w') as mkinit:
 				## TODO: Don't replace it, in case some update in the future actually adds something.
-				mkinit.write('MODULES=(btrfs)\n')
-				mkinit.write('BINARIES=(/usr/bin/btrfs)\n')
+				mkinit.write('MODULES=(btrfs)\n' if self.partition.filesystem == 'btrfs' else 'MODULES=()\n')
+				mkinit.write('BINARIES=(/usr/bin/btrfs)\n' if self.partition.filesystem == 'btrfs' else 'BINARIES=()\n')
 				mkinit.write('FILES=()\n')
-				mkinit.write('HOOKS=(base udev autodetect modconf block encrypt filesystems keyboard fsck)\n')
+				mkinit.write(f'HOOKS=(base udev autodetect modconf block {volume_hooks}encrypt filesystems keyboard fsck)\n')
 			sys_command(f'/usr/bin/arch-chroot {self.mountpoint} mkinitcpio -p linux')
 
 		self.helper_flags['base'] = True
 		return True
 
+	def _swap_policy(self, swap):
+		if isinstance(swap, Partition):
+			return {'type' : 'partition', 'partition' : swap, 'sysctl' : SWAP_SYSCTL['partition']}
+		if type(swap) == dict:
+			return swap
+
+		policy = swap_policy(self.partition.path, type=swap if type(swap) == str else None)
+		if policy['type'] == 'swapfile' and self.partition.volume and self.partition.volume.backend == 'btrfs':
+			# btrfs only supports swapfiles on single device filesystems
+			policy = swap_policy(self.partition.path, type='zram')
+		return policy
+
+	def add_swap(self, swap=True):
+		"""
+		Sets up swap on the installation, along with the `vm.swappiness` and `vm.page-cluster` that suit it:
+
+		* `zram` through `zram-generator`, which creates a compressed swap device in RAM on every boot.
+		* `swapfile`, fully allocated and without copy on write. On btrfs it goes in a `/swap` subvolume of its own,
+		  since a subvolume with an active swapfile can't be snapshotted.
+		* A swap :py:class:`~archinstall.Partition`, which is not encrypted.
+
+		:param swap: `True` to let :py:func:`~archinstall.swap_policy` pick from the RAM and disk type, `zram`, `swapfile`,
+		    the `dict` returned by :py:func:`~archinstall.swap_policy` or a partition.
+		:type swap: bool, str, dict, class:`archinstall.Partition`, optional
+		"""
+		policy = self._swap_policy(swap)
+		log(f'Setting up {policy["type"]} swap')
+
+		if policy['type'] == 'zram':
+			if 'zram-generator' not in self.base_packages:
+				self.queue_packages('zram-generator')
+			with open(f'{self.mountpoint}/etc/systemd/zram-generator.conf', 'w') as zram:
+				zram.write('[zram0]\n')
+				zram.write(f'zram-size = {policy["size"] // 1024**2}\n')
+				zram.write(f'compression-algorithm = {policy["algorithm"]}\n')
+				zram.write('swap-priority = 100\n')
+				zram.write('fs-type = swap\n')
+		else:
+			if policy['type'] == 'swapfile':
+				swapfile = '/swapfile'
+				if self.partition.filesystem == 'btrfs':
+					swapfile = '/swap/swapfile'
+					if (handle := sys_command(f'/usr/bin/btrfs subvolume create {self.mountpoint}/swap')).exit_code != 0:
+						raise DiskError(f'Could not create the swap subvolume on {self.partition}: {b"".join(handle)}')
+				create_swapfile(f'{self.mountpoint}{swapfile}', policy['size'])
+				device = swapfile
+			else:
+				device = f'UUID={write_swap_header(policy["partition"].path, label="swap")}'
+
+			with open(f'{self.mountpoint}/etc/fstab', 'a') as fstab:
+				fstab.write(f'{device} none swap defaults 0 0\n')
+
+		with open(f'{self.mountpoint}/etc/sysctl.d/99-swap.conf', 'w') as sysctl:
+			for key, value in policy['sysctl'].items():
+				sysctl.write(f'{key} = {value}\n')
+		return True
+
+	@property
+	def root_flags(self):
+		"""
+		` rootflags=subvol=<subvolume>` for the kernel command line if / is a btrfs subvolume.
+		"""
+		for subvolume, target in self.subvolumes.items():
+			if target == '/':
+				return f' rootflags=subvol={subvolume}'
+		return ''
+
 	def add_bootloader(self):
 		log(f'Adding bootloader to {self.boot_partition}')
 		o = b''.join(sys_command(f'/usr/bin/arch-chroot {self.mountpoint} bootctl --no-variables --path=/boot install'))
@@ -180,32 +381,39 @@ class Installer():
 			entry.write('title Arch Linux\n')
 			entry.write('linux /vmlinuz-linux\n')
 			entry.write('initrd /initramfs-linux.img\n')
-			## blkid doesn't trigger on loopback devices really well,
-			## so we'll use the old manual method until we get that sorted out.
-			
-
+			## blkid doesn't trigger on loopback devices really well, so the UUIDs are read
+			## straight off the LUKS header and partition table, with the /dev/disk links udev made as a fallback.
 			if self.partition.encrypted:
-				for root, folders, uids in os.walk('/dev/disk/by-uuid'):
-					for uid in uids:
-						real_path = os.path.realpath(os.path.join(root, uid))
-						if not os.path.basename(real_path) == os.path.basename(self.partition.real_device): continue
-
-						entry.write(f'options cryptdevice=UUID={uid}:luksdev root=/dev/mapper/luksdev rw intel_pstate=no_hwp\n')
-						
-						self.helper_flags['bootloader'] = True
-						return True
-					break
+				device = self.partition.real_device
+			elif self.partition.volume:
+				# Arrays aren't partitions, they don't have a PARTUUID
+				entry.write(f'options {self.partition.volume.kernel_parameters}{self.root_flags} rw intel_pstate=no_hwp\n')
+
+				self.helper_flags['bootloader'] = True
+				return True
 			else:
-				for root, folders, uids in os.walk('/dev/disk/by-partuuid'):
-					for uid in uids:
-						real_path = os.path.realpath(os.path.join(root, uid))
-						if not os.path.basename(real_path) == os.path.basename(self.partition.path): continue
-
-						entry.write(f'options root=PARTUUID={uid} rw intel_pstate=no_hwp\n')
-						
-						self.helper_flags['bootloader'] = True
-						return True
-					break
+				device = self.partition.path
+
+			try:
+				identifiers = read_superblock(device)
+			except (OSError, DiskError):
+				identifiers = {}
+			if not identifiers.get('uuid') or not identifiers.get('partuuid'):
+				identifiers = {**device_identifiers().get(os.path.realpath(device), {}), **{key: value for key, value in identifiers.items() if value}}
+
+			if self.partition.encrypted and identifiers.get('uuid'):
+				# The flags persisted in the LUKS2 header by luks2.unlock(), so the encrypt hook opens it the same way
+				flags = [flag for flag in identifiers.get('luks', {}).get('config', {}).get('flags', []) if flag in ENCRYPT_HOOK_FLAGS]
+				crypt_options = f':{",".join(flags)}' if flags else ''
+				entry.write(f'options cryptdevice=UUID={identifiers["uuid"]}:luksdev{crypt_options} root=/dev/mapper/luksdev{self.root_flags} rw intel_pstate=no_hwp\n')
+
+				self.helper_flags['bootloader'] = True
+				return True
+			elif not self.partition.encrypted and identifiers.get('partuuid'):
+				entry.write(f'options root=PARTUUID={identifiers["partuuid"]}{self.root_flags} rw intel_pstate=no_hwp\n')
+
+				self.helper_flags['bootloader'] = True
+				return True
 		raise RequirementError(f'Could not identify the UUID of {self.partition}, there for {self.mountpoint}/boot/loader/entries/arch.conf will be broken until fixed.')
 
 	def add_additional_packages(self, *packages):
@@ -225,6 +433,7 @@ class Installer():
 
 	def user_create(self, user :str, password=None, groups=[], sudo=False):
 		log(f'Creating user {user}')
+		self.flush_packages() # Groups can come from queued packages
 		o = b''.join(sys_command(f'/usr/bin/arch-chroot {self.mountpoint} useradd -m -G wheel {user}'))
 		if password:
 			self.user_set_pw(user, password)
@@ -243,7 +452,7 @@ class Installer():
 			# This means the root account isn't locked/disabled with * in /etc/passwd
 			self.helper_flags['user'] = True
 
-		o = b''.join(sys_command(f"/usr/bin/arch-chroot {self.mountpoint} sh -c \"echo '{user}:{password}' | chpasswd\""))
+		o = b''.join(sys_command(f"/usr/bin/arch-chroot {self.mountpoint} sh -c \"echo '{user}:{password}' | chpasswd\"", sensitive=True))
 		pass
 
 	def set_keyboard_language(self, language):
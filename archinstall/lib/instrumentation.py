@@ -0,0 +1,118 @@
+import os, json, time, threading, functools
+
+class Instrumentation():
+	"""
+	Collects timing and resource usage of every :py:class:`~archinstall.sys_command`
+	and every :py:class:`~archinstall.Installer` method call.
+	Everything collected can be saved as a JSON summary, or as a Chrome `trace_event` file
+	which can be opened in `chrome://tracing` or https://ui.perfetto.dev.
+
+	Every event is a `dict` holding at least `name`, `category`, `started` and `ended`.
+	`sys_command` events also carry `cmd`, `exit_code`, `cpu_time` *(user + system seconds of the child)*,
+	`max_rss` *(peak resident memory of the child in KiB)* and `output_bytes`.
+	"""
+	def __init__(self):
+		self.events = []
+		self.enabled = True
+		self.lock = threading.Lock()
+
+	def __repr__(self, *args, **kwargs):
+		return f'Instrumentation(events={len(self.events)}, enabled={self.enabled})'
+
+	def add(self, name, category, started, ended, **details):
+		if not self.enabled: return
+
+		with self.lock:
+			self.events.append({
+				'name' : name,
+				'category' : category,
+				'started' : started,
+				'ended' : ended,
+				'pid' : os.getpid(),
+				'thread' : threading.get_ident(),
+				**details
+			})
+
+	def clear(self):
+		with self.lock:
+			self.events = []
+
+	def summary(self):
+		"""
+		Sums up the events per category and name, for instance `sys_command` -> `pacstrap`.
+
+		:return: `{category : {name : {'count', 'wall_time', 'cpu_time', 'python_cpu_time', 'max_rss', 'output_bytes'}}}`
+		:rtype: dict
+		"""
+		summary = {}
+		for event in self.events:
+			entry = summary.setdefault(event['category'], {}).setdefault(event['name'], {
+				'count' : 0,
+				'wall_time' : 0.0,
+				'cpu_time' : 0.0,
+				'python_cpu_time' : 0.0,
+				'max_rss' : 0,
+				'output_bytes' : 0
+			})
+			entry['count'] += 1
+			entry['wall_time'] += event['ended'] - event['started']
+			entry['cpu_time'] += event.get('cpu_time') or 0.0
+			entry['python_cpu_time'] += event.get('python_cpu_time') or 0.0
+			entry['max_rss'] = max(entry['max_rss'], event.get('max_rss') or 0)
+			entry['output_bytes'] += event.get('output_bytes') or 0
+		return summary
+
+	def chrome_trace(self):
+		"""
+		Converts the events into the Chrome `trace_event` format, using complete (`X`) events.
+		Nested events (for instance `pacstrap` inside `Installer.minimal_installation`) end up stacked on the same thread.
+		"""
+		events = []
+		for event in self.events:
+			events.append({
+				'name' : event['name'],
+				'cat' : event['category'],
+				'ph' : 'X',
+				'ts' : event['started'] * 1000000,
+				'dur' : (event['ended'] - event['started']) * 1000000,
+				'pid' : event['pid'],
+				'tid' : event['thread'],
+				'args' : {key: value for key, value in event.items() if key not in ('name', 'category', 'started', 'ended', 'pid', 'thread')}
+			})
+		return {'traceEvents' : events, 'displayTimeUnit' : 'ms'}
+
+	def save_summary(self, path):
+		with open(path, 'w') as fh:
+			json.dump({'summary' : self.summary(), 'events' : self.events}, fh, indent=4)
+		return True
+
+	def save_chrome_trace(self, path):
+		with open(path, 'w') as fh:
+			json.dump(self.chrome_trace(), fh)
+		return True
+
+# Shared by sys_command and Installer, see Instrumentation.save_chrome_trace()
+instrumentation = Instrumentation()
+
+def instrumented(category):
+	"""
+	Class decorator which records wall time and Python side CPU time
+	of every public method call in :py:data:`~archinstall.instrumentation`.
+	"""
+	def decorate(cls):
+		for name, attribute in list(vars(cls).items()):
+			if name.startswith('_') or not callable(attribute): continue
+
+			def wrap(function, event_name):
+				@functools.wraps(function)
+				def wrapper(*args, **kwargs):
+					started, cpu_started = time.time(), time.thread_time()
+					try:
+						return function(*args, **kwargs)
+					finally:
+						instrumentation.add(event_name, category, started, time.time(), python_cpu_time=time.thread_time() - cpu_started)
+				return wrapper
+
+			setattr(cls, name, wrap(attribute, f'{cls.__name__}.{name}'))
+		return cls
+	return decorate
@@ -0,0 +1,204 @@
+import os, json, struct, threading
+from .output import log
+
+try:
+	import zstandard
+	ZSTD_AVAILABLE = True
+except ImportError:
+	ZSTD_AVAILABLE = False
+
+JOURNAL_MAGIC = b'AIJ1'
+RECORD_HEADER = struct.Struct('<4sIQ') # magic, metadata length, output length
+JOURNAL_MAX_SIZE = 64 * 1024**2 # Past this the journal is rotated to <path>.1, replacing the previous one
+JOURNAL_INDEX_INTERVAL = 64 # Records between saves of the index, anything after the last save is found by scanning
+
+_zstd_warned = False
+
+class TraceJournal():
+	"""
+	A single append-only file holding one record per executed command,
+	replacing the per command `workers/<worker_id>/trace.log` directories.
+
+	Every record is a small binary header, followed by the JSON metadata
+	(command, timestamps, exit code etc) and then the output.
+	The output is zstd compressed if `compress` is set and the `zstandard` module is available.
+
+	Once the journal grows past `max_size` it's moved to `<path>.1` (which can be opened as a journal of its own)
+	and a new one is started. The index of the records is kept next to it in `<path>.index`,
+	so opening the journal only scans what was written since the index was last saved.
+
+	:param path: Where the journal is stored.
+	:type path: str
+
+	:param compress: Compress the output of each record with zstd.
+	:type compress: bool, optional
+
+	:param max_size: Size in bytes the journal is rotated at, `None` to let it grow.
+	:type max_size: int, optional
+	"""
+	def __init__(self, path, compress=False, compression_level=3, max_size=JOURNAL_MAX_SIZE):
+		self.path = path
+		self.index_path = f'{path}.index'
+		self.compress = compress and ZSTD_AVAILABLE
+		self.compression_requested = compress
+		self.compression_level = compression_level
+		self.max_size = max_size
+		self.index = None
+		self.indexed_size = 0
+		self.unsaved = 0
+		self.lock = threading.Lock()
+
+	def __repr__(self, *args, **kwargs):
+		return f'TraceJournal({self.path}, compress={self.compress})'
+
+	def __iter__(self):
+		for worker_id in self.load_index():
+			yield self.metadata(worker_id)
+
+	def __contains__(self, worker_id):
+		return worker_id in self.load_index()
+
+	def load_index(self):
+		"""
+		Returns the `{worker_id : (offset, metadata length, output length)}` index.
+		It's read from `<path>.index` if that belongs to this journal, and completed
+		by walking the record headers written after it, skipping over the output itself.
+		"""
+		if self.index is not None:
+			return self.index
+
+		self.index, self.indexed_size = {}, 0
+		if not os.path.isfile(self.path):
+			return self.index
+
+		journal = os.stat(self.path)
+		try:
+			with open(self.index_path, 'r') as fh:
+				saved = json.load(fh)
+			# An index of a rotated or truncated journal doesn't apply
+			if saved['inode'] == journal.st_ino and saved['size'] <= journal.st_size:
+				self.index = {worker_id : tuple(entry) for worker_id, entry in saved['index'].items()}
+				self.indexed_size = saved['size']
+		except (OSError, ValueError, KeyError):
+			pass
+
+		with open(self.path, 'rb') as fh:
+			fh.seek(self.indexed_size)
+			while len(header := fh.read(RECORD_HEADER.size)) == RECORD_HEADER.size:
+				magic, metadata_length, output_length = RECORD_HEADER.unpack(header)
+				if magic != JOURNAL_MAGIC:
+					break # Truncated or foreign data, stop at the last good record
+
+				offset = fh.tell() - RECORD_HEADER.size
+				metadata = json.loads(fh.read(metadata_length).decode('UTF-8'))
+				self.index[metadata['worker_id']] = (offset, metadata_length, output_length)
+				fh.seek(output_length, os.SEEK_CUR)
+				self.unsaved += 1
+				self.indexed_size = offset + RECORD_HEADER.size + metadata_length + output_length
+
+		if self.unsaved:
+			self.save_index()
+		return self.index
+
+	def save_index(self):
+		try:
+			with open(f'{self.index_path}.tmp', 'w') as fh:
+				json.dump({'inode' : os.stat(self.path).st_ino, 'size' : self.indexed_size, 'index' : self.index}, fh)
+			os.replace(f'{self.index_path}.tmp', self.index_path)
+			self.unsaved = 0
+		except OSError as err:
+			log(f'Could not save the index of {self}: {err}', level=3)
+
+	def _rotate(self):
+		# Called with self.lock held, moves the journal to <path>.1 (replacing the previous one) and starts an empty one.
+		if self.unsaved:
+			self.save_index()
+		os.replace(self.path, f'{self.path}.1')
+		if os.path.isfile(self.index_path):
+			os.replace(self.index_path, f'{self.path}.1.index')
+		self.index, self.indexed_size, self.unsaved = {}, 0, 0
+
+	def record(self, worker_id, output=(), **metadata):
+		"""
+		Appends a record for `worker_id` to the journal.
+
+		:param output: The output as a iterable of `bytes` chunks, for instance a :py:class:`~archinstall.TraceLog`.
+		:type output: iterable
+
+		:param metadata: Any JSON serializable information about the command, such as `cmd`, `started`, `ended` and `exit_code`.
+		"""
+		global _zstd_warned
+		if self.compression_requested and not self.compress and not _zstd_warned:
+			_zstd_warned = True
+			log(f'The zstandard module is not available, {self} stores the output uncompressed.', level=3)
+
+		metadata = {**metadata, 'worker_id' : worker_id, 'compression' : 'zstd' if self.compress else None}
+		metadata = json.dumps(metadata).encode('UTF-8')
+
+		with self.lock:
+			self.load_index()
+			if self.max_size and self.indexed_size >= self.max_size:
+				self._rotate()
+			os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+			with open(self.path, 'ab') as fh:
+				offset = fh.tell()
+				# The output length isn't known until it's been written (and compressed),
+				# so the header is written with a zero length and patched afterwards.
+				fh.write(RECORD_HEADER.pack(JOURNAL_MAGIC, len(metadata), 0))
+				fh.write(metadata)
+
+				output_length = 0
+				if self.compress:
+					compressor = zstandard.ZstdCompressor(level=self.compression_level).compressobj()
+					for chunk in output:
+						output_length += fh.write(compressor.compress(chunk))
+					output_length += fh.write(compressor.flush())
+				else:
+					for chunk in output:
+						output_length += fh.write(chunk)
+
+			with open(self.path, 'r+b') as fh:
+				fh.seek(offset)
+				fh.write(RECORD_HEADER.pack(JOURNAL_MAGIC, len(metadata), output_length))
+
+			self.index[worker_id] = (offset, len(metadata), output_length)
+			self.indexed_size = offset + RECORD_HEADER.size + len(metadata) + output_length
+			self.unsaved += 1
+			if self.unsaved >= JOURNAL_INDEX_INTERVAL:
+				self.save_index()
+		return True
+
+	def metadata(self, worker_id):
+		"""
+		Returns the metadata stored for `worker_id`, without reading the output.
+		"""
+		if not worker_id in self.load_index():
+			raise KeyError(f'{self} has no record of worker "{worker_id}"')
+
+		offset, metadata_length, output_length = self.index[worker_id]
+		with open(self.path, 'rb') as fh:
+			fh.seek(offset + RECORD_HEADER.size)
+			return json.loads(fh.read(metadata_length).decode('UTF-8'))
+
+	def output(self, worker_id):
+		"""
+		Returns the (decompressed) output stored for `worker_id`.
+		"""
+		metadata = self.metadata(worker_id)
+		offset, metadata_length, output_length = self.index[worker_id]
+		with open(self.path, 'rb') as fh:
+			fh.seek(offset + RECORD_HEADER.size + metadata_length)
+			output = fh.read(output_length)
+
+		if metadata['compression'] == 'zstd':
+			if not ZSTD_AVAILABLE:
+				raise KeyError(f'The output of worker "{worker_id}" is zstd compressed, but the zstandard module is not available.')
+			output = zstandard.ZstdDecompressor().decompressobj().decompress(output)
+		return output
+
+	def find(self, worker_id):
+		"""
+		Returns the full record for `worker_id`, the metadata and its output under `output`.
+		"""
+		return {**self.metadata(worker_id), 'output' : self.output(worker_id)}
@@ -1,27 +1,167 @@
-import os
+import os, re, json
 from .exceptions import *
 from .general import *
-from .disk import Partition
+from .disk import Partition, topology, wait_for_devices, queue_limits
+from .swap import memory_size
+
+# Ciphers worth considering as (cipher, key size in bits), most preferred first.
+# aes-xts with a 512 bit key is AES-256. Adiantum is for CPUs without AES instructions, where it's several times faster than aes-xts.
+LUKS_CIPHERS = [('aes-xts-plain64', 512), ('aes-xts-plain64', 256), ('xchacha12,aes-adiantum-plain64', 256)]
+LUKS_UNLOCK_LATENCY = 2000 # ms of argon2id at every unlock, what cryptsetup aims for by default
+LUKS_PBKDF_MAX_MEMORY = 1024**3 # cryptsetup's default, the initramfs has to be able to spare it
+LUKS_BENCHMARK_CACHE = '/tmp/archinstall-luks-benchmark.json'
+
+# `cryptsetup open` options and the LUKS2 header flags they're persisted as, which the `encrypt` hook also takes in `cryptdevice=`.
+# Skipping the dm-crypt workqueues saves a context switch per I/O, which only pays off on fast, non-rotational drives.
+LUKS_WORKQUEUE_FLAGS = {'--perf-no_read_workqueue' : 'no-read-workqueue', '--perf-no_write_workqueue' : 'no-write-workqueue'}
+LUKS_DISCARD_FLAGS = {'--allow-discards' : 'allow-discards'}
+
+_luks_benchmarks = {}
+
+def luks_benchmark(unlock_latency=LUKS_UNLOCK_LATENCY, memory=None, cache=None):
+	"""
+	Measures the throughput of `LUKS_CIPHERS` and what argon2id can do within `unlock_latency` on this machine, using `cryptsetup benchmark`.
+	The results are kept in `LUKS_BENCHMARK_CACHE`, so the benchmark runs once per boot of the live medium rather than once per install.
+
+	:param unlock_latency: Milliseconds the key derivation should take.
+	:type unlock_latency: int, optional
+
+	:param memory: Most memory argon2id may use in bytes, a quarter of the RAM up to 1GiB if not given.
+	:type memory: int, optional
+
+	:return: `{'ciphers' : {'aes-xts-plain64/512' : {'encryption' : MiB/s, 'decryption' : MiB/s}}, 'argon2id' : {'iterations', 'memory', 'parallel'}}`,
+	    ciphers the kernel doesn't support are left out and `argon2id` memory is in KiB.
+	:rtype: dict
+	"""
+	if memory is None:
+		memory = min(memory_size() // 4, LUKS_PBKDF_MAX_MEMORY)
+	cache = cache or LUKS_BENCHMARK_CACHE
+	pbkdf_key = f'{unlock_latency}ms/{memory // 1024}KiB'
+
+	if not _luks_benchmarks and os.path.isfile(cache):
+		try:
+			with open(cache, 'r') as fh:
+				_luks_benchmarks.update(json.load(fh))
+		except (OSError, ValueError):
+			pass # Rather benchmark again than trust a broken cache
+
+	if 'ciphers' not in _luks_benchmarks:
+		ciphers = {}
+		for cipher, key_size in LUKS_CIPHERS:
+			output = sys_command(f'/usr/bin/cryptsetup benchmark --cipher {cipher} --key-size {key_size}').trace_log.decode('UTF-8')
+			# `  aes-xts   512b   2034.4 MiB/s   2076.2 MiB/s`, or N/A when the kernel lacks the cipher
+			if (match := re.search(r'\s(\d+)b\s+([0-9.]+)\s+MiB/s\s+([0-9.]+)\s+MiB/s', output)):
+				ciphers[f'{cipher}/{key_size}'] = {'encryption' : float(match.group(2)), 'decryption' : float(match.group(3))}
+		_luks_benchmarks['ciphers'] = ciphers
+
+	if pbkdf_key not in _luks_benchmarks.setdefault('argon2id', {}):
+		output = sys_command(f'/usr/bin/cryptsetup benchmark --pbkdf argon2id --iter-time {unlock_latency} --pbkdf-memory {memory // 1024}').trace_log.decode('UTF-8')
+		# `argon2id   4 iterations, 1048576 memory, 4 parallel threads (CPUs) for 256-bit key (requested 2000 ms time)`
+		if not (match := re.search(r'argon2id\s+(\d+) iterations, (\d+) memory, (\d+) parallel', output)):
+			raise DiskError(f'Could not benchmark argon2id: {output}')
+		_luks_benchmarks['argon2id'][pbkdf_key] = {'iterations' : int(match.group(1)), 'memory' : int(match.group(2)), 'parallel' : int(match.group(3))}
+
+	try:
+		with open(cache, 'w') as fh:
+			json.dump(_luks_benchmarks, fh, indent=4)
+	except OSError as err:
+		log(f'Could not cache the LUKS benchmark in {cache}: {err}', level=3)
+
+	return {'ciphers' : _luks_benchmarks['ciphers'], 'argon2id' : _luks_benchmarks['argon2id'][pbkdf_key]}
+
+def luks_parameters(unlock_latency=LUKS_UNLOCK_LATENCY, memory=None):
+	"""
+	Picks the LUKS2 cipher, key size and argon2id cost for this machine from :py:func:`~archinstall.luks_benchmark`:
+	the fastest cipher in `LUKS_CIPHERS` (going by the slower of encryption and decryption), preferring the ones
+	listed first when they're within 10% of it, and argon2id sized to take `unlock_latency` milliseconds.
+
+	:return: `{'cipher', 'key_size', 'pbkdf', 'pbkdf_memory', 'pbkdf_parallel', 'iterations', 'throughput'}`, `pbkdf_memory` in KiB and `throughput` in MiB/s.
+	:rtype: dict
+	"""
+	benchmark = luks_benchmark(unlock_latency, memory)
+	if not (throughput := {name : min(result.values()) for name, result in benchmark['ciphers'].items()}):
+		raise DiskError(f'None of the LUKS ciphers ({", ".join(cipher for cipher, key_size in LUKS_CIPHERS)}) are supported by the kernel.')
+
+	fastest = max(throughput.values())
+	cipher, key_size = next((cipher, key_size) for cipher, key_size in LUKS_CIPHERS if throughput.get(f'{cipher}/{key_size}', 0) >= fastest * 0.9)
+	parameters = {
+		'cipher' : cipher,
+		'key_size' : key_size,
+		'pbkdf' : 'argon2id',
+		'pbkdf_memory' : benchmark['argon2id']['memory'],
+		'pbkdf_parallel' : benchmark['argon2id']['parallel'],
+		'iterations' : benchmark['argon2id']['iterations'],
+		'throughput' : throughput[f'{cipher}/{key_size}']
+	}
+
+	log(f'LUKS2 parameters: {cipher} with a {key_size} bit key at {parameters["throughput"]} MiB/s, '
+		f'argon2id with {parameters["iterations"]} iterations, {parameters["pbkdf_memory"]} KiB and {parameters["pbkdf_parallel"]} threads for a {unlock_latency}ms unlock')
+	log(f'Measured cipher throughput (MiB/s): {", ".join(f"{name} {value}" for name, value in throughput.items())}', level=4)
+	return parameters
+
+def luks_sector_size(path):
+	"""
+	The dm-crypt sector size for a device: its physical block size, within the 512 to 4096 bytes LUKS2 allows.
+	Encrypting 4K at a time instead of 512 bytes means an eighth of the cipher operations on 4K drives.
+	"""
+	return min(max(queue_limits(path)['physical_block_size'], 512), 4096)
 
 class luks2():
+	"""
+	Encrypts and unlocks a partition::
+
+		with archinstall.luks2(harddrive.partition[1], 'luksloop', password) as unlocked_device:
+			unlocked_device.format('btrfs')
+
+	Any other keyword arguments are passed on to :py:func:`~archinstall.luks2.encrypt`.
+
+	:param no_workqueue: Bypass the dm-crypt read and write workqueues, on by default for non-rotational drives.
+	:type no_workqueue: bool, optional
+
+	:param allow_discards: Pass discards through to the drive. This reveals which blocks are in use, so it's off by default.
+	:type allow_discards: bool, optional
+	"""
 	def __init__(self, partition, mountpoint, password, *args, **kwargs):
 		self.password = password
 		self.partition = partition
 		self.mountpoint = mountpoint
+		self.no_workqueue = kwargs.pop('no_workqueue', None)
+		self.allow_discards = kwargs.pop('allow_discards', False)
 		self.args = args
 		self.kwargs = kwargs
+		self.unlocked = None
 
 	def __enter__(self):
 		key_file = self.encrypt(self.partition, self.password, *self.args, **self.kwargs)
-		return self.unlock(self.partition, self.mountpoint, key_file)
+		self.unlocked = self.unlock(self.partition, self.mountpoint, key_file)
+		return self.unlocked
 
 	def __exit__(self, *args, **kwargs):
 		# TODO: https://stackoverflow.com/questions/28157929/how-to-safely-handle-an-exception-inside-a-context-manager
 		if len(args) >= 2 and args[1]:
+			# Don't leave the mapping behind for the next attempt to trip over, unless something still has it mounted.
+			if self.unlocked:
+				try:
+					self.close(self.mountpoint)
+				except SysCallError as err:
+					log(f'Could not close /dev/mapper/{self.mountpoint}: {err}', level=3)
 			raise args[1]
 		return True
 
-	def encrypt(self, partition, password, key_size=512, hash_type='sha512', iter_time=10000, key_file=None):
+	def encrypt(self, partition, password, key_size=512, hash_type='sha512', iter_time=10000, key_file=None, tune=False, unlock_latency=LUKS_UNLOCK_LATENCY, sector_size=None):
+		"""
+		Formats `partition` as LUKS2.
+
+		:param sector_size: The dm-crypt sector size in bytes, :py:func:`~archinstall.luks_sector_size` if not given.
+		:type sector_size: int, optional
+
+		:param tune: Pick the cipher, key size and argon2id cost from a benchmark of this machine (see :py:func:`~archinstall.luks_parameters`)
+		    instead of `key_size` and `iter_time`. This also saves `cryptsetup` from benchmarking argon2id again while formatting.
+		:type tune: bool, optional
+
+		:param unlock_latency: How long unlocking should take in milliseconds, when tuning.
+		:type unlock_latency: int, optional
+		"""
 		log(f'Encrypting {partition}')
 		if not key_file: key_file = f'/tmp/{os.path.basename(self.partition.path)}.disk_pw' #TODO: Make disk-pw-file randomly unique?
 		if type(password) != bytes: password = bytes(password, 'UTF-8')
@@ -29,25 +169,58 @@ class luks2():
 		with open(key_file, 'wb') as fh:
 			fh.write(password)
 
-		o = b''.join(sys_command(f'/usr/bin/cryptsetup -q -v --type luks2 --pbkdf argon2i --hash {hash_type} --key-size {key_size} --iter-time {iter_time} --key-file {os.path.abspath(key_file)} --use-urandom luksFormat {partition.path}'))
+		if tune:
+			parameters = luks_parameters(unlock_latency)
+			options = f'--cipher {parameters["cipher"]} --key-size {parameters["key_size"]} --pbkdf argon2id --pbkdf-memory {parameters["pbkdf_memory"]} --pbkdf-parallel {parameters["pbkdf_parallel"]} --pbkdf-force-iterations {parameters["iterations"]}'
+		else:
+			options = f'--pbkdf argon2i --key-size {key_size} --iter-time {iter_time}'
+		options += f' --sector-size {sector_size or luks_sector_size(partition.path)}'
+
+		topology.invalidate()
+		o = b''.join(sys_command(f'/usr/bin/cryptsetup -q -v --type luks2 {options} --hash {hash_type} --key-file {os.path.abspath(key_file)} --use-urandom luksFormat {partition.path}'))
 		if not b'Command successful.' in o:
 			raise DiskError(f'Could not encrypt volume "{partition.path}": {o}')
 	
 		return key_file
 
-	def unlock(self, partition, mountpoint, key_file):
+	def unlock(self, partition, mountpoint, key_file, no_workqueue=None, allow_discards=None):
 		"""
 		Mounts a lukts2 compatible partition to a certain mountpoint.
 		Keyfile must be specified as there's no way to interact with the pw-prompt atm.
+		The performance and discard options are persisted in the LUKS2 header, so the installed system opens it the same way.
 
 		:param mountpoint: The name without absolute path, for instance "luksdev" will point to /dev/mapper/luksdev
 		:type mountpoint: str
+
+		:param no_workqueue: See :py:class:`~archinstall.luks2`, defaults to what it was given.
+		:type no_workqueue: bool, optional
+
+		:param allow_discards: See :py:class:`~archinstall.luks2`, defaults to what it was given.
+		:type allow_discards: bool, optional
 		"""
 		if '/' in mountpoint: os.path.basename(mountpoint) # TODO: Raise exception instead?
-		sys_command(f'/usr/bin/cryptsetup open {partition.path} {mountpoint} --key-file {os.path.abspath(key_file)} --type luks2')
-		if os.path.islink(f'/dev/mapper/{mountpoint}'):
-			return Partition(f'/dev/mapper/{mountpoint}', encrypted=True)
+		if no_workqueue is None:
+			no_workqueue = self.no_workqueue
+		if no_workqueue is None:
+			no_workqueue = not queue_limits(partition.path)['rotational']
+		if allow_discards is None:
+			allow_discards = self.allow_discards
+
+		flags = list(LUKS_WORKQUEUE_FLAGS) if no_workqueue else []
+		if allow_discards:
+			flags += list(LUKS_DISCARD_FLAGS)
+		if flags:
+			flags.insert(0, '--persistent')
+
+		topology.invalidate()
+		sys_command(f'/usr/bin/cryptsetup open {partition.path} {mountpoint} --key-file {os.path.abspath(key_file)} --type luks2 {" ".join(flags)}')
+		if wait_for_devices([f'/dev/mapper/{mountpoint}']):
+			unlocked = Partition(f'/dev/mapper/{mountpoint}', encrypted=True)
+			unlocked.trimmed = partition.trimmed # Nothing below the mapping is in use either
+			unlocked.volume = partition.volume
+			return unlocked
 
 	def close(self, mountpoint):
+		topology.invalidate()
 		sys_command(f'cryptsetup close /dev/mapper/{mountpoint}')
 		return os.path.islink(f'/dev/mapper/{mountpoint}') is False
\ No newline at end of file
@@ -1,4 +1,4 @@
-import sys
+import sys, os
 from .tts import TTS
 
 # Found first reference here: https://stackoverflow.com/questions/7445658/how-to-detect-if-the-console-does-support-ansi-escape-codes-in-python
@@ -0,0 +1,212 @@
+import time, threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .exceptions import *
+from .output import log
+
+class Step():
+	def __init__(self, name, function, args=(), kwargs={}, depends=(), locks=()):
+		self.name = name
+		self.function = function
+		self.args = args
+		self.kwargs = kwargs
+		self.depends = tuple(depends)
+		self.locks = tuple(sorted(locks))
+		self.status = 'pending'
+		self.result = None
+		self.exception = None
+		self.started = None
+		self.ended = None
+
+	def __repr__(self, *args, **kwargs):
+		return f'Step({self.name}, status={self.status}, depends={self.depends})'
+
+	def dump(self):
+		return {
+			'name' : self.name,
+			'status' : self.status,
+			'depends' : self.depends,
+			'locks' : self.locks,
+			'started' : self.started,
+			'ended' : self.ended,
+			'exception' : str(self.exception) if self.exception else None
+		}
+
+class StepGraph():
+	"""
+	A set of installation steps with explicit dependencies between them.
+	Steps whose dependencies are met run at the same time on a bounded pool of threads,
+	and when a step fails every step depending on it (directly or not) is cancelled.
+	Steps that don't depend on the failed step still run to completion.
+
+	Example, formatting the boot partition while the root partition is being encrypted::
+
+		steps = archinstall.StepGraph()
+		steps.add('format_boot', harddrive.partition[0].format, 'fat32')
+		steps.add_context('encrypt_root', archinstall.luks2(harddrive.partition[1], 'luksloop', disk_password))
+		steps.add('format_root', lambda: steps['encrypt_root'].format('btrfs'), depends=['encrypt_root'])
+		steps.run()
+
+	Steps that share a lock never run at the same time. Anything using `pacstrap` or `arch-chroot`
+	should share one (for instance `locks=['chroot']`) as they both mount the API filesystems inside the target.
+
+	:param workers: The maximum number of steps running at once.
+	:type workers: int
+	"""
+	def __init__(self, workers=4):
+		self.workers = workers
+		self.steps = {}
+		self.locks = {}
+		self.contexts = {}
+		self.entered = []
+
+	def __repr__(self, *args, **kwargs):
+		return f'StepGraph({list(self.steps.values())})'
+
+	def __getitem__(self, name):
+		"""
+		Returns the result of a finished step.
+		"""
+		if not name in self.steps:
+			raise StepError(f'No step named "{name}" has been added to {self}')
+		if self.steps[name].status != 'done':
+			raise StepError(f'Step "{name}" has not finished successfully (status: {self.steps[name].status})')
+		return self.steps[name].result
+
+	def add(self, name, function, *args, depends=(), locks=(), **kwargs):
+		"""
+		Adds `function(*args, **kwargs)` as a step called `name`.
+
+		:param depends: Names of steps that must finish successfully before this one starts.
+		:type depends: list, optional
+
+		:param locks: Names of locks held while the step runs.
+		:type locks: list, optional
+		"""
+		if name in self.steps:
+			raise StepError(f'A step named "{name}" already exists in {self}')
+
+		self.steps[name] = Step(name, function, args, kwargs, depends=depends, locks=locks)
+		for lock in locks:
+			if not lock in self.locks:
+				self.locks[lock] = threading.Lock()
+		return self.steps[name]
+
+	def add_context(self, name, context, depends=(), locks=()):
+		"""
+		Adds a step entering a context manager, such as :py:class:`~archinstall.luks2` or :py:class:`~archinstall.Installer`.
+		The step's result is what `__enter__` returns. Once every step has finished, the entered
+		context managers are left in the reverse order they were entered, with the exception that failed the run if any.
+
+		:param context: A context manager, or a function returning one when the step starts
+		    (so it can be given results of the steps it depends on).
+		:type context: object
+
+		:param depends: Names of steps that must finish successfully before this one starts.
+		:type depends: list, optional
+
+		:param locks: Names of locks held while entering.
+		:type locks: list, optional
+		"""
+		def enter():
+			self.contexts[name] = context() if callable(context) and not hasattr(context, '__enter__') else context
+			result = self.contexts[name].__enter__()
+			self.entered.append(name)
+			return result
+
+		return self.add(name, enter, depends=depends, locks=locks)
+
+	def _exit_contexts(self, exception):
+		error = None
+		while self.entered:
+			name = self.entered.pop()
+			try:
+				if exception:
+					self.contexts[name].__exit__(type(exception), exception, exception.__traceback__)
+				else:
+					self.contexts[name].__exit__(None, None, None)
+			except BaseException as exit_exception:
+				if exit_exception is not exception: # Re-raising what they were given is how most of them say they saw it
+					log(f'Leaving step "{name}" failed: {exit_exception}', bg='black', fg='red')
+					error = error or exit_exception
+		return error
+
+	def validate(self):
+		for step in self.steps.values():
+			for dependency in step.depends:
+				if not dependency in self.steps:
+					raise StepError(f'{step} depends on an unknown step "{dependency}"')
+
+		# Depth first walk, a step we run into while it's still being visited means a cycle.
+		visited = {}
+		def visit(name, trail):
+			if visited.get(name) == 'visiting':
+				raise StepError(f'Circular dependency between steps: {" -> ".join(trail + [name])}')
+			if visited.get(name) == 'visited':
+				return
+			visited[name] = 'visiting'
+			for dependency in self.steps[name].depends:
+				visit(dependency, trail + [name])
+			visited[name] = 'visited'
+
+		for name in self.steps:
+			visit(name, [])
+		return True
+
+	def _run_step(self, step):
+		for lock in step.locks:
+			self.locks[lock].acquire()
+		try:
+			step.started = time.time()
+			step.result = step.function(*step.args, **step.kwargs)
+			step.status = 'done'
+		except BaseException as exception: # SysCallError and friends are BaseException's
+			step.exception = exception
+			step.status = 'failed'
+			log(f'Step "{step.name}" failed: {exception}', bg='black', fg='red')
+		finally:
+			step.ended = time.time()
+			for lock in reversed(step.locks):
+				self.locks[lock].release()
+		return step
+
+	def run(self):
+		"""
+		Runs all the steps and waits for them to finish.
+
+		:return: A `dict` of `{name : result}` for every step.
+		:rtype: dict
+
+		:raises StepError: If any step failed, after every step not depending on it has finished.
+		"""
+		self.validate()
+
+		pending = {name: step for name, step in self.steps.items() if step.status == 'pending'}
+		running = {}
+		with ThreadPoolExecutor(max_workers=self.workers) as pool:
+			while pending or running:
+				for name, step in list(pending.items()):
+					dependencies = [self.steps[dependency] for dependency in step.depends]
+					if any(dependency.status in ('failed', 'cancelled') for dependency in dependencies):
+						step.status = 'cancelled'
+						log(f'Step "{name}" was cancelled since a step it depends on did not finish.', bg='black', fg='red')
+						del(pending[name])
+					elif all(dependency.status == 'done' for dependency in dependencies):
+						step.status = 'running'
+						running[pool.submit(self._run_step, step)] = step
+						del(pending[name])
+
+				if running:
+					finished, _ = wait(running, return_when=FIRST_COMPLETED)
+					for future in finished:
+						del(running[future])
+
+		if (failed := [step for step in self.steps.values() if step.status == 'failed']):
+			error = StepError(f'{len(failed)} step(s) failed: {", ".join(step.name for step in failed)}')
+			error.__cause__ = failed[0].exception
+			self._exit_contexts(error)
+			raise error
+
+		if (error := self._exit_contexts(None)):
+			raise StepError(f'Could not leave every step\'s context: {error}') from error
+
+		return {name: step.result for name, step in self.steps.items()}
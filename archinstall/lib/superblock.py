@@ -0,0 +1,114 @@
+import os, json, uuid, struct
+from .exceptions import *
+from .gpt import GPTWriter
+
+LUKS_MAGIC = b'LUKS\xba\xbe'
+LUKS2_JSON_OFFSET = 4096 # The JSON area follows the 4KiB binary header
+EXT_MAGIC = 0xEF53
+BTRFS_MAGIC = b'_BHRfS_M'
+SWAP_MAGICS = (b'SWAPSPACE2', b'SWAP-SPACE')
+SWAP_PAGE_SIZES = (4096, 8192, 16384, 32768, 65536) # The magic ends the first page, whichever page size mkswap ran with
+
+# ext4 feature bits telling ext2, ext3 and ext4 apart, same as blkid does
+EXT3_FEATURE_COMPAT_HAS_JOURNAL = 0x0004
+EXT4_FEATURE_INCOMPAT = 0x0040 | 0x0080 | 0x0200 # extents, 64bit, flex_bg
+
+def _string(raw):
+	return raw.split(b'\x00', 1)[0].decode('UTF-8', errors='replace').strip() or None
+
+def _luks(fd):
+	header = os.pread(fd, 512, 0)
+	version, = struct.unpack_from('>H', header, 6)
+	info = {'type' : 'crypto_LUKS', 'version' : version, 'uuid' : _string(header[168:208]), 'label' : None}
+
+	if version == 2:
+		header_size, = struct.unpack_from('>Q', header, 8)
+		info['label'] = _string(header[24:72])
+		# The JSON metadata holds the keyslots, segments (cipher, sector size) and flags (allow-discards etc)
+		area = os.pread(fd, header_size - LUKS2_JSON_OFFSET, LUKS2_JSON_OFFSET)
+		info['luks'] = json.loads(area.split(b'\x00', 1)[0].decode('UTF-8'))
+	return info
+
+def _ext(superblock):
+	compat, incompat = struct.unpack_from('<I', superblock, 0x5C)[0], struct.unpack_from('<I', superblock, 0x60)[0]
+	if incompat & EXT4_FEATURE_INCOMPAT:
+		filesystem = 'ext4'
+	elif compat & EXT3_FEATURE_COMPAT_HAS_JOURNAL:
+		filesystem = 'ext3'
+	else:
+		filesystem = 'ext2'
+	return {'type' : filesystem, 'uuid' : str(uuid.UUID(bytes=superblock[0x68:0x78])), 'label' : _string(superblock[0x78:0x88])}
+
+def _btrfs(superblock):
+	return {'type' : 'btrfs', 'uuid' : str(uuid.UUID(bytes=superblock[0x20:0x30])), 'label' : _string(superblock[0x12B:0x22B])}
+
+def _fat(boot_sector):
+	# FAT32 keeps the serial and label further in, after its larger BIOS parameter block
+	serial_offset, label_offset = (0x43, 0x47) if boot_sector[0x52:0x57] == b'FAT32' else (0x27, 0x2B)
+	serial, = struct.unpack_from('<I', boot_sector, serial_offset)
+	label = _string(boot_sector[label_offset:label_offset+11])
+	return {'type' : 'vfat', 'uuid' : f'{serial >> 16:04X}-{serial & 0xFFFF:04X}', 'label' : None if label == 'NO NAME' else label}
+
+def read_superblock(path):
+	"""
+	Identifies what's on a block device or image file by reading its superblock directly:
+	LUKS (including the LUKS2 JSON metadata), ext2/3/4, btrfs, FAT and swap.
+	No `blkid`, subprocess or udev involved, so it also works on loop devices and right after formatting.
+
+	:return: `{'type', 'uuid', 'label', 'partuuid'}`, plus `luks` with the JSON metadata for LUKS2.
+	    `type` uses the `blkid` names (`crypto_LUKS`, `ext4`, `btrfs`, `vfat`, `swap`), and is `None` if nothing was recognised.
+	:rtype: dict
+	"""
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		head = os.pread(fd, 0x10000 + 0x1000, 0)
+		if len(head) < 512:
+			raise DiskError(f'{path} is too small to hold a filesystem.')
+
+		if head[:6] == LUKS_MAGIC:
+			info = _luks(fd)
+		elif len(head) >= 0x10000 + 0x48 and head[0x10040:0x10048] == BTRFS_MAGIC:
+			info = _btrfs(head[0x10000:])
+		elif len(head) >= 2048 and struct.unpack_from('<H', head, 1024 + 0x38)[0] == EXT_MAGIC:
+			info = _ext(head[1024:2048])
+		elif head[510:512] == b'\x55\xaa' and (head[0x52:0x57] == b'FAT32' or head[0x36:0x39] == b'FAT'):
+			info = _fat(head[:512])
+		elif any(head[page_size-10:page_size] in SWAP_MAGICS for page_size in SWAP_PAGE_SIZES if page_size <= len(head)):
+			info = {'type' : 'swap', 'uuid' : str(uuid.UUID(bytes=head[0x40C:0x41C])), 'label' : _string(head[0x41C:0x42C])}
+		else:
+			info = {'type' : None, 'uuid' : None, 'label' : None}
+	finally:
+		os.close(fd)
+
+	info['partuuid'] = partition_uuid(path)
+	return info
+
+def partition_uuid(path, sysfs='/sys'):
+	"""
+	Returns the PARTUUID of a partition, read from the GPT (or the MBR disk signature) of the disk it's on.
+	`None` for anything that isn't a partition, such as a whole disk or an image file.
+	"""
+	device = os.path.realpath(f'{sysfs}/class/block/{os.path.basename(os.path.realpath(path))}')
+	try:
+		with open(f'{device}/partition') as fh:
+			number = int(fh.read().strip())
+	except (OSError, ValueError):
+		return None
+
+	disk = f'/dev/{os.path.basename(os.path.dirname(device))}'
+	try:
+		for partition in GPTWriter(disk).read()['partitions']:
+			if partition['number'] == number:
+				return partition['uuid']
+		return None
+	except DiskError:
+		pass # Not a GPT disk, or a GPT we couldn't read
+
+	with open(disk, 'rb') as fh:
+		mbr = fh.read(512)
+	if mbr[510:512] != b'\x55\xaa':
+		return None
+	if any(mbr[446 + entry * 16 + 4] == 0xEE for entry in range(4)):
+		return None # A protective MBR, the disk is GPT and its disk signature means nothing
+	signature, = struct.unpack_from('<I', mbr, 440)
+	return f'{signature:08x}-{number:02x}'
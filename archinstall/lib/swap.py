@@ -0,0 +1,140 @@
+import os, uuid, fcntl, struct
+from .exceptions import *
+from .general import *
+from .disk import queue_limits
+
+SWAP_TYPES = ('zram', 'swapfile', 'partition')
+
+# Up to this much RAM, compressed swap in RAM (zram) gives more headroom than it costs.
+# Past it (build hosts and the like) the peaks need room beyond RAM, which means a swapfile.
+ZRAM_MEMORY_LIMIT = 16 * 1024**3
+ZRAM_MAX_SIZE = 16 * 1024**3
+SWAPFILE_MIN_SIZE = 4 * 1024**3
+SWAPFILE_MAX_SIZE = 32 * 1024**3
+
+# vm.* tuning for each kind of swap. zram is far cheaper to swap to than any disk, so the kernel should prefer it
+# over dropping page cache (swappiness above 100), and read ahead is pointless for it (page-cluster 0).
+SWAP_SYSCTL = {
+	'zram' : {'vm.swappiness' : 180, 'vm.page-cluster' : 0, 'vm.watermark_boost_factor' : 0, 'vm.watermark_scale_factor' : 125},
+	'swapfile' : {'vm.swappiness' : 10, 'vm.page-cluster' : 0},
+	'partition' : {'vm.swappiness' : 10, 'vm.page-cluster' : 0}
+}
+
+SWAP_HEADER = struct.Struct('<III16s16s') # version, last page, number of bad pages, uuid, label
+SWAP_MAGIC = b'SWAPSPACE2'
+
+# Signatures blkid finds past the first page (which the swap header replaces, along with ext4, xfs, vfat, LVM and LUKS ones).
+# mkswap wipes them, or blkid reports the swap space as two things at once.
+SWAP_WIPE_OFFSETS = (
+	0x1000, # bcache
+	0x4000, 0x8000, 0x10000, 0x20000, 0x40000, 0x80000, 0x100000, 0x200000, 0x400000, # LUKS2 secondary header
+	# 0x8000 is also where iso9660, udf and jfs are, 0x10000 btrfs and reiserfs
+)
+SWAP_WIPE_SIZE = 8192
+SWAP_WIPE_TAIL = 512 * 1024 # md 0.90 and 1.0 superblocks, the backup GPT and the last two ZFS labels
+
+FS_IOC_GETFLAGS = 0x80086601
+FS_IOC_SETFLAGS = 0x40086602
+FS_NOCOW_FL = 0x00800000 # chattr +C
+
+def memory_size(meminfo='/proc/meminfo'):
+	"""
+	Returns the total amount of RAM in bytes.
+	"""
+	with open(meminfo, 'r') as fh:
+		for line in fh:
+			if line.startswith('MemTotal:'):
+				return int(line.split()[1]) * 1024
+	raise RequirementError(f'Could not find MemTotal in {meminfo}.')
+
+def swap_policy(path=None, memory=None, type=None):
+	"""
+	Decides what kind of swap, and how much of it, suits the machine::
+
+		{'type' : 'zram', 'size' : 4294967296, 'algorithm' : 'zstd', 'sysctl' : {'vm.swappiness' : 180, ...}}
+
+	* Up to 16GiB of RAM, or when `path` is on a rotational disk: zram sized to all of the RAM (up to 4GiB) or half of it,
+	  compressed with `zstd`, or `lz4` on large machines where the CPU time spent compressing matters more.
+	* Otherwise a swapfile of a quarter of the RAM, between 4GiB and 32GiB.
+
+	Swap partitions have to be planned along with the rest of the disk, see :py:func:`~archinstall.Filesystem.use_entire_disk`.
+
+	:param path: The device the installation goes on, to tell SSD's from spinning disks.
+	:type path: str, optional
+
+	:param memory: The amount of RAM in bytes, read from `/proc/meminfo` if not given.
+	:type memory: int, optional
+
+	:param type: Size and tune for `zram` or `swapfile`, instead of picking one.
+	:type type: str, optional
+	"""
+	if type not in (None, 'zram', 'swapfile'):
+		raise RequirementError(f'Unknown swap type "{type}", swap_policy() can pick between zram and swapfile.')
+	if memory is None:
+		memory = memory_size()
+	rotational = bool(queue_limits(path)['rotational']) if path else False
+
+	if type is None:
+		type = 'zram' if memory <= ZRAM_MEMORY_LIMIT or rotational else 'swapfile'
+
+	if type == 'zram':
+		size = memory if memory <= 4 * 1024**3 else min(memory // 2, ZRAM_MAX_SIZE)
+		algorithm = 'zstd' if memory <= ZRAM_MEMORY_LIMIT else 'lz4'
+		return {'type' : type, 'size' : size - size % 1024**2, 'algorithm' : algorithm, 'sysctl' : SWAP_SYSCTL[type]}
+
+	size = min(max(memory // 4, SWAPFILE_MIN_SIZE), SWAPFILE_MAX_SIZE)
+	return {'type' : type, 'size' : size - size % 1024**2, 'sysctl' : SWAP_SYSCTL[type]}
+
+def write_swap_header(path, size=None, label=None):
+	"""
+	Turns a file or partition into swap space, like `mkswap` does: a version 1 swap header in the first page,
+	with the signatures of whatever was there before (see `SWAP_WIPE_OFFSETS`) zeroed.
+	The page is the running kernel's page size, also like `mkswap`, so the swap space is only usable
+	by kernels with the same page size (4KiB on x86_64, the only size Arch Linux ships).
+
+	:return: The UUID of the swap space.
+	:rtype: str
+	"""
+	page_size = os.sysconf('SC_PAGE_SIZE')
+	swap_uuid = uuid.uuid4()
+
+	fd = os.open(path, os.O_RDWR)
+	try:
+		if size is None:
+			size = os.lseek(fd, 0, os.SEEK_END)
+		if size < page_size * 10:
+			raise DiskError(f'{path} is too small for swap ({size} bytes).')
+
+		zeroes = bytes(max(SWAP_WIPE_SIZE, SWAP_WIPE_TAIL))
+		for offset in SWAP_WIPE_OFFSETS:
+			if page_size <= offset < size:
+				os.pwrite(fd, zeroes[:min(SWAP_WIPE_SIZE, size - offset)], offset)
+		tail = max(size - SWAP_WIPE_TAIL, page_size)
+		os.pwrite(fd, zeroes[:size - tail], tail)
+
+		page = bytearray(page_size)
+		SWAP_HEADER.pack_into(page, 1024, 1, size // page_size - 1, 0, swap_uuid.bytes, (label or '').encode('UTF-8')[:16])
+		page[-len(SWAP_MAGIC):] = SWAP_MAGIC
+		os.pwrite(fd, bytes(page), 0)
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+	return str(swap_uuid)
+
+def create_swapfile(path, size):
+	"""
+	Creates a fully allocated swapfile, with copy on write turned off first so it also works on btrfs
+	(the flag only sticks to empty files). The swapfile must not be in a subvolume that gets snapshotted.
+	"""
+	log(f'Creating a {size // 1024**2}MiB swapfile at {path}')
+	fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+	try:
+		try:
+			flags = struct.unpack('i', fcntl.ioctl(fd, FS_IOC_GETFLAGS, struct.pack('i', 0)))[0]
+			fcntl.ioctl(fd, FS_IOC_SETFLAGS, struct.pack('i', flags | FS_NOCOW_FL))
+		except OSError:
+			pass # Filesystems without copy on write (ext4) don't support the flag, and don't need it
+		os.posix_fallocate(fd, 0, size)
+	finally:
+		os.close(fd)
+	return write_swap_header(path, size)
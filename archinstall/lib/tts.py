@@ -2,6 +2,7 @@ class TTS():
 	def __init__(self):
 		try:
 			import pyttsx3
+			self._pyttsx3 = pyttsx3
 			self._available = True
 		except:
 			self._available = False
@@ -26,11 +27,13 @@ class TTS():
 	def speak(self, phrase):
 		if self.available:
 			self.engine.say("I will speak this text")
-			engine.runAndWait()
+			self.engine.runAndWait()
 
 	def __enter__(self):
-		self.engine = pyttsx3.init()
+		if self.available:
+			self.engine = self._pyttsx3.init()
 		return self
 
 	def __exit__(self, *args, **kwargs):
-		self.engine.stop()
\ No newline at end of file
+		if self.available:
+			self.engine.stop()
\ No newline at end of file
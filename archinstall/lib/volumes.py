@@ -0,0 +1,172 @@
+from .exceptions import *
+from .general import *
+from .disk import Partition, PartitionPlan, Filesystem, GPT, parse_size, wait_for_devices, topology
+from .superblock import read_superblock
+
+# Partition type of the members for every backend, see GPT_PARTITION_TYPES
+MEMBER_TYPES = {'mdadm' : 'raid', 'lvm' : 'lvm', 'btrfs' : 'linux'}
+
+# Supported levels and the least number of disks each one needs
+LEVELS = {
+	'mdadm' : {'raid0' : 2, 'raid1' : 2, 'raid10' : 2},
+	'lvm' : {'raid0' : 2, 'raid1' : 2},
+	'btrfs' : {'raid0' : 2, 'raid1' : 2, 'raid10' : 4}
+}
+
+class DiskArray():
+	"""
+	Combines several disks into one volume, and returns it as a :py:class:`~archinstall.Partition`
+	that can be encrypted with :py:class:`~archinstall.luks2`, formatted and handed to the :py:class:`~archinstall.Installer`::
+
+		array = archinstall.DiskArray([nvme0, nvme1], 'raid0', backend='mdadm')
+		with array as root:
+			array.boot_partition.format('fat32')
+			root.format('ext4')
+			with archinstall.Installer(root, boot_partition=array.boot_partition) as installation:
+				...
+
+	Every disk gets the same layout, a 512MiB EFI partition followed by one member partition,
+	so the members line up and any of the disks can be made bootable. Only the first EFI partition is used.
+
+	* `mdadm` creates a `raid0`, `raid1` or `raid10` array (`/dev/md/<name>`).
+	* `lvm` creates one volume group over all members and a logical volume striped (`raid0`) or mirrored (`raid1`) across them (`/dev/<name>/root`).
+	* `btrfs` formats all members as a single multi device btrfs with `raid0`, `raid1` or `raid10` data and metadata.
+	  The returned partition is already formatted and can't be encrypted as a whole.
+
+	:param blockdevices: The :py:class:`~archinstall.BlockDevice`'s to use, all of their content is lost.
+	:type blockdevices: list
+
+	:param level: `raid0`, `raid1` or `raid10`
+	:type level: str
+
+	:param backend: `mdadm`, `lvm` or `btrfs`
+	:type backend: str, optional
+
+	:param name: Name of the array or volume group, not `root` as `/dev/root` is the kernel's alias for the root device.
+	:type name: str, optional
+
+	:param chunk_size: Chunk (stripe unit) size of `raid0`/`raid10`, in parted notation.
+	:type chunk_size: str, optional
+	"""
+	def __init__(self, blockdevices, level, backend='mdadm', name='archinstall', chunk_size='512KiB', mode=GPT):
+		if backend not in LEVELS:
+			raise DiskError(f'Unknown disk array backend "{backend}", available backends: {", ".join(LEVELS)}')
+		if level not in LEVELS[backend]:
+			raise DiskError(f'{backend} does not support "{level}", available levels: {", ".join(LEVELS[backend])}')
+		if len(blockdevices) < LEVELS[backend][level]:
+			raise DiskError(f'{backend} {level} needs at least {LEVELS[backend][level]} disks, got {len(blockdevices)}.')
+
+		self.blockdevices = blockdevices
+		self.level = level
+		self.backend = backend
+		self.name = name
+		self.chunk_size = parse_size(chunk_size)
+		self.mode = mode
+		self.boot_partition = None
+		self.members = []
+		self.partition = None
+
+	def __repr__(self, *args, **kwargs):
+		return f'DiskArray({self.backend} {self.level}, name={self.name}, disks={self.blockdevices})'
+
+	def __enter__(self, *args, **kwargs):
+		self.create_members()
+		return self.create()
+
+	def __exit__(self, *args, **kwargs):
+		# TODO: https://stackoverflow.com/questions/28157929/how-to-safely-handle-an-exception-inside-a-context-manager
+		if len(args) >= 2 and args[1]:
+			raise args[1]
+		return True
+
+	def create_members(self):
+		"""
+		Partitions every disk and returns the member partitions.
+		"""
+		self.members = []
+		for index, blockdevice in enumerate(self.blockdevices):
+			plan = PartitionPlan()
+			plan.add(start='1MiB', end='513MiB', name='EFI', flags=['boot'])
+			plan.add(start='513MiB', end='100%', name=f'{self.name}{index}', type=MEMBER_TYPES[self.backend])
+
+			partitions = list(Filesystem(blockdevice, self.mode).apply(plan).values())
+			if len(partitions) != 2:
+				raise DiskError(f'Expected two partitions on {blockdevice} after partitioning it for {self}, found {len(partitions)}.')
+			if index == 0:
+				self.boot_partition = partitions[0]
+			self.members.append(partitions[1])
+		return self.members
+
+	def create(self):
+		"""
+		Creates the array out of the member partitions.
+
+		:return: The array as a :py:class:`~archinstall.Partition`
+		:rtype: :py:class:`~archinstall.Partition`
+		"""
+		log(f'Creating {self}')
+		members = ' '.join(member.path for member in self.members)
+		chunk = self.chunk_size // 1024 # mdadm and lvm both take KiB
+		topology.invalidate()
+
+		if self.backend == 'mdadm':
+			options = f'--chunk={chunk}K' if self.level != 'raid1' else ''
+			if all(member.zeroed for member in self.members):
+				# Members that read back as zeroes are already in sync. Merely discarded ones may not be, those get resynced.
+				options += ' --assume-clean'
+			handle = sys_command(f'/usr/bin/mdadm --create /dev/md/{self.name} --run --metadata=1.2 --homehost=any --level={self.level[4:]} --raid-devices={len(self.members)} {options} {members}')
+			path = f'/dev/md/{self.name}'
+		elif self.backend == 'lvm':
+			# Every member is a PV of its own, holding one column of the stripe, so each PV's data is aligned to a chunk.
+			# That puts every chunk of the striped volume on a chunk boundary of its member, a full stripe (chunk x members) only exists across the PVs.
+			sys_command(f'/usr/bin/pvcreate --yes --dataalignment {chunk}k {members}')
+			sys_command(f'/usr/bin/vgcreate --yes {self.name} {members}')
+			if self.level == 'raid0':
+				layout = f'--stripes {len(self.members)} --stripesize {chunk}k'
+			else:
+				layout = f'--type raid1 --mirrors {len(self.members) - 1}'
+			handle = sys_command(f'/usr/bin/lvcreate --yes --name root --extents 100%FREE {layout} {self.name}')
+			path = f'/dev/{self.name}/root'
+		else:
+			handle = sys_command(f'/usr/bin/mkfs.btrfs -f --label {self.name} --data {self.level} --metadata {self.level if self.level != "raid0" else "raid1"} {members}')
+			path = self.members[0].path
+
+		if handle.exit_code != 0:
+			raise DiskError(f'Could not create {self}: {handle.trace_log.decode("UTF-8")}')
+
+		wait_for_devices([path])
+		self.partition = Partition(path, filesystem='btrfs' if self.backend == 'btrfs' else None)
+		self.partition.trimmed = all(member.trimmed for member in self.members)
+		self.partition.zeroed = all(member.zeroed for member in self.members)
+		self.partition.volume = self
+		return self.partition
+
+	@property
+	def packages(self):
+		return {'mdadm' : ['mdadm'], 'lvm' : ['lvm2'], 'btrfs' : ['btrfs-progs']}[self.backend]
+
+	@property
+	def hooks(self):
+		"""
+		The mkinitcpio hooks needed to assemble the array at boot, they go right after `block`.
+		"""
+		return {'mdadm' : ['mdadm_udev'], 'lvm' : ['lvm2'], 'btrfs' : ['btrfs']}[self.backend]
+
+	@property
+	def kernel_parameters(self):
+		"""
+		`root=` for the boot entry, when the array isn't encrypted.
+		"""
+		if self.backend == 'btrfs':
+			return f'root=UUID={read_superblock(self.members[0].path)["uuid"]}'
+		return f'root={self.partition.path}'
+
+	def configure(self, installation):
+		"""
+		Writes whatever the installed system needs to assemble the array, called by the :py:class:`~archinstall.Installer`.
+		"""
+		if self.backend == 'mdadm':
+			scan = sys_command('/usr/bin/mdadm --detail --scan')
+			with open(f'{installation.mountpoint}/etc/mdadm.conf', 'ab') as fh:
+				fh.write(bytes(scan.trace_log))
+		return True
@@ -0,0 +1,9 @@
+"""
+Benchmarks for archinstall's own overhead.
+
+The real binaries (parted, mkfs.*, cryptsetup, pacstrap, arch-chroot etc) are swapped
+for stub scripts with configurable latency and output, so that the disk and installer
+steps can be driven end to end without real hardware:
+
+    python -m benchmarks --latency 0.01 --json results.json
+"""
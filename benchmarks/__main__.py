@@ -0,0 +1,52 @@
+import sys, json, argparse
+
+import archinstall
+from . import phases
+
+parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Measures archinstall overhead against stub binaries.')
+parser.add_argument('--latency', type=float, default=0.0, help='Seconds every stub binary sleeps before returning.')
+parser.add_argument('--iterations', type=int, default=200, help='Number of spawns for the spawn latency benchmark.')
+parser.add_argument('--json', help='Also write the results to this file.')
+parser.add_argument('--chrome-trace', help='Write a Chrome trace_event file of the installation phases.')
+parser.add_argument('--loop-devices', action='store_true', help='Format and encrypt loop devices attached to temporary images (needs root), rather than the images themselves.')
+args = parser.parse_args()
+
+results = {
+	'installation' : phases.installation(latency=args.latency),
+	'spawn_latency' : phases.spawn_latency(args.iterations),
+	'trigger_matcher' : phases.trigger_matcher(),
+	'enumeration' : phases.enumeration(),
+	'gpt_writer' : phases.gpt_writer(),
+	'format_profiles' : phases.format_profiles(loop_devices=args.loop_devices),
+	'superblock' : phases.superblock(),
+	'dm_crypt' : phases.dm_crypt(loop_devices=args.loop_devices)
+}
+
+print(f"{'phase':<24}{'wall (ms)':>12}{'spawns':>8}{'commands (ms)':>16}{'python (ms)':>14}")
+for name, phase in results['installation'].items():
+	print(f"{name:<24}{phase['wall_time']*1000:>12.2f}{phase['spawns']:>8}{phase['command_time']*1000:>16.2f}{phase['python_overhead']*1000:>14.2f}" + (f"  ({phase['error']})" if phase['error'] else ''))
+
+for name, seconds in results['spawn_latency'].items():
+	print(f"spawn latency ({name}): {seconds*1000:.3f} ms")
+print(f"trigger matcher: {results['trigger_matcher']/1024/1024:.2f} MiB/s")
+print(f"sysfs enumeration of {results['enumeration']['devices']} devices: {results['enumeration']['sysfs']*1000:.3f} ms (lsblk on this machine: {results['enumeration']['lsblk_local']*1000:.3f} ms)")
+print(f"in-process GPT of a 64GiB image: {results['gpt_writer']*1000:.3f} ms")
+for filesystem, profiles in results['format_profiles'].items():
+	print(f"mkfs {filesystem}: " + ', '.join(f"{profile} {seconds*1000:.1f} ms" for profile, seconds in profiles.items()))
+for name, seconds in results['superblock'].items():
+	print(f"ext4 UUID via {name}: {seconds*1000000:.1f} us")
+for name, throughput in results['dm_crypt'].items():
+	print(f"dm-crypt {name}: write {throughput['write']:.1f} MiB/s, read {throughput['read']:.1f} MiB/s")
+
+if args.json:
+	with open(args.json, 'w') as fh:
+		json.dump(results, fh, indent=4)
+
+if args.chrome_trace:
+	archinstall.instrumentation.save_chrome_trace(args.chrome_trace)
+
+# A failed phase measured nothing, don't let that pass unnoticed
+if (failed := {name : phase['error'] for name, phase in results['installation'].items() if phase['error']}):
+	for name, error in failed.items():
+		print(f'phase {name} failed: {error}', file=sys.stderr)
+	sys.exit(1)
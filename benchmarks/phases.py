@@ -0,0 +1,312 @@
+import os, mmap, time, shutil, tempfile, subprocess
+
+import archinstall
+from archinstall.lib import general, disk, luks
+from .stubs import create_stubs, binaries_from, StubSession
+from .sysfs import create_fake_sysfs
+
+class Phase():
+	"""
+	Measures one step of the installation: wall time, the number of spawned
+	processes and how much of the wall time was spent in archinstall itself
+	rather than waiting on the (stubbed) processes.
+	"""
+	def __init__(self, name, results):
+		self.name = name
+		self.results = results
+
+	def __enter__(self):
+		self.first_event = len(archinstall.instrumentation.events)
+		self.started = time.perf_counter()
+		return self
+
+	def __exit__(self, *args, **kwargs):
+		wall_time = time.perf_counter() - self.started
+		commands = [event for event in archinstall.instrumentation.events[self.first_event:] if event['category'] == 'sys_command']
+		command_time = sum(event['ended'] - event['started'] for event in commands)
+
+		self.results[self.name] = {
+			'wall_time' : wall_time,
+			'spawns' : len(commands),
+			'command_time' : command_time,
+			'python_overhead' : max(wall_time - command_time, 0.0),
+			'error' : str(args[1]) if len(args) >= 2 and args[1] else None
+		}
+		return True # Keep going, a failed phase is part of the result
+
+BENCHMARK_LUKS_UUID = '0b7f1c1e-3f5c-4b73-9d7c-bench0000002'
+BENCHMARK_PARTUUID = '5e2a8f0c-3f5c-4b73-9d7c-bench0000003'
+
+def installation(latency=0.0, latencies={}):
+	"""
+	Drives the disk and installer steps of `guided.py` end to end against stub binaries.
+
+	:return: `{phase : {'wall_time', 'spawns', 'command_time', 'python_overhead', 'error'}}`
+	:rtype: dict
+	"""
+	results = {}
+	with tempfile.TemporaryDirectory(prefix='archinstall-benchmark-') as workdir, binaries_from(create_stubs(f'{workdir}/bin', latency=latency, latencies=latencies)):
+		trace_journal, general.trace_journal = general.trace_journal, archinstall.TraceJournal(f'{workdir}/trace.journal')
+		# The stubs never create any device nodes, the session tells wait_for_devices() not to wait for them.
+		session = StubSession(f'{workdir}/session.json').start()
+		# Nor the /dev/disk links, so the bootloader gets to find the LUKS UUID in links of our own.
+		device_links, disk.DEVICE_LINKS = disk.DEVICE_LINKS, f'{workdir}/disk'
+		for directory, name in (('by-uuid', BENCHMARK_LUKS_UUID), ('by-partuuid', BENCHMARK_PARTUUID)):
+			os.makedirs(f'{workdir}/disk/{directory}')
+			os.symlink('/dev/bench0p2', f'{workdir}/disk/{directory}/{name}')
+		# Every run pays for the cipher benchmark, like the first install after booting the live medium does.
+		luks_benchmark_cache, luks.LUKS_BENCHMARK_CACHE = luks.LUKS_BENCHMARK_CACHE, f'{workdir}/luks-benchmark.json'
+		luks._luks_benchmarks.clear()
+
+		try:
+			harddrive = archinstall.BlockDevice('/dev/bench0', {'path' : '/dev/bench0', 'type' : 'disk', 'size' : '20G', 'label' : None})
+
+			with Phase('use_entire_disk', results):
+				with archinstall.Filesystem(harddrive, archinstall.GPT) as fs:
+					fs.use_entire_disk('luks2')
+
+			with Phase('format_boot', results):
+				boot_partition = harddrive.partition[0]
+				boot_partition.format('fat32')
+
+			with Phase('luks2', results):
+				crypt = archinstall.luks2(harddrive.partition[1], 'luksloop', 'benchmark')
+				key_file = crypt.encrypt(harddrive.partition[1], 'benchmark', key_file=f'{workdir}/bench0p2.disk_pw', tune=True)
+				unlocked_device = crypt.unlock(harddrive.partition[1], 'luksloop', key_file)
+
+			with Phase('format_root', results):
+				unlocked_device.format('btrfs')
+
+			installation = archinstall.Installer(unlocked_device, boot_partition=boot_partition, mountpoint=f'{workdir}/mnt', subvolumes=True, swap='zram')
+			with Phase('mount', results):
+				installation.__enter__()
+
+			with Phase('minimal_installation', results):
+				installation.minimal_installation()
+
+			with Phase('add_bootloader', results):
+				installation.add_bootloader()
+
+			# What NTP, guided.py's extra packages and a desktop profile add on top, over a single database sync
+			with Phase('packages', results):
+				installation.activate_ntp()
+				installation.queue_packages(['git', 'wget'])
+				installation.queue_packages('xorg-server xorg-xinit') # profiles/xorg.py
+				installation.add_additional_packages('awesome xterm git') # profiles/applications/awesome.py
+				installation.flush_packages()
+		finally:
+			general.trace_journal = trace_journal
+			session.stop()
+			disk.DEVICE_LINKS = device_links
+			luks.LUKS_BENCHMARK_CACHE = luks_benchmark_cache
+
+	return results
+
+def spawn_latency(iterations=200):
+	"""
+	Average time to run `/bin/true` over a pty against over plain pipes.
+	"""
+	results = {}
+	for name, use_pty in (('pty', True), ('pipe', False)):
+		started = time.perf_counter()
+		for i in range(iterations):
+			archinstall.sys_command('/bin/true', pty=use_pty)
+		results[name] = (time.perf_counter() - started) / iterations
+	return results
+
+def trigger_matcher(size=8*1024*1024, chunk_size=8192):
+	"""
+	Throughput (bytes/s) of :py:class:`~archinstall.TriggerMatcher` on a synthetic stream
+	with a handful of `cryptsetup`/`passwd` style prompts that never match.
+	"""
+	matcher = archinstall.TriggerMatcher({'enter passphrase': '', 'verify passphrase': '', 'new password:': '', 'retype new password:': ''})
+	stream = (b'Lorem ipsum dolor sit amet, password passphrase enter verify\n' * (size // 61 + 1))[:size]
+
+	started = time.perf_counter()
+	for position in range(0, size, chunk_size):
+		matcher.feed(stream[position:position+chunk_size])
+	return size / (time.perf_counter() - started)
+
+def enumeration(iterations=20, **layout):
+	"""
+	Average time for :py:func:`~archinstall.enumerate_block_devices` to list a fake sysfs tree
+	with hundreds of block devices, and for the real `lsblk` to list this machine for comparison.
+	"""
+	results = {}
+	with tempfile.TemporaryDirectory(prefix='archinstall-sysfs-') as workdir:
+		roots = create_fake_sysfs(workdir, **layout)
+
+		started = time.perf_counter()
+		for i in range(iterations):
+			devices = archinstall.enumerate_block_devices(**roots)
+		results['sysfs'] = (time.perf_counter() - started) / iterations
+		results['devices'] = len(devices)
+
+	started = time.perf_counter()
+	for i in range(iterations):
+		archinstall.sys_command('/usr/bin/lsblk --json -l -o path,size,type,mountpoint,label,pkname')
+	results['lsblk_local'] = (time.perf_counter() - started) / iterations
+	return results
+
+def gpt_writer(iterations=50, size=64*1024*1024*1024):
+	"""
+	Average time for :py:class:`~archinstall.GPTWriter` to write and verify
+	the `use_entire_disk` layout on a sparse image file.
+	"""
+	plan = archinstall.PartitionPlan()
+	plan.add(start='1MiB', end='513MiB', name='EFI', flags=['boot'])
+	plan.add(start='513MiB', end='100%')
+
+	with tempfile.TemporaryDirectory(prefix='archinstall-gpt-') as workdir:
+		with open(f'{workdir}/disk.img', 'wb') as fh:
+			fh.truncate(size)
+
+		started = time.perf_counter()
+		for i in range(iterations):
+			archinstall.GPTWriter(f'{workdir}/disk.img').write(plan)
+		return (time.perf_counter() - started) / iterations
+
+def _attach_loop(image):
+	"""
+	Attaches `image` to a free loop device, and returns the device only if it's really backed by `image`.
+	"""
+	loop = subprocess.run(['losetup', '--find', '--show', image], capture_output=True, text=True)
+	if loop.returncode != 0 or not (device := loop.stdout.strip()):
+		return None
+
+	try:
+		with open(f'/sys/block/{os.path.basename(device)}/loop/backing_file', 'r') as fh:
+			backing_file = fh.read().strip()
+	except OSError:
+		backing_file = None
+	if backing_file != os.path.realpath(image):
+		subprocess.run(['losetup', '--detach', device])
+		return None
+	return device
+
+def format_profiles(size=16*1024*1024*1024, filesystems=('ext4', 'btrfs', 'fat32'), loop_devices=False):
+	"""
+	Time for :py:func:`~archinstall.Partition.format` with each of the `FORMAT_PROFILES`,
+	running the real `mkfs` binaries (where installed) against a sparse file.
+
+	:param loop_devices: Format a loop device attached to the sparse file instead, which needs root.
+	    Nothing else is ever formatted, the loop device is checked to be backed by the sparse file first.
+	:type loop_devices: bool, optional
+
+	:return: `{filesystem : {profile : seconds}}`
+	:rtype: dict
+	"""
+	binaries = {'ext4' : 'mkfs.ext4', 'btrfs' : 'mkfs.btrfs', 'fat32' : 'mkfs.vfat'}
+	results = {}
+	with tempfile.TemporaryDirectory(prefix='archinstall-mkfs-') as workdir:
+		# The commands use /usr/bin/mkfs.*, point them at wherever this machine has them.
+		os.makedirs(f'{workdir}/bin')
+		for binary in binaries.values():
+			if (location := shutil.which(binary)):
+				os.symlink(location, f'{workdir}/bin/{binary}')
+
+		with binaries_from(f'{workdir}/bin'):
+			for filesystem in filesystems:
+				if not os.path.exists(f'{workdir}/bin/{binaries[filesystem]}'):
+					continue
+
+				for profile in archinstall.FORMAT_PROFILES:
+					with open(f'{workdir}/disk.img', 'wb') as fh:
+						fh.truncate(0)
+						fh.truncate(size)
+
+					loop = _attach_loop(f'{workdir}/disk.img') if loop_devices else None
+					try:
+						started = time.perf_counter()
+						archinstall.Partition(loop or f'{workdir}/disk.img').format(filesystem, profile=profile)
+						results.setdefault(filesystem, {})[profile] = time.perf_counter() - started
+					finally:
+						if loop:
+							subprocess.run(['losetup', '--detach', loop])
+	return results
+
+def superblock(iterations=200, size=1024*1024*1024):
+	"""
+	Average time for :py:func:`~archinstall.read_superblock` to identify an ext4 image made by the real `mkfs.ext4`,
+	against `blkid -p` on the same image. Skipped (`{}`) if `mkfs.ext4` isn't installed.
+	"""
+	results = {}
+	if not (mkfs := shutil.which('mkfs.ext4')):
+		return results
+
+	with tempfile.TemporaryDirectory(prefix='archinstall-superblock-') as workdir:
+		with open(f'{workdir}/disk.img', 'wb') as fh:
+			fh.truncate(size)
+		subprocess.run([mkfs, '-q', '-F', f'{workdir}/disk.img'], check=True)
+
+		started = time.perf_counter()
+		for i in range(iterations):
+			archinstall.read_superblock(f'{workdir}/disk.img')
+		results['read_superblock'] = (time.perf_counter() - started) / iterations
+
+		if (blkid := shutil.which('blkid')):
+			started = time.perf_counter()
+			for i in range(iterations // 10):
+				subprocess.run([blkid, '-p', f'{workdir}/disk.img'], capture_output=True)
+			results['blkid'] = (time.perf_counter() - started) / (iterations // 10)
+	return results
+
+def _direct_io_throughput(path, size, chunk):
+	# O_DIRECT needs a page aligned buffer, which an anonymous mmap is
+	buffer = mmap.mmap(-1, chunk)
+	buffer.write(os.urandom(chunk))
+	fd = os.open(path, os.O_RDWR | os.O_DIRECT)
+	try:
+		started = time.perf_counter()
+		for offset in range(0, size, chunk):
+			os.pwritev(fd, [buffer], offset)
+		os.fsync(fd)
+		write = size / (time.perf_counter() - started)
+
+		started = time.perf_counter()
+		for offset in range(0, size, chunk):
+			os.preadv(fd, [buffer], offset)
+		read = size / (time.perf_counter() - started)
+	finally:
+		os.close(fd)
+		buffer.close()
+	return {'write' : write / 1024**2, 'read' : read / 1024**2}
+
+def dm_crypt(size=512*1024*1024, chunk=1024*1024, loop_devices=False):
+	"""
+	Direct I/O throughput of a LUKS2 encrypted loop device set up by :py:class:`~archinstall.luks2` with 512 byte sectors
+	and the dm-crypt workqueues (`default`), against 4K sectors without the workqueues (`tuned`), as it's set up on 4K SSD's.
+	Needs `loop_devices` (see :py:func:`format_profiles`), root, `losetup` and `cryptsetup`, skipped (`{}`) otherwise.
+
+	:return: `{'default' : {'write' : MiB/s, 'read' : MiB/s}, 'tuned' : {...}}`
+	:rtype: dict
+	"""
+	results = {}
+	if not loop_devices or os.geteuid() != 0 or not (cryptsetup := shutil.which('cryptsetup')) or not shutil.which('losetup'):
+		return results
+
+	with tempfile.TemporaryDirectory(prefix='archinstall-dm-crypt-') as workdir:
+		# The commands use /usr/bin/cryptsetup, point them at wherever this machine has it.
+		os.makedirs(f'{workdir}/bin')
+		os.symlink(cryptsetup, f'{workdir}/bin/cryptsetup')
+
+		with open(f'{workdir}/disk.img', 'wb') as fh:
+			fh.truncate(size + 32*1024*1024) # Room for the LUKS2 header
+		if not (loop := _attach_loop(f'{workdir}/disk.img')):
+			return results
+
+		try:
+			with binaries_from(f'{workdir}/bin'):
+				for name, sector_size, no_workqueue in (('default', 512, False), ('tuned', 4096, True)):
+					partition = archinstall.Partition(loop)
+					crypt = archinstall.luks2(partition, 'archinstall-bench', 'benchmark', no_workqueue=no_workqueue)
+					key_file = crypt.encrypt(partition, 'benchmark', iter_time=100, key_file=f'{workdir}/disk.pw', sector_size=sector_size)
+					if not (unlocked := crypt.unlock(partition, 'archinstall-bench', key_file)):
+						break
+					try:
+						results[name] = _direct_io_throughput(unlocked.path, size, chunk)
+					finally:
+						crypt.close('archinstall-bench')
+		finally:
+			subprocess.run(['losetup', '--detach', loop])
+	return results
@@ -0,0 +1,117 @@
+import os, json, stat, contextlib
+
+import archinstall
+from archinstall.lib import general
+
+# Output the installer steps look for, so that they carry on as if the real binary ran.
+LSBLK_PARTITIONS = {
+	'blockdevices' : [{
+		'name' : 'bench0', 'size' : '20G', 'type' : 'disk',
+		'children' : [
+			{'name' : 'bench0p1', 'size' : '512M', 'type' : 'part'},
+			{'name' : 'bench0p2', 'size' : '19.5G', 'type' : 'part', 'children' : [
+				{'name' : 'luksloop', 'size' : '19.5G', 'type' : 'crypt'}
+			]}
+		]
+	}]
+}
+
+LSBLK_LIST = {
+	'blockdevices' : [
+		{'name' : 'bench0', 'path' : '/dev/bench0', 'pkname' : None, 'type' : 'disk', 'size' : '20G', 'mountpoint' : None, 'label' : None},
+		{'name' : 'bench0p1', 'path' : '/dev/bench0p1', 'pkname' : 'bench0', 'type' : 'part', 'size' : '512M', 'mountpoint' : None, 'label' : None},
+		{'name' : 'bench0p2', 'path' : '/dev/bench0p2', 'pkname' : 'bench0', 'type' : 'part', 'size' : '19.5G', 'mountpoint' : None, 'label' : None},
+		{'name' : 'luksloop', 'path' : '/dev/mapper/luksloop', 'pkname' : 'bench0p2', 'type' : 'crypt', 'size' : '19.5G', 'mountpoint' : None, 'label' : None}
+	]
+}
+
+STUBS = {
+	'parted' : {},
+	# The partition plan arrives on stdin.
+	'sfdisk' : {'script' : 'cat > /dev/null'},
+	'partprobe' : {},
+	'sync' : {},
+	'mount' : {},
+	'umount' : {},
+	'mkfs.btrfs' : {'output' : 'btrfs-progs v5.9\nUUID: 6a1e0c7e-3f5c-4b73-9d7c-bench0000001'},
+	'mkfs.vfat' : {'output' : 'mkfs.fat 4.1 (2017-01-24)'},
+	'mkfs.ext4' : {'output' : 'Creating filesystem with 5111808 4k blocks and 1277952 inodes'},
+	# `benchmark` answers like a machine with AES instructions would.
+	'cryptsetup' : {'script' : """case "$*" in
+		benchmark*argon2id*) echo 'argon2id      4 iterations, 1048576 memory, 4 parallel threads (CPUs) for 256-bit key (requested 2000 ms time)';;
+		benchmark*adiantum*) echo '#     Algorithm |       Key |      Encryption |      Decryption'; echo 'xchacha12,aes-adiantum        256b       812.3 MiB/s       840.1 MiB/s';;
+		benchmark*256*) echo '#     Algorithm |       Key |      Encryption |      Decryption'; echo '        aes-xts        256b      2580.3 MiB/s      2591.0 MiB/s';;
+		benchmark*) echo '#     Algorithm |       Key |      Encryption |      Decryption'; echo '        aes-xts        512b      2105.6 MiB/s      2110.2 MiB/s';;
+		*) printf 'Key slot 0 created.\\nCommand successful.\\n';;
+	esac"""},
+	# The device tree for `lsblk -J <dev>`, the flat list for `lsblk -l`.
+	'lsblk' : {'script' : f"""case "$*" in *-l*) echo '{json.dumps(LSBLK_LIST)}';; *) echo '{json.dumps(LSBLK_PARTITIONS)}';; esac"""},
+	'losetup' : {'output' : json.dumps({'loopdevices' : []})},
+	'pacman' : {'output' : ':: Synchronizing package databases...'},
+	# pacstrap lays out the bits of the target the later steps write into.
+	'pacstrap' : {'script' : 'mkdir -p "$1/etc/systemd" "$1/etc/sysctl.d" "$1/boot/loader/entries" && touch "$1/etc/fstab"'},
+	'btrfs' : {'output' : "Create subvolume"},
+	'genfstab' : {'output' : 'UUID=6a1e0c7e-3f5c-4b73-9d7c-bench0000001 / btrfs rw,noatime,compress=zstd:3,ssd,space_cache=v2,subvol=/@ 0 0'},
+	'arch-chroot' : {},
+}
+
+def create_stubs(directory, latency=0.0, latencies={}, outputs={}):
+	"""
+	Writes a `/bin/sh` stub for every binary in `STUBS` into `directory`.
+
+	:param latency: Seconds every stub sleeps before printing its output.
+	:type latency: float
+
+	:param latencies: Per binary latency, for instance `{'pacstrap' : 2.0}`.
+	:type latencies: dict
+
+	:param outputs: Per binary output, replacing the default one.
+	:type outputs: dict
+	"""
+	os.makedirs(directory, exist_ok=True)
+
+	for name, stub in STUBS.items():
+		delay = latencies.get(name, latency)
+		output = outputs.get(name, stub.get('output', ''))
+
+		with open(os.path.join(directory, name), 'w') as fh:
+			fh.write('#!/bin/sh\n')
+			if delay:
+				fh.write(f'sleep {delay}\n')
+			if output:
+				fh.write(f"cat <<'__STUB_OUTPUT__'\n{output}\n__STUB_OUTPUT__\n")
+			if 'script' in stub:
+				fh.write(f"{stub['script']}\n")
+
+		os.chmod(os.path.join(directory, name), stat.S_IRWXU)
+
+	return directory
+
+class StubSession(archinstall.Cassette):
+	"""
+	Records the session run against the stubs. They never create any device nodes,
+	so like a replayed session, they're taken to be there rather than waited for.
+	"""
+	def __init__(self, path):
+		super().__init__(path, mode='record')
+
+	def emulates_devices(self):
+		return True
+
+@contextlib.contextmanager
+def binaries_from(directory):
+	"""
+	Looks every command up by its basename in `directory` first, even the ones called with an absolute path,
+	by wrapping :py:func:`~archinstall.locate_binary` for as long as the context lasts.
+	"""
+	locate_binary = general.locate_binary
+	def override(name):
+		if os.path.isfile(path := os.path.join(directory, os.path.basename(name))):
+			return path
+		return locate_binary(name)
+
+	general.locate_binary = override
+	try:
+		yield directory
+	finally:
+		general.locate_binary = locate_binary
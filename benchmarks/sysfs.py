@@ -0,0 +1,59 @@
+import os
+
+def _write(path, data):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, 'w') as fh:
+		fh.write(f'{data}\n')
+
+def create_fake_sysfs(directory, nvme=128, partitions=4, loops=64, multipath=32):
+	"""
+	Builds a fake `/sys` + `/proc/self/mountinfo` + `/run/udev/data` tree with hundreds of block devices:
+	NVMe namespaces with partitions, attached loop devices and device mapper multipath devices
+	on top of pairs of SCSI paths. Useful for :py:func:`~archinstall.enumerate_block_devices`.
+
+	:return: `{'sysfs', 'mountinfo', 'udev_data'}` to pass on to `enumerate_block_devices()`
+	:rtype: dict
+	"""
+	sysfs = f'{directory}/sys'
+	udev_data = f'{directory}/udev'
+	os.makedirs(f'{sysfs}/block', exist_ok=True)
+	os.makedirs(udev_data, exist_ok=True)
+	mountinfo = []
+
+	def block(name, major, minor, sectors, parent_dir=None):
+		device_dir = f'{parent_dir}/{name}' if parent_dir else f'{sysfs}/devices/virtual/block/{name}'
+		_write(f'{device_dir}/size', sectors)
+		_write(f'{device_dir}/dev', f'{major}:{minor}')
+		_write(f'{device_dir}/removable', 0)
+		os.makedirs(f'{device_dir}/holders', exist_ok=True)
+		os.makedirs(f'{device_dir}/slaves', exist_ok=True)
+		_write(f'{udev_data}/b{major}:{minor}', f'E:ID_FS_LABEL={name}-label')
+		if not parent_dir:
+			os.symlink(os.path.relpath(device_dir, f'{sysfs}/block'), f'{sysfs}/block/{name}')
+		return device_dir
+
+	for index in range(nvme):
+		disk = block(f'nvme{index}n1', 259, index * (partitions + 1), 2000409264)
+		for part in range(1, partitions + 1):
+			block(f'nvme{index}n1p{part}', 259, index * (partitions + 1) + part, 2000409264 // partitions, parent_dir=disk)
+			_write(f'{disk}/nvme{index}n1p{part}/partition', part)
+			mountinfo.append(f'{len(mountinfo) + 30} 1 259:{index * (partitions + 1) + part} / /srv/nvme{index}/{part} rw,noatime - xfs /dev/nvme{index}n1p{part} rw')
+
+	for index in range(loops):
+		block(f'loop{index}', 7, index, 4194304)
+
+	for index in range(multipath):
+		paths = []
+		for path in range(2):
+			name = f'sd{chr(97 + (index * 2 + path) // 26)}{chr(97 + (index * 2 + path) % 26)}'
+			block(name, 8, (index * 2 + path) * 16, 3907029168)
+			paths.append(name)
+		device_dir = block(f'dm-{index}', 253, index, 3907029168)
+		_write(f'{device_dir}/dm/name', f'mpath{index}')
+		_write(f'{device_dir}/dm/uuid', f'mpath-3600508b400105e21000090000{index:04d}')
+		for name in paths:
+			os.symlink(f'../../{name}', f'{device_dir}/slaves/{name}')
+			os.symlink(f'../../dm-{index}', f'{sysfs}/devices/virtual/block/{name}/holders/dm-{index}')
+
+	_write(f'{directory}/mountinfo', '\n'.join(mountinfo))
+	return {'sysfs' : sysfs, 'mountinfo' : f'{directory}/mountinfo', 'udev_data' : udev_data}
@@ -1,13 +1,13 @@
 import archinstall, getpass, time
 
-def perform_installation(device, boot_partition, language, mirrors):
+def add_installation_steps(steps, device, boot_partition, language, mirrors, depends):
 	"""
-	Performs the installation steps on a block device.
-	Only requirement is that the block devices are
-	formatted and setup prior to entering this function.
+	Adds the installation steps on a block device to `steps`.
+	Only requirement is that the block devices are formatted
+	and setup by the steps in `depends` (or prior to running).
+	`device` can be a function returning the block device, once `depends` have run.
 	"""
-	with archinstall.Installer(device, boot_partition=boot_partition, hostname=hostname) as installation:
-		## if len(mirrors):
+	def wait_for_mirrors():
 		# Certain services might be running that affects the system during installation.
 		# Currently, only one such service is "reflector.service" which updates /etc/pacman.d/mirrorlist
 		# We need to wait for it before we continue since we opted in to use a custom mirror/region.
@@ -16,26 +16,42 @@ def perform_installation(device, boot_partition, language, mirrors):
 			time.sleep(1)
 
 		archinstall.use_mirrors(mirrors) # Set the mirrors for the live medium
-		if installation.minimal_installation():
-			installation.set_mirrors(mirrors) # Set the mirrors in the installation medium
-			installation.set_keyboard_language(language)
-			installation.add_bootloader()
 
-			if len(packages) and packages[0] != '':
-				installation.add_additional_packages(packages)
+	def configure():
+		installation = steps['installer']
+		installation.set_mirrors(mirrors) # Set the mirrors in the installation medium
+		installation.set_keyboard_language(language)
 
-			if len(profile.strip()):
-				installation.install_profile(profile)
+	def create_users():
+		installation = steps['installer']
+		for user, password in users.items():
+			sudo = False
+			if len(root_pw.strip()) == 0:
+				sudo = True
 
-			for user, password in users.items():
-				sudo = False
-				if len(root_pw.strip()) == 0:
-					sudo = True
+			installation.user_create(user, password, sudo=sudo)
 
-				installation.user_create(user, password, sudo=sudo)
+		if root_pw:
+			installation.user_set_pw('root', root_pw)
 
-			if root_pw:
-				installation.user_set_pw('root', root_pw)
+	# The live medium's mirrors don't depend on the disk, they're sorted out while it's being formatted.
+	# pacstrap and arch-chroot both mount the API filesystems inside the target, so anything using them shares the "chroot" lock.
+	steps.add('mirrors', wait_for_mirrors)
+	steps.add_context('installer', lambda: archinstall.Installer(device() if callable(device) else device, boot_partition=boot_partition, hostname=hostname, swap=swap), depends=depends)
+	steps.add('minimal_installation', lambda: steps['installer'].minimal_installation(), depends=['installer', 'mirrors'], locks=['chroot'])
+	steps.add('configure', configure, depends=['minimal_installation'])
+	steps.add('bootloader', lambda: steps['installer'].add_bootloader(), depends=['minimal_installation'], locks=['chroot'])
+
+	after_packages = ['minimal_installation']
+	if len(packages) and packages[0] != '':
+		# Goes in with the profile, or when leaving the installer
+		steps.add('packages', lambda: steps['installer'].queue_packages(packages), depends=['minimal_installation'], locks=['chroot'])
+		after_packages = ['packages']
+
+	if len(profile.strip()):
+		steps.add('profile', lambda: steps['installer'].install_profile(profile), depends=after_packages, locks=['chroot'])
+
+	steps.add('users', create_users, depends=['minimal_installation'], locks=['chroot'])
 
 # Unmount and close previous runs (in case the installer is restarted)
 archinstall.sys_command(f'umount -R /mnt', surpress_errors=True)
@@ -105,6 +121,9 @@ while 1:
 
 packages = input('Additional packages aside from base (space separated): ').split(' ')
 
+# zram or a swapfile, whichever archinstall.swap_policy() picks for this machine
+swap = input('Set up swap (y/N): ').strip().lower() in ('y', 'yes')
+
 """
 	Issue a final warning before we continue with something un-revertable.
 """
@@ -120,9 +139,14 @@ print(f' ! Formatting {harddrive} in 1...')
 time.sleep(1)
 
 """
-	Setup the blockdevice, filesystem (and optionally encryption).
-	Once that's done, we'll hand over to perform_installation()
+	Setup the blockdevice, filesystem (and optionally encryption),
+	then hand over to the installation steps, all in one step graph.
 """
+if disk_password:
+	# Benchmarked before anything runs in parallel, formatting at the same time would skew the numbers.
+	# luks2(tune=True) then picks the cached result up.
+	archinstall.luks_parameters()
+
 with archinstall.Filesystem(harddrive, archinstall.GPT) as fs:
 	# Use partitioning helper to set up the disk partitions.
 	if disk_password:
@@ -132,16 +156,24 @@ with archinstall.Filesystem(harddrive, archinstall.GPT) as fs:
 
 	if harddrive.partition[1].size == '512M':
 		raise OSError('Trying to encrypt the boot partition for petes sake..')
-	harddrive.partition[0].format('fat32')
+
+	# The boot and root partitions don't depend on each other,
+	# so the boot partition gets formatted while the root partition is being set up.
+	steps = archinstall.StepGraph()
+	steps.add('format_boot', harddrive.partition[0].format, 'fat32')
 
 	if disk_password:
 		# First encrypt and unlock, then format the desired partition inside the encrypted part.
 		# archinstall.luks2() encrypts the partition when entering the with context manager, and
 		# unlocks the drive so that it can be used as a normal block-device within archinstall.
-		with archinstall.luks2(harddrive.partition[1], 'luksloop', disk_password) as unlocked_device:
-			unlocked_device.format('btrfs')
-			
-			perform_installation(unlocked_device, harddrive.partition[0], keyboard_language, mirror_regions)
+		# The graph leaves it once the installation is done, closing it again if anything failed.
+		steps.add_context('encrypt_root', archinstall.luks2(harddrive.partition[1], 'luksloop', disk_password, tune=True))
+		steps.add('format_root', lambda: steps['encrypt_root'].format('btrfs'), depends=['encrypt_root'])
+
+		add_installation_steps(steps, lambda: steps['encrypt_root'], harddrive.partition[0], keyboard_language, mirror_regions, depends=['format_boot', 'format_root'])
 	else:
-		harddrive.partition[1].format('ext4')
-		perform_installation(harddrive.partition[1], harddrive.partition[0], keyboard_language, mirror_regions)
\ No newline at end of file
+		steps.add('format_root', harddrive.partition[1].format, 'ext4')
+
+		add_installation_steps(steps, harddrive.partition[1], harddrive.partition[0], keyboard_language, mirror_regions, depends=['format_boot', 'format_root'])
+
+	steps.run()
@@ -42,7 +42,8 @@ if __name__ == 'awesome':
 		"audio" : "pulseaudio pulseaudio-alsa pavucontrol"
 	}
 
-	installation.add_additional_packages("{webbrowser} {utils} {mediaplayer} {window_manager} {virtulization} {filebrowser} {editor}".format(**arguments))
+	# Nothing below reads from these, they're installed when the gsettings calls flush the queue
+	installation.queue_packages("{webbrowser} {utils} {mediaplayer} {window_manager} {virtulization} {filebrowser} {editor}".format(**arguments))
 
 	#with open(f'{installation.mountpoint}/etc/X11/xinit/xinitrc', 'a') as X11:
 	#	X11.write('setxkbmap se\n')
@@ -38,7 +38,7 @@ def select_driver(options):
 		print(' -- You need to select (and read about) which one you need. --')
 
 		lspci = archinstall.sys_command(f'/usr/bin/lspci')
-		for line in lspci.trace_log.split(b'\r\n'):
+		for line in lspci:
 			if b' vga ' in line.lower():
 				if b'nvidia' in line.lower():
 					print(' ** nvidia card detected, suggested driver: nvidia **')
@@ -102,10 +102,11 @@ def _prep_function(*args, **kwargs):
 # through importlib.util.spec_from_file_location("xorg", "/somewhere/xorg.py")
 # or through conventional import xorg
 if __name__ == 'xorg':
+	# Queued, so they go in with the desktop environment that needs xorg in one transaction
 	try:
-		installation.add_additional_packages(f"xorg-server xorg-xinit {' '.join(_gfx_driver_packages)}")
+		installation.queue_packages(f"xorg-server xorg-xinit {' '.join(_gfx_driver_packages)}")
 	except:
-		installation.add_additional_packages(f"xorg-server xorg-xinit") # Prep didn't run, so there's no driver to install
+		installation.queue_packages(f"xorg-server xorg-xinit") # Prep didn't run, so there's no driver to install
 
 	# with open(f'{installation.mountpoint}/etc/X11/xinit/xinitrc', 'a') as X11:
 	# 	X11.write('setxkbmap se\n')
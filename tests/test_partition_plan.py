@@ -0,0 +1,108 @@
+import pytest
+import archinstall
+
+DISK_SIZE = 8 * 1024**3
+
+def efi_and_root():
+	plan = archinstall.PartitionPlan()
+	plan.add(start='1MiB', end='513MiB', name='EFI', flags=['boot'])
+	plan.add(start='513MiB', end='100%', flags=['legacy_boot'])
+	return plan
+
+def test_sfdisk_script():
+	# The last partition stops 4KiB short of the backup GPT (33 sectors), where the alignment is
+	assert efi_and_root().sfdisk_script(DISK_SIZE) == '\n'.join([
+		'label: gpt',
+		'sector-size: 512',
+		'start=2048, size=1048576, type=C12A7328-F81F-11D2-BA4B-00A0C93EC93B, name="EFI"',
+		'start=1050624, size=15726552, type=0FC63DAF-8483-4772-8E79-3D69D8477DE4, attrs="LegacyBIOSBootable"',
+	]) + '\n'
+
+def test_sfdisk_script_rest_of_disk():
+	plan = archinstall.PartitionPlan()
+	plan.add(start='1MiB', end='100%', type='lvm')
+	assert plan.sfdisk_script(sector_size=4096).splitlines()[1:] == ['sector-size: 4096', 'start=256, type=E6D6D379-F507-44C2-A23C-238F2A3DF928']
+
+def test_resolve_alignment_offset():
+	partitions = efi_and_root().resolve(DISK_SIZE, alignment=1024**2, alignment_offset=3584)
+	# Starts round up and ends round down to 3584 + n * 1MiB
+	assert [partition['start'] for partition in partitions] == [1024**2 + 3584, 513 * 1024**2 + 3584]
+	assert partitions[0]['size'] == 511 * 1024**2
+	assert (partitions[1]['start'] + partitions[1]['size'] - 3584) % 1024**2 == 0
+	assert partitions[1]['start'] + partitions[1]['size'] <= DISK_SIZE - 33 * 512
+
+@pytest.mark.parametrize('start, end, message', [
+	('0MiB', '1GiB', 'inside the GPT header'),
+	('1MiB', '9GiB', 'beyond the end of the disk'),
+	('1MiB', '1MiB', 'is empty once aligned'),
+])
+def test_resolve_rejects(start, end, message):
+	plan = archinstall.PartitionPlan()
+	plan.add(start=start, end=end)
+	with pytest.raises(archinstall.DiskError, match=message):
+		plan.resolve(DISK_SIZE)
+
+def test_resolve_rejects_layout():
+	plan = archinstall.PartitionPlan()
+	plan.add(start='1MiB', end='100%')
+	plan.add(start='2GiB', end='3GiB')
+	with pytest.raises(archinstall.DiskError, match='not the last partition'):
+		plan.resolve() # 100% is only "the rest of the disk" while the size isn't known
+
+	plan = archinstall.PartitionPlan()
+	plan.add(start='1MiB', end='2GiB')
+	plan.add(start='1GiB', end='3GiB')
+	with pytest.raises(archinstall.DiskError, match='overlapping partition 0'):
+		plan.resolve(DISK_SIZE)
+
+	plan = archinstall.PartitionPlan()
+	plan.add(start='1MiB', end='2GiB', flags=['no_such_flag'])
+	with pytest.raises(archinstall.DiskError, match='Unsupported flag'):
+		plan.resolve(DISK_SIZE)
+
+def _limits(physical_block_size=512, minimum_io_size=512, optimal_io_size=0, alignment_offset=0):
+	return {'logical_block_size' : 512, 'physical_block_size' : physical_block_size, 'minimum_io_size' : minimum_io_size,
+		'optimal_io_size' : optimal_io_size, 'alignment_offset' : alignment_offset}
+
+@pytest.mark.parametrize('limits, expected', [
+	(_limits(), (1024**2, 0)),
+	(_limits(4096, 4096), (1024**2, 0)),
+	(_limits(4096, 65536, 196608), (3 * 1024**2, 0)), # A RAID5 stripe of three 64KiB chunks
+	(_limits(4096, 4096, 33553920), (1024**2, 0)), # USB bridges reporting 0xFFFE00, not a multiple of the block size
+	(_limits(4096, 4096, 48 * 1024**2), (48 * 1024**2, 0)),
+	(_limits(4096, 4096, 96 * 1024**2), (1024**2, 0)), # Past 64MiB
+	(_limits(4096, 4096, alignment_offset=3584), (1024**2, 3584)),
+])
+def test_partition_alignment(limits, expected):
+	assert archinstall.partition_alignment(limits) == expected
+
+def test_gpt_writer_round_trip(tmp_path):
+	image = tmp_path / 'disk.img'
+	with open(image, 'wb') as fh:
+		fh.truncate(DISK_SIZE)
+
+	writer = archinstall.GPTWriter(str(image))
+	disk_guid = writer.write(efi_and_root())
+	table = writer.read()
+
+	assert table['disk_guid'] == disk_guid
+	assert [(partition['number'], partition['start'], partition['size']) for partition in table['partitions']] == [
+		(1, 1024**2, 512 * 1024**2),
+		(2, 513 * 1024**2, 15726552 * 512),
+	]
+	assert table['partitions'][0]['type'] == archinstall.GPT_PARTITION_TYPES['esp']
+	assert table['partitions'][0]['name'] == 'EFI'
+	assert table['partitions'][1]['attributes'] == ['LegacyBIOSBootable']
+
+def test_gpt_writer_detects_corruption(tmp_path):
+	image = tmp_path / 'disk.img'
+	with open(image, 'wb') as fh:
+		fh.truncate(1024**3)
+
+	writer = archinstall.GPTWriter(str(image))
+	writer.write(efi_and_root())
+	with open(image, 'r+b') as fh:
+		fh.seek(512 + 24) # The current LBA field of the primary header
+		fh.write(b'\xff')
+	with pytest.raises(archinstall.DiskError, match='bad CRC32'):
+		writer.read()
@@ -0,0 +1,53 @@
+import shutil, subprocess, uuid
+import pytest
+import archinstall
+
+def _image(path, size):
+	with open(path, 'wb') as fh:
+		fh.truncate(size)
+	return str(path)
+
+def _run(*cmd):
+	if not shutil.which(cmd[0]):
+		pytest.skip(f'{cmd[0]} is not installed')
+	subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+@pytest.mark.parametrize('filesystem, options', [
+	('ext4', ()),
+	('ext3', ('-O', '^extent,^64bit,^flex_bg')),
+	('ext2', ('-O', '^has_journal,^extent,^64bit,^flex_bg')),
+])
+def test_ext(tmp_path, filesystem, options):
+	image = _image(tmp_path / 'ext.img', 64 * 1024**2)
+	filesystem_uuid = str(uuid.uuid4())
+	_run('mkfs.ext4', '-q', '-F', '-U', filesystem_uuid, '-L', 'archroot', *options, image)
+
+	assert archinstall.read_superblock(image) == {'type' : filesystem, 'uuid' : filesystem_uuid, 'label' : 'archroot', 'partuuid' : None}
+
+@pytest.mark.parametrize('page_size', [4096, 65536])
+def test_mkswap(tmp_path, page_size):
+	image = _image(tmp_path / 'swap.img', 16 * 1024**2)
+	swap_uuid = str(uuid.uuid4())
+	_run('mkswap', '-p', str(page_size), '-U', swap_uuid, '-L', 'swap', image)
+
+	assert archinstall.read_superblock(image) == {'type' : 'swap', 'uuid' : swap_uuid, 'label' : 'swap', 'partuuid' : None}
+
+def test_write_swap_header(tmp_path):
+	image = _image(tmp_path / 'swap.img', 16 * 1024**2)
+	swap_uuid = archinstall.write_swap_header(image, label='swapfile')
+
+	assert archinstall.read_superblock(image) == {'type' : 'swap', 'uuid' : swap_uuid, 'label' : 'swapfile', 'partuuid' : None}
+
+def test_swap_replaces_ext4(tmp_path):
+	image = _image(tmp_path / 'reused.img', 16 * 1024**2)
+	_run('mkfs.ext4', '-q', '-F', image)
+	archinstall.write_swap_header(image)
+
+	# The ext4 magic is wiped, so it's not found before the swap signature
+	assert archinstall.read_superblock(image)['type'] == 'swap'
+
+def test_unknown_and_too_small(tmp_path):
+	assert archinstall.read_superblock(_image(tmp_path / 'empty.img', 1024**2))['type'] is None
+
+	with pytest.raises(archinstall.DiskError):
+		archinstall.read_superblock(_image(tmp_path / 'tiny.img', 100))
@@ -0,0 +1,95 @@
+import os
+import archinstall
+from benchmarks.sysfs import create_fake_sysfs
+
+def _write(path, data):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, 'w') as fh:
+		fh.write(f'{data}\n')
+
+def _block(device_dir, dev, sectors):
+	_write(f'{device_dir}/size', sectors)
+	_write(f'{device_dir}/dev', dev)
+	_write(f'{device_dir}/removable', 0)
+	os.makedirs(f'{device_dir}/holders', exist_ok=True)
+	os.makedirs(f'{device_dir}/slaves', exist_ok=True)
+	return device_dir
+
+def _link(sysfs, name, device_dir):
+	os.makedirs(f'{sysfs}/block', exist_ok=True)
+	os.symlink(os.path.relpath(device_dir, f'{sysfs}/block'), f'{sysfs}/block/{name}')
+
+def _stack(lower_dir, upper_dir):
+	# Links both ways, like the kernel does for device mapper and md devices
+	os.symlink(os.path.relpath(lower_dir, f'{upper_dir}/slaves'), f'{upper_dir}/slaves/{os.path.basename(lower_dir)}')
+	os.symlink(os.path.relpath(upper_dir, f'{lower_dir}/holders'), f'{lower_dir}/holders/{os.path.basename(upper_dir)}')
+
+def test_enumerate_fake_sysfs(tmp_path):
+	roots = create_fake_sysfs(str(tmp_path), nvme=2, partitions=2, loops=2, multipath=1)
+	devices = {device['path'] : device for device in archinstall.enumerate_block_devices(**roots)}
+
+	assert devices['/dev/nvme0n1']['type'] == 'disk'
+	assert devices['/dev/nvme0n1p2']['type'] == 'part'
+	assert devices['/dev/nvme0n1p2']['pkname'] == 'nvme0n1'
+	assert devices['/dev/nvme0n1p2']['mountpoint'] == '/srv/nvme0/2'
+	assert devices['/dev/nvme1n1p1']['label'] == 'nvme1n1p1-label'
+	assert devices['/dev/loop1']['type'] == 'loop'
+	assert devices['/dev/mapper/mpath0']['type'] == 'mpath'
+	assert not any(device['rm'] or device['hotplug'] for device in devices.values())
+
+	# The multipath device is listed under both of its paths, but isn't a top level device itself
+	entries = archinstall.enumerate_block_devices(**roots)
+	assert sorted(device['pkname'] for device in entries if device['path'] == '/dev/mapper/mpath0') == ['sdaa', 'sdab']
+
+def test_enumerate_stacked_and_hotplugged(tmp_path):
+	sysfs, udev = f'{tmp_path}/sys', f'{tmp_path}/udev'
+	os.makedirs(udev)
+
+	# sda1 -> dm-0 (LUKS) -> dm-1 (LVM, btrfs mounted at / through an anonymous 0:N device number)
+	sda = _block(f'{sysfs}/devices/pci0000:00/ata1/block/sda', '8:0', 1000215216)
+	stack = [_block(f'{sda}/sda1', '8:1', 1000212480)]
+	_write(f'{sda}/sda1/partition', 1)
+	_link(sysfs, 'sda', sda)
+
+	for name, dev, uuid, dm_name in (('dm-0', '254:0', 'CRYPT-LUKS2-0123-root', 'root'), ('dm-1', '254:1', 'LVM-abcdef', 'vg-root')):
+		device_dir = _block(f'{sysfs}/devices/virtual/block/{name}', dev, 1000179712)
+		_write(f'{device_dir}/dm/uuid', uuid)
+		_write(f'{device_dir}/dm/name', dm_name)
+		_link(sysfs, name, device_dir)
+		_stack(stack[-1], device_dir)
+		stack.append(device_dir)
+
+	# A USB stick, hotplugged through its ancestor on the usb bus
+	usb = f'{sysfs}/devices/pci0000:00/usb1/1-1'
+	_link(sysfs, 'sdb', _block(f'{usb}/host0/block/sdb', '8:16', 60062500))
+	os.makedirs(f'{sysfs}/bus/usb/devices')
+	os.symlink(os.path.relpath(usb, f'{sysfs}/bus/usb/devices'), f'{sysfs}/bus/usb/devices/1-1')
+
+	# An unused loop device and a RAM disk, both left out
+	_link(sysfs, 'loop0', _block(f'{sysfs}/devices/virtual/block/loop0', '7:0', 0))
+	_link(sysfs, 'ram0', _block(f'{sysfs}/devices/virtual/block/ram0', '1:0', 16384))
+
+	_write(f'{tmp_path}/mountinfo', '\n'.join([
+		'22 1 0:25 /@ / rw,relatime shared:1 - btrfs /dev/mapper/vg-root rw,space_cache=v2',
+		'23 22 0:25 /@home /home\\040dir rw,relatime shared:2 - btrfs /dev/mapper/vg-root rw,space_cache=v2'
+	]))
+
+	devices = archinstall.enumerate_block_devices(sysfs=sysfs, mountinfo=f'{tmp_path}/mountinfo', udev_data=udev)
+	assert [device['path'] for device in devices] == ['/dev/sda', '/dev/sda1', '/dev/mapper/root', '/dev/mapper/vg-root', '/dev/sdb']
+
+	by_path = {device['path'] : device for device in devices}
+	assert by_path['/dev/mapper/root']['type'] == 'crypt'
+	assert by_path['/dev/mapper/root']['pkname'] == 'sda1'
+	assert by_path['/dev/mapper/vg-root']['type'] == 'lvm'
+	assert by_path['/dev/mapper/vg-root']['pkname'] == 'dm-0'
+	assert by_path['/dev/mapper/vg-root']['mountpoint'] == '/'
+	assert by_path['/dev/sdb']['hotplug'] and not by_path['/dev/sda']['hotplug']
+
+	disks = archinstall.all_disks(sysfs=sysfs, mountinfo=f'{tmp_path}/mountinfo', udev_data=udev, fixed=True)
+	assert list(disks) == ['/dev/sda', '/dev/mapper/root', '/dev/mapper/vg-root']
+
+def test_read_mountinfo_unescapes(tmp_path):
+	_write(f'{tmp_path}/mountinfo', '36 1 8:2 / /mnt/my\\040disk rw - ext4 /dev/sda2 rw')
+	mounts = archinstall.read_mountinfo(f'{tmp_path}/mountinfo')
+	assert mounts['8:2'] == '/mnt/my disk'
+	assert mounts['/dev/sda2'] == '/mnt/my disk'